@@ -0,0 +1,68 @@
+import argparse
+import time
+from typing import Callable, List
+
+
+def create_fragments(chunk_size: int, fragment_size: int) -> List[bytes]:
+    """
+    Creates the fragments aiohttp would hand us for one HTTP chunk of NDJSON
+    """
+    line: bytes = b'{"resourceType":"AuditEvent","id":"' + b"0" * 600 + b'"}\n'
+    chunk: bytes = (line * (chunk_size // len(line) + 1))[:chunk_size]
+    return [chunk[start:start + fragment_size] for start in range(0, chunk_size, fragment_size)]
+
+
+def assemble_with_bytes(fragments: List[bytes]) -> int:
+    """
+    The old loop: bytes concatenation (copies the whole buffer per fragment) and a decode just to count lines
+    """
+    buffer = b""
+    for data in fragments:
+        buffer += data
+    my_text = buffer.decode('utf-8')
+    return my_text.count('\n')
+
+
+def assemble_with_bytearray(fragments: List[bytes]) -> int:
+    """
+    The new loop: in-place bytearray growth and newline counting on the raw bytes
+    """
+    buffer = bytearray()
+    for data in fragments:
+        buffer += data
+    num_lines: int = buffer.count(b'\n')
+    buffer.clear()
+    return num_lines
+
+
+def measure(assemble: Callable[[List[bytes]], int], fragments: List[bytes], chunk_size: int,
+            total_bytes: int) -> float:
+    """
+    :return: MB/sec for assembling enough chunks to make up total_bytes
+    """
+    number_of_chunks: int = max(1, total_bytes // chunk_size)
+    start: float = time.perf_counter()
+    for _ in range(number_of_chunks):
+        assemble(fragments)
+    elapsed: float = time.perf_counter() - start
+    return number_of_chunks * chunk_size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares chunk assembly throughput of bytes vs bytearray")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[64 * 1024, 256 * 1024, 1024 * 1024])
+    parser.add_argument("--fragment-sizes", type=int, nargs="+", default=[1024, 4 * 1024, 16 * 1024])
+    parser.add_argument("--total-mb", type=int, default=8, help="MB to assemble per measurement")
+    args = parser.parse_args()
+
+    print(f"{'Chunk KB':>10} {'Fragment KB':>12} {'before MB/s':>12} {'after MB/s':>12} {'speedup':>8}")
+    for chunk_size in args.chunk_sizes:
+        for fragment_size in args.fragment_sizes:
+            if fragment_size > chunk_size:
+                continue
+            fragments: List[bytes] = create_fragments(chunk_size, fragment_size)
+            assert assemble_with_bytes(fragments) == assemble_with_bytearray(fragments)
+            before: float = measure(assemble_with_bytes, fragments, chunk_size, args.total_mb * 1024 * 1024)
+            after: float = measure(assemble_with_bytearray, fragments, chunk_size, args.total_mb * 1024 * 1024)
+            print(f"{chunk_size // 1024:>10,} {fragment_size // 1024:>12,} {before:>12,.0f} {after:>12,.0f}"
+                  f" {after / before if before > 0 else 0:>7.1f}x")
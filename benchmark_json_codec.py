@@ -0,0 +1,75 @@
+import argparse
+import time
+from typing import Any, Callable, Dict, List
+
+import json_codec
+
+
+def create_audit_event(index: int) -> Dict[str, Any]:
+    """
+    Creates an AuditEvent shaped like the ones the server returns, so parse and serialize costs are realistic
+    """
+    return {
+        "resourceType": "AuditEvent",
+        "id": f"{index:032x}",
+        "meta": {
+            "versionId": "1",
+            "lastUpdated": "2022-02-22T10:00:00.000Z",
+            "security": [
+                {"system": "https://www.icanbwell.com/owner", "code": "medstar"},
+                {"system": "https://www.icanbwell.com/access", "code": "medstar"}
+            ]
+        },
+        "type": {"system": "http://dicom.nema.org/resources/ontology/DCM", "code": "110112", "display": "Query"},
+        "action": "R",
+        "recorded": "2022-02-22T10:00:00.000Z",
+        "outcome": "0",
+        "agent": [
+            {
+                "who": {"reference": f"Person/{index % 1000:08d}"},
+                "altId": f"user{index % 1000}@example.com",
+                "requestor": True,
+                "network": {"address": f"10.0.{index % 256}.{index % 200}", "type": "2"}
+            }
+        ],
+        "source": {"site": "fhir.icanbwell.com", "observer": {"reference": "Organization/bwell"}},
+        "entity": [
+            {"what": {"reference": f"Patient/{index:012d}"}, "type": {"code": "1"}, "role": {"code": "1"}}
+        ]
+    }
+
+
+def measure(operation: Callable[[], int], repetitions: int) -> float:
+    """
+    :return: resources/sec of the best of repetitions runs of operation, which returns the number of resources
+    """
+    best: float = 0.0
+    for _ in range(repetitions):
+        start: float = time.perf_counter()
+        resource_count: int = operation()
+        elapsed: float = time.perf_counter() - start
+        best = max(best, resource_count / elapsed if elapsed > 0 else 0.0)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares resources/sec of the JSON backends in json_codec")
+    parser.add_argument("--resources", type=int, default=100_000, help="resources per measurement")
+    parser.add_argument("--repetitions", type=int, default=3, help="the best of this many runs is reported")
+    args = parser.parse_args()
+
+    resources: List[Dict[str, Any]] = [create_audit_event(index) for index in range(args.resources)]
+    backends: List[str] = [backend for backend in json_codec.BACKENDS if backend != "orjson" or json_codec.orjson]
+    if "orjson" not in backends:
+        print("orjson is not installed (pip install orjson), measuring the standard library only")
+
+    print(f"{'backend':>10} {'parse/s':>12} {'serialize/s':>12}")
+    for backend in backends:
+        json_codec.set_backend(backend)
+        ndjson: bytes = json_codec.dumps_ndjson(resources)
+        assert json_codec.parse_ndjson_lines(ndjson) == resources
+        parse_rate: float = measure(lambda: len(json_codec.parse_ndjson_lines(ndjson)), args.repetitions)
+        serialize_rate: float = measure(
+            lambda: json_codec.dumps_ndjson(resources).count(b"\n"), args.repetitions
+        )
+        print(f"{backend:>10} {parse_rate:>12,.0f} {serialize_rate:>12,.0f}")
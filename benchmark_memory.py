@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+from typing import Any, Dict, List
+
+from ndjson_sink import NdjsonFileSink
+from run_metrics import get_peak_rss_in_mb
+
+
+def create_audit_event(index: int) -> Dict[str, Any]:
+    """
+    Creates a synthetic AuditEvent roughly the size of the ones we download
+    """
+    return {
+        "resourceType": "AuditEvent",
+        "id": f"audit-event-{index}",
+        "meta": {
+            "versionId": "1",
+            "lastUpdated": "2022-02-22T10:00:00.000Z",
+            "security": [
+                {"system": "https://www.icanbwell.com/access", "code": "medstar"},
+                {"system": "https://www.icanbwell.com/owner", "code": "medstar"}
+            ]
+        },
+        "recorded": "2022-02-22T10:00:00.000Z",
+        "type": {"system": "http://dicom.nema.org/resources/ontology/DCM", "code": "110112", "display": "Query"},
+        "action": "R",
+        "agent": [
+            {
+                "who": {"reference": f"Person/{index % 1000}"},
+                "altId": f"user-{index % 1000}",
+                "requestor": True,
+                "network": {"address": "10.0.0.1", "type": "2"}
+            }
+        ],
+        "source": {"site": "fhir-next", "observer": {"reference": "Organization/bwell"}},
+        "entity": [{"what": {"reference": f"Patient/{index}"}}]
+    }
+
+
+async def run_benchmark(total_resources: int, batch_size: int, report_every: int, use_in_memory_list: bool) -> None:
+    """
+    Pushes synthetic AuditEvents through the NDJSON sink (or the old in-memory list) and reports
+    peak RSS against the number of resources received
+
+    :param total_resources: number of resources to generate
+    :param batch_size: number of resources per batch, like page_size_for_retrieving_resources
+    :param report_every: print a line every this many resources
+    :param use_in_memory_list: keep every resource in a list like main.py used to
+    """
+    resources: List[Dict[str, Any]] = []
+    mode: str = "in-memory list" if use_in_memory_list else "NDJSON sink"
+    print(f"Mode: {mode}, resources: {total_resources:,}, batch size: {batch_size:,}")
+    print(f"{'Resources':>12} {'Peak RSS MB':>12} {'Elapsed':>16}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start_job = time.time()
+        async with NdjsonFileSink(os.path.join(temp_dir, "benchmark.ndjson")) as sink:
+            next_report: int = report_every
+            for batch_start in range(0, total_resources, batch_size):
+                batch: List[Dict[str, Any]] = [
+                    create_audit_event(index)
+                    for index in range(batch_start, min(batch_start + batch_size, total_resources))
+                ]
+                if use_in_memory_list:
+                    resources.extend(batch)
+                else:
+                    await sink.write_resources(batch)
+                received: int = batch_start + len(batch)
+                if received >= next_report or received == total_resources:
+                    print(f"{received:>12,} {get_peak_rss_in_mb():>12.1f}"
+                          f" {str(timedelta(seconds=time.time() - start_job)):>16}")
+                    next_report += report_every
+        print(f"====== {mode}: {total_resources:,} resources, {sink.total_bytes / (1024 * 1024):.0f} MB written,"
+              f" peak RSS {get_peak_rss_in_mb():.1f} MB =======")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reports peak RSS against resource count for the output sink")
+    parser.add_argument("--resources", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--report-every", type=int, default=100000)
+    parser.add_argument("--in-memory", action="store_true",
+                        help="keep resources in a list (the old behavior) instead of streaming them to disk")
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(total_resources=args.resources, batch_size=args.batch_size,
+                              report_every=args.report_every, use_in_memory_list=args.in_memory))
@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import csv
+import importlib
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from statistics import median
+from typing import Any, Dict, List, Union
+
+from dotenv import load_dotenv
+
+import json_codec
+from run_metrics import RunMetrics
+
+# scripts whose load_data() can be run by the suite
+SCRIPTS: List[str] = ["simple_with_progress", "simple_sync_with_progress", "chunked_sync_with_progress"]
+
+# metrics that are summarized (median over the measured runs) per cell
+SUMMARY_METRICS: List[str] = [
+    "time_to_first_byte", "total_seconds", "resources_per_second", "mb_per_second", "wire_mb_per_second",
+    "compression_ratio", "cpu_seconds", "decompress_cpu_seconds",
+    "chunk_latency_p50", "chunk_latency_p95", "chunk_latency_p99", "peak_rss_mb"
+]
+
+
+def expand_matrix(matrix: Union[Dict[str, Any], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Turns a matrix into the list of cells to run.
+
+    :param matrix: either a list of cells, or a dict of setting -> value or list of values,
+                   in which case every combination of the values is a cell
+    """
+    if isinstance(matrix, list):
+        return [dict(cell) for cell in matrix]
+    keys: List[str] = list(matrix.keys())
+    values: List[List[Any]] = [value if isinstance(value, list) else [value] for value in matrix.values()]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def describe_cell(cell: Dict[str, Any]) -> str:
+    return " ".join(f"{key}={value}" for key, value in cell.items())
+
+
+def run_cell_in_this_process(cell: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs load_data() of the cell's script once and returns its metrics
+    """
+    settings: Dict[str, Any] = dict(cell)
+    script: str = settings.pop("script")
+    assert script in SCRIPTS, f"Unknown script {script}, expected one of {SCRIPTS}"
+    # json_backend is not a load_data() setting: it picks the JSON library for the whole run
+    json_codec.set_backend(settings.pop("json_backend", None))
+    module = importlib.import_module(script)
+    metrics: RunMetrics = asyncio.run(module.load_data(**settings))
+    return {**metrics.to_dict(), "json_backend": json_codec.backend}
+
+
+def run_cell(cell: Dict[str, Any], show_output: bool) -> Dict[str, Any]:
+    """
+    Runs the cell once in a new process, so peak RSS and caches are not carried over from earlier runs
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result_file: str = os.path.join(temp_dir, "result.json")
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-cell", json_codec.dumps(cell).decode("utf-8"),
+             "--result-file", result_file],
+            stdout=None if show_output else subprocess.DEVNULL,
+            stderr=None if show_output else subprocess.PIPE
+        )
+        if completed.returncode != 0 or not os.path.exists(result_file):
+            error: str = completed.stderr.decode('utf-8', errors='replace').strip() if completed.stderr else ""
+            return {"error": error.splitlines()[-1] if error else f"exit code {completed.returncode}"}
+        with open(result_file, mode='rb') as file:
+            result: Dict[str, Any] = json_codec.loads(file.read())
+            return result
+
+
+def summarize(cell: Dict[str, Any], runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    successful_runs: List[Dict[str, Any]] = [run for run in runs if "error" not in run]
+    summary: Dict[str, Any] = {**cell, "runs": len(runs), "failed_runs": len(runs) - len(successful_runs)}
+    for metric in SUMMARY_METRICS:
+        values: List[float] = [run[metric] for run in successful_runs if run.get(metric) is not None]
+        summary[f"median_{metric}"] = median(values) if values else None
+    return summary
+
+
+def write_results(output_prefix: str, runs: List[Dict[str, Any]], summaries: List[Dict[str, Any]]) -> None:
+    """
+    Writes <output_prefix>.json with every run and the per-cell summary, and <output_prefix>.csv with every run
+    """
+    with open(f"{output_prefix}.json", mode='wb') as file:
+        file.write(json_codec.dumps({"runs": runs, "summary": summaries}, indent=True))
+    field_names: List[str] = []
+    for run in runs:
+        field_names.extend(key for key in run.keys() if key not in field_names)
+    with open(f"{output_prefix}.csv", mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=field_names)
+        writer.writeheader()
+        writer.writerows(runs)
+
+
+def run_suite(cells: List[Dict[str, Any]], repetitions: int, warmup: int, output_prefix: str,
+              show_output: bool) -> None:
+    """
+    Runs each cell warmup times (results discarded) and then repetitions times
+
+    :param cells: settings for load_data() plus the script to run
+    :param repetitions: measured runs per cell
+    :param warmup: runs per cell before the measured runs, e.g. to warm up server caches
+    :param output_prefix: results are written to <output_prefix>.json and <output_prefix>.csv
+    :param show_output: show the output of the scripts
+    """
+    runs: List[Dict[str, Any]] = []
+    summaries: List[Dict[str, Any]] = []
+    for cell_number, cell in enumerate(cells, start=1):
+        print(f"--------- [{cell_number}/{len(cells)}] {describe_cell(cell)} -----")
+        for warmup_run in range(1, warmup + 1):
+            result: Dict[str, Any] = run_cell(cell, show_output=show_output)
+            print(f"warmup {warmup_run}: {result.get('error') or 'done'}")
+        cell_runs: List[Dict[str, Any]] = []
+        for repetition in range(1, repetitions + 1):
+            started: str = datetime.now().isoformat()
+            result = run_cell(cell, show_output=show_output)
+            cell_runs.append({**cell, "repetition": repetition, "started": started, **result})
+            if "error" in result:
+                print(f"run {repetition}: ERROR {result['error']}")
+            else:
+                print(f"run {repetition}: {result['resources']:,} resources in {result['total_seconds']:.2f}s"
+                      f" ttfb={result['time_to_first_byte'] or 0:.2f}s {result['resources_per_second']:,.0f}/s"
+                      f" {result['mb_per_second']:.1f} MB/s ({result['wire_mb_per_second']:.1f} MB/s on the wire)"
+                      f" cpu={result['cpu_seconds']:.2f}s (decompress {result['decompress_cpu_seconds']:.2f}s)"
+                      f" peak RSS {result['peak_rss_mb']:.0f} MB json={result['json_backend']}")
+        runs.extend(cell_runs)
+        summaries.append(summarize(cell, cell_runs))
+        # write after every cell so a long suite that is interrupted still leaves results behind
+        write_results(output_prefix, runs, summaries)
+    print(f"====== Wrote {len(runs)} runs of {len(cells)} cells to {output_prefix}.json and {output_prefix}.csv =======")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the download scripts over a matrix of servers and flags")
+    parser.add_argument("--matrix", default="benchmark_matrix.json",
+                        help="json file with a list of cells or a dict of setting -> list of values")
+    parser.add_argument("--repetitions", type=int, default=3, help="measured runs per cell")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured runs per cell before the measured ones")
+    parser.add_argument("--output-prefix", default="benchmark_results")
+    parser.add_argument("--show-output", action="store_true", help="show the progress output of the scripts")
+    parser.add_argument("--run-cell", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    load_dotenv()
+
+    if args.run_cell:
+        # child process started by run_cell()
+        cell_result: Dict[str, Any] = run_cell_in_this_process(json_codec.loads(args.run_cell))
+        with open(args.result_file, mode='wb') as result_file:
+            result_file.write(json_codec.dumps(cell_result))
+    else:
+        with open(args.matrix, mode='rb') as matrix_file:
+            matrix_cells: List[Dict[str, Any]] = expand_matrix(json_codec.loads(matrix_file.read()))
+        run_suite(cells=matrix_cells, repetitions=args.repetitions, warmup=args.warmup,
+                  output_prefix=args.output_prefix, show_output=args.show_output)
@@ -1,51 +1,90 @@
+import asyncio
 import os
-import requests
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import urljoin
 
+from aiohttp import ClientSession
 from dotenv import load_dotenv
 
+import json_codec
+from http_session_pool import HttpSessionPool
 
-def call_fhir_server(resource_url):
+FHIR_SERVER_HOST: str = "https://fhir.staging.bwell.zone"
+
+
+async def call_fhir_server(session: ClientSession, resource_url: str,
+                           fhir_server_host: str = FHIR_SERVER_HOST) -> Dict[str, Any]:
     assert os.environ.get("FHIR_AUTH_TOKEN"), "FHIR_AUTH_TOKEN environment variable must be set"
 
-    fhir_server_host = "https://fhir.staging.bwell.zone"
-    full_url = f"{fhir_server_host}{resource_url}"
-    payload = {}
+    # next links from the server are absolute urls, the first url is relative to the host
+    full_url = urljoin(fhir_server_host, resource_url)
     headers = {
-        f'Authorization': f'Bearer {os.environ.get("FHIR_AUTH_TOKEN")}'
+        'Authorization': f'Bearer {os.environ.get("FHIR_AUTH_TOKEN")}'
     }
 
-    response = requests.request("GET", full_url, headers=headers, data=payload)
-    print(response.status_code)
-    if response.status_code == 401:
-        print("ERROR: ========= Your FHIR_AUTH_TOKEN has expired ==========")
-    assert response.status_code == 200
-    return response.json()
+    async with session.get(full_url, headers=headers, ssl=False) as response:
+        if response.status == 401:
+            print("ERROR: ========= Your FHIR_AUTH_TOKEN has expired ==========")
+        assert response.status == 200, f"{response.status} from {full_url}"
+        response_json: Dict[str, Any] = json_codec.loads(await response.read())
+        return response_json
 
 
-def load_ids(url, practitioner_ids):
-    response_json = call_fhir_server(url)
-    # read the next url if it exists and store all the ids from the entry array
-    link_array = [x["url"] for x in response_json["link"] if x['relation'] == 'next']
-    print(link_array)
+async def load_ids(session: ClientSession, url: str, fhir_server_host: str = FHIR_SERVER_HOST) -> Set[str]:
+    """
+    Follows the next links from url and returns the ids of all the resources.
 
-    practitioner_ids.extend([x["resource"]["id"] for x in response_json["entry"]])
-    print("practitioner ids from single call")
-    # print(practitioner_ids)
-    if len(link_array) > 0:
-        next_url = link_array[0]
-        print(f"loading next page: {next_url}")
-        print(f"practitioner id count: {len(practitioner_ids)}")
-        load_ids(next_url, practitioner_ids)
-    else:
-        print(response_json)
+    Pages are read in a loop rather than by recursion, so the number of pages is not limited by the recursion
+    limit, and the request for the next page is sent before the ids of the current page are processed, so
+    we are waiting on the server for one page at a time at most.
 
+    :param session: session used for every page, so the connection is kept alive between pages
+    :param url: first page, relative to fhir_server_host
+    :param fhir_server_host: scheme and host of the FHIR server
+    """
+    practitioner_ids: Set[str] = set()
+    duplicate_count: int = 0
+    page_count: int = 0
+    start_time: float = time.time()
+    next_page: Optional["asyncio.Future[Dict[str, Any]]"] = asyncio.ensure_future(
+        call_fhir_server(session, url, fhir_server_host)
+    )
+    while next_page is not None:
+        response_json: Dict[str, Any] = await next_page
+        page_count += 1
+        # read the next url if it exists and start loading it while we store the ids from the entry array
+        link_array: List[str] = [x["url"] for x in response_json.get("link") or [] if x['relation'] == 'next']
+        next_page = asyncio.ensure_future(
+            call_fhir_server(session, link_array[0], fhir_server_host)
+        ) if link_array else None
 
-if __name__ == '__main__':
-    load_dotenv()
+        for entry in response_json.get("entry") or []:
+            resource_id: str = entry["resource"]["id"]
+            if resource_id in practitioner_ids:
+                duplicate_count += 1
+            else:
+                practitioner_ids.add(resource_id)
+        print(f"[{page_count:,}] practitioner id count: {len(practitioner_ids):,} duplicates: {duplicate_count:,}"
+              f" {timedelta(seconds=time.time() - start_time)}", end='\r')
+    print()
+    if duplicate_count:
+        print(f"ERROR: ========= {duplicate_count:,} ids were returned on more than one page ==========")
+    return practitioner_ids
+
+
+async def main() -> None:
     page_size = 200
     url = f"/4_0_0/Practitioner?_elements=id&_security=https://www.icanbwell.com/access|unitypoint&_useAtlas=1&_count={page_size}"
-    practitioner_ids = []
-    load_ids(url, practitioner_ids)
-    print(practitioner_ids)
+    pool = HttpSessionPool()
+    practitioner_ids: Set[str] = await load_ids(pool.session, url)
+    print(pool.report())
+    await pool.close()
     print(f"total practitioner id count: {len(practitioner_ids)}")
-    assert '1003219551' in practitioner_ids, f"practitioner id 1003219551 was not found"
+    assert '1003219551' in practitioner_ids, "practitioner id 1003219551 was not found"
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    asyncio.run(main())
@@ -0,0 +1,134 @@
+import os
+from typing import Any, Dict, List, Optional, Set
+
+import json_codec
+
+
+class CheckpointState:
+    """
+    What a previous run durably completed, as read back from the journal
+    """
+
+    def __init__(self) -> None:
+        self.header: Optional[Dict[str, Any]] = None
+        # output file -> offset up to which the output file holds only committed records
+        self.committed_offsets: Dict[str, int] = {}
+        self.completed_slices: Set[int] = set()
+        # ids already written for slices that were not completed, so they can be skipped on resume
+        self.ids_seen: Set[str] = set()
+        self.committed_batches: int = 0
+
+
+class CheckpointJournal:
+    """
+    Append-only journal of export progress that lets an export resume after a crash or pod restart.
+
+    Batches and completed slices are held in memory until commit(), which is only called after the output files
+    have been fsynced up to the offsets being recorded.  Each commit is a single fsynced json line, so a
+    crash mid-write loses at most the last (unterminated) line and everything before it stays consistent.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        """
+        :param file_path: path of the journal file
+        """
+        self.file_path: str = file_path
+        self._pending_batches: List[Dict[str, Any]] = []
+        self._pending_completed_slices: List[int] = []
+
+    def start(self, header: Dict[str, Any]) -> None:
+        """
+        Starts a new journal, discarding any previous one
+
+        :param header: settings of this export; a resume must use the same settings
+        """
+        self._pending_batches = []
+        self._pending_completed_slices = []
+        with open(self.file_path, mode='wb') as file:
+            self._write_line(file, {"type": "header", **header})
+
+    def load(self) -> CheckpointState:
+        """
+        Reads back everything a previous run committed.  Uncommitted batches are ignored.
+        """
+        state: CheckpointState = CheckpointState()
+        if not os.path.exists(self.file_path):
+            return state
+        ids_by_slice: Dict[int, Set[str]] = {}
+        with open(self.file_path, mode='rb') as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # the process died while writing this line
+                entry: Dict[str, Any] = json_codec.loads(line)
+                if entry["type"] == "header":
+                    state.header = {k: v for k, v in entry.items() if k != "type"}
+                elif entry["type"] == "commit":
+                    state.committed_offsets.update(entry["offsets"])
+                    for batch in entry["batches"]:
+                        ids_by_slice.setdefault(batch["slice"], set()).update(batch["ids"])
+                        state.committed_batches += 1
+                    state.completed_slices.update(entry["completed_slices"])
+        for slice_number, ids in ids_by_slice.items():
+            if slice_number not in state.completed_slices:
+                state.ids_seen.update(ids)
+        return state
+
+    def record_batch(self, slice_number: int, ids: List[str]) -> None:
+        """
+        Records a batch whose records have been written to the output files (but not necessarily synced)
+        """
+        self._pending_batches.append({"slice": slice_number, "ids": ids})
+
+    def record_slice_completed(self, slice_number: int) -> None:
+        self._pending_completed_slices.append(slice_number)
+
+    def commit(self, offsets: Dict[str, int]) -> None:
+        """
+        Durably records everything since the last commit.  Call only after the output files have been
+        fsynced, passing offsets captured before the sync and after all pending batches were written.
+
+        :param offsets: output file -> offset up to which the file holds only recorded batches
+        """
+        entry: Dict[str, Any] = {
+            "type": "commit",
+            "offsets": offsets,
+            "batches": self._pending_batches,
+            "completed_slices": self._pending_completed_slices
+        }
+        self._pending_batches = []
+        self._pending_completed_slices = []
+        with open(self.file_path, mode='ab') as file:
+            self._write_line(file, entry)
+
+    def take_pending(self) -> "CheckpointJournal":
+        """
+        Moves the pending batches and slices into a new journal object so a commit can be prepared
+        while new batches keep arriving
+        """
+        snapshot: CheckpointJournal = CheckpointJournal(self.file_path)
+        snapshot._pending_batches = self._pending_batches
+        snapshot._pending_completed_slices = self._pending_completed_slices
+        self._pending_batches = []
+        self._pending_completed_slices = []
+        return snapshot
+
+    @staticmethod
+    def _write_line(file: Any, entry: Dict[str, Any]) -> None:
+        file.write(json_codec.dumps(entry) + b"\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def truncate_to_committed_offset(file_path: str, committed_offset: int) -> int:
+    """
+    Cuts off anything written to file_path after the last commit, e.g. half-written records
+
+    :return: number of bytes removed
+    """
+    if not os.path.exists(file_path):
+        assert committed_offset == 0, f"{file_path} is missing but the checkpoint expects {committed_offset} bytes"
+        return 0
+    size: int = os.path.getsize(file_path)
+    assert size >= committed_offset, f"{file_path} is shorter ({size}) than the checkpoint ({committed_offset})"
+    os.truncate(file_path, committed_offset)
+    return size - committed_offset
@@ -1,16 +1,19 @@
 import asyncio
-import base64
-import json
 import os
-from typing import Dict, Any
 import time
 from datetime import datetime, timedelta
+from typing import Optional, TextIO
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
-from furl import furl
-from requests import Session, Response
+from requests import Response
 from requests.exceptions import ChunkedEncodingError
 
+from chunked_transfer_decoder import ChunkedTransferDecoder
+from run_metrics import RunMetrics
+from token_provider import get_access_token
+from transport_compression import StreamingDecompressor
+
 
 # from http.client import HTTPConnection, HTTPResponse
 # HTTPConnection.debuglevel = 1
@@ -18,55 +21,19 @@ from requests.exceptions import ChunkedEncodingError
 
 
 async def authenticate(client_id, client_secret, fhir_server_url):
-    full_uri: furl = furl(furl(fhir_server_url).origin)
-    full_uri /= ".well-known/smart-configuration"
-
-    # print(f"Calling {full_uri}")
-    with Session() as http:
-        response: Response = http.request(
-            "GET", str(full_uri)
-        )
-        response_json = json.loads(response.text)
-        auth_server_url = response_json["token_endpoint"]
-
     auth_scopes = ["user/AuditEvent.read", "access/medstar.*"]
-
-    login_token: str = base64.b64encode(
-        f"{client_id}:{client_secret}".encode("ascii")
-    ).decode("ascii")
-
-    payload: str = (
-        "grant_type=client_credentials&scope=" + "%20".join(auth_scopes)
-        if auth_scopes
-        else ""
-    )
-    # noinspection SpellCheckingInspection
-    headers: Dict[str, str] = {
-        "Accept": "application/json",
-        "Authorization": "Basic " + login_token,
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-
-    # print(f"Calling {auth_server_url}")
-    with Session() as http:
-        with http.request(
-                "POST", auth_server_url, headers=headers, data=payload
-        ) as response:
-            token_text: str = response.text
-            if not token_text:
-                return None
-            token_json: Dict[str, Any] = json.loads(token_text)
-
-            if "access_token" not in token_json:
-                raise Exception(f"No access token found in {token_json}")
-            access_token: str = token_json["access_token"]
-        return access_token
+    # the token endpoint and the access token are cached in process and on disk by the shared provider
+    return await get_access_token(fhir_server_url=fhir_server_url, client_id=client_id,
+                                  client_secret=client_secret, auth_scopes=auth_scopes)
 
 
 async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_atlas: bool, retrieve_only_ids: bool,
-                    use_access_index: bool = False):
+                    use_access_index: bool = False, trace_file_path: Optional[str] = None,
+                    metrics: Optional[RunMetrics] = None, use_compression: bool = False) -> RunMetrics:
     """
     loads data
+    :param use_compression: let the server compress the response; it is decompressed here chunk by chunk
+    :param trace_file_path: if set, chunk headers are traced to this file, separately from the data in output.json
     :param use_access_index:
     :param retrieve_only_ids:
     :type retrieve_only_ids:
@@ -75,14 +42,15 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     :param fhir_server:
     :type use_data_streaming:
     :param limit:
-    :return: None
+    :param metrics: timings of this run are recorded here.  If not passed, a new one is created.
+    :return: timings of this run
     """
     # greater_than = "2023-05-01"
     # less_than = "2023-05-30"
     # fhir_server_relative_url = f"/4_0_0/AuditEvent?_lastUpdated=gt{greater_than}&_lastUpdated=lt{less_than}&_count={limit}&_getpagesoffset=0"
     fhir_server_relative_url = f"/4_0_0/Practitioner"
     if retrieve_only_ids:
-        fhir_server_relative_url += "&_elements=id"
+        fhir_server_relative_url += ("&" if "?" in fhir_server_relative_url else "?") + "_elements=id"
     # if use_data_streaming:
     #     fhir_server_relative_url += "&_streamResponse=1"
     # fhir_server_relative_url += "&_cursorBatchSize=100"
@@ -91,7 +59,9 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     # cursor_batch_size = 1000000
     # if cursor_batch_size:
     #     fhir_server_url += f"&_cursorBatchSize={cursor_batch_size}"
-    fhir_server_url = f"https://{fhir_server}{fhir_server_relative_url}"
+    # a url such as http://localhost:8080 (see mock_fhir_server.py) can be passed instead of a host name
+    fhir_server_base_url = fhir_server if "://" in fhir_server else f"https://{fhir_server}"
+    fhir_server_url = f"{fhir_server_base_url}{fhir_server_relative_url}"
     # fhir_server_url = f"https://{fhir_server}/4_0_0/AuditEvent?_lastUpdated=gt2022-04-20&_lastUpdated=lt2022-04-22&_elements=id&_count={limit}&_getpagesoffset=0"
     assert os.environ.get("FHIR_CLIENT_ID"), "FHIR_CLIENT_ID environment variable must be set"
     assert os.environ.get("FHIR_CLIENT_SECRET"), "FHIR_CLIENT_SECRET environment variable must be set"
@@ -106,9 +76,10 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
         "Authorization": f"Bearer {access_token}",
         "Connection": "Keep-Alive",
         # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Keep-Alive
-        "Keep-Alive": "timeout=600, max=100",
-        "x-no-compression": "1"
+        "Keep-Alive": "timeout=600, max=100"
     }
+    if not use_compression:
+        headers["x-no-compression"] = "1"
 
     payload = {}
 
@@ -127,61 +98,59 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
 
     # https://stackoverflow.com/questions/24500752/how-can-i-read-exactly-one-response-chunk-with-pythons-http-client
     import http.client
-    conn = http.client.HTTPSConnection(fhir_server, timeout=60*60*1000)
+    metrics = metrics or RunMetrics()
+    metrics.start()
+    server_location = urlsplit(fhir_server_base_url)
+    connection_class = http.client.HTTPSConnection if server_location.scheme == "https" else http.client.HTTPConnection
+    conn = connection_class(server_location.netloc, timeout=60*60*1000)
     conn.request("GET", fhir_server_relative_url, headers=headers, encode_chunked=False)
     resp = conn.getresponse()
+    metrics.record_first_byte(resp.status)
     print(resp.status, resp.reason)
+    # http.client does not decompress, so a compressed body is decompressed here as each piece is read
+    decompressor = StreamingDecompressor(resp.getheader("Content-Encoding"))
+    decoded_line_count: int = 0
+    trace_file: Optional[TextIO] = open(trace_file_path, mode='w') if trace_file_path else None
     with open('output.json', mode='wb') as file:
-        resp.chunked = False
-
-        def get_chunk_size(file1):
-            if resp.closed:
-                print("Response closed")
-            file1.write("waiting for chunk size: ".encode())
-            file1.write("\n".encode('utf-8'))
-            file1.flush()
-            size_str = resp.read(2)
-            while size_str[-2:] != b"\r\n":
-                size_str += resp.read(1)
-            # print(f"size: {size_str}\n")
-            file1.write("size: ".encode())
-            file1.write("\n".encode('utf-8'))
-            file1.write(size_str)
-            file1.write(str(int(size_str[:-2], 16)).encode())
-            file1.write("\n".encode('utf-8'))
-            file1.flush()
-            return int(size_str[:-2], 16)
-
-        def get_chunk_data(file1, chunk_size1):
-            file1.write("waiting for chunk data: ".encode())
-            file1.write("\n".encode('utf-8'))
-            file1.flush()
-            data = resp.read(chunk_size1)
-            trailer = resp.read(2)
-            # print(f"data: {data}{trailer}\n")
-            file1.write("data: ".encode())
-            file.write("\n".encode('utf-8'))
-            file1.write(data)
-            file1.write(trailer)
-            # file.write("\n".encode('utf-8'))
-            file1.flush()
-            return data
-
-        while True:
-            chunk_size = get_chunk_size(file)
-            if chunk_size == 0:
-                break
-            else:
-                line = get_chunk_data(file, chunk_size)
+        if resp.chunked:
+            # decode the chunked transfer encoding ourselves so we see every chunk the server sends
+            resp.chunked = False
+            decoder = ChunkedTransferDecoder(resp, trace_file=trace_file)
+            for data, end_of_chunk in decoder.iter_chunks():
+                decoded = decompressor.decompress(data)
+                file.write(decoded)
+                if decompressor.is_compressed:
+                    # the decoder counts the lines in what it read, which here is compressed
+                    decoded_line_count += decoded.count(b'\n')
+                else:
+                    decoded_line_count = decoder.line_count
+                if end_of_chunk:
+                    chunk_number += 1
+                    metrics.record_chunk(decompressor.decoded_bytes - metrics.byte_count,
+                                         decoded_line_count - line_count,
+                                         decompressor.wire_bytes - metrics.wire_byte_count)
+                    line_count = decoded_line_count
+                    chunk_end_time = time.time()
+                    print(f"[{chunk_number:,} {line_count:,}] {decoder.payload_bytes:,}"
+                          f" {timedelta(seconds=chunk_end_time - start_job)}", end='\r')
+        else:
+            buffer = bytearray(256 * 1024)
+            view = memoryview(buffer)
+            bytes_read: int = resp.readinto(buffer)
+            while bytes_read:
+                decoded = decompressor.decompress(view[:bytes_read])
+                file.write(decoded)
                 chunk_number += 1
-                chunk_end_time = time.time()
-                # file.write(chunk)
-                my_text = line.decode('utf-8')
-                line_count += my_text.count('\n')
-                # file.write("\n".encode('utf-8'))
-                # file.flush()
-                print(f"[{chunk_number:,} {line_count:,}] {chunk_size} {timedelta(seconds=chunk_end_time - start_job)}", end='\n')
-                # print(repr(chunk))
+                lines_read: int = (decoded.count(b'\n') if decompressor.is_compressed
+                                   else buffer.count(b'\n', 0, bytes_read))
+                line_count += lines_read
+                metrics.record_chunk(len(decoded), lines_read, bytes_read)
+                bytes_read = resp.readinto(buffer)
+        tail: bytes = decompressor.flush()
+        if tail:
+            file.write(tail)
+            line_count += tail.count(b'\n')
+            metrics.record_chunk(len(tail), tail.count(b'\n'), 0)
 
         conn.close()
         # while chunk := r1.read(200):
@@ -246,9 +215,17 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     #                     print(response.text)
     #         else:
     #             print(f"ERROR: {response.status_code} {response.text}")
+    if trace_file:
+        trace_file.close()
+    metrics.record_decompression(decompressor.cpu_seconds)
+    metrics.finish()
     end_job = time.time()
-    print(f"\n====== Received {chunk_number} chunks in {timedelta(seconds=end_job - start_job)}"
+    print(f"\n====== Received {chunk_number} chunks ({line_count:,} lines) in {timedelta(seconds=end_job - start_job)}"
           f" with Atlas={use_atlas} =======")
+    print(f"Content-Encoding={decompressor.content_encoding} wire MB={metrics.wire_byte_count / (1024 * 1024):,.1f}"
+          f" decoded MB={metrics.byte_count / (1024 * 1024):,.1f} ratio={metrics.compression_ratio:.1f}"
+          f" decompress cpu={metrics.decompress_seconds:.2f}s of {metrics.cpu_seconds:.2f}s")
+    return metrics
 
 
 # Press the green button in the gutter to run the script.
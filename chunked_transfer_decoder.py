@@ -0,0 +1,104 @@
+from typing import Any, Iterator, Optional, TextIO, Tuple
+
+
+class ChunkedTransferDecoder:
+    """
+    Decodes an HTTP/1.1 chunked transfer encoded body (https://datatracker.ietf.org/doc/html/rfc7230#section-4.1)
+    from a raw stream.
+
+    Data is read with readinto() into one preallocated buffer and the chunk-size lines are parsed from that buffer,
+    so we never read a byte at a time and never copy the payload before handing it to the caller.
+    """
+
+    def __init__(self, raw: Any, buffer_size: int = 256 * 1024, trace_file: Optional[TextIO] = None) -> None:
+        """
+        :param raw: stream positioned at the start of the body that supports readinto(),
+                    e.g. an http.client.HTTPResponse with chunked set to False
+        :param buffer_size: size of the read buffer; chunks bigger than this are yielded in pieces
+        :param trace_file: if set, a line is written here for every chunk header, separately from the payload
+        """
+        self.raw: Any = raw
+        # readinto() of a buffered stream blocks until the whole buffer is filled, which on a keep-alive connection
+        # does not happen once the body is done; readinto1() returns as soon as some data has arrived
+        self._readinto: Any = getattr(raw, "readinto1", None) or raw.readinto
+        self.trace_file: Optional[TextIO] = trace_file
+        self._buffer: bytearray = bytearray(buffer_size)
+        self._view: memoryview = memoryview(self._buffer)
+        # unconsumed data is self._buffer[self._start:self._end]
+        self._start: int = 0
+        self._end: int = 0
+        self.chunk_count: int = 0
+        self.payload_bytes: int = 0
+        self.line_count: int = 0
+
+    def iter_chunks(self) -> Iterator[Tuple[memoryview, bool]]:
+        """
+        Yields (data, end_of_chunk) like aiohttp's iter_chunks().  data is a view into the read buffer and is only
+        valid until the next item is requested, so write or copy it before continuing.
+        """
+        while True:
+            chunk_size: int = self._read_chunk_size()
+            if chunk_size == 0:
+                self._skip_trailers()
+                return
+            self.chunk_count += 1
+            remaining: int = chunk_size
+            while remaining > 0:
+                if self._start == self._end:
+                    self._fill()
+                take: int = min(remaining, self._end - self._start)
+                piece_start: int = self._start
+                self._start += take
+                remaining -= take
+                self.payload_bytes += take
+                self.line_count += self._buffer.count(b"\n", piece_start, self._start)
+                yield self._view[piece_start:self._start], remaining == 0
+            self._expect_crlf()
+
+    def _read_line(self) -> bytes:
+        """
+        Returns the next CRLF terminated line from the buffer, without the CRLF
+        """
+        while True:
+            line_end: int = self._buffer.find(b"\r\n", self._start, self._end)
+            if line_end >= 0:
+                line: bytes = bytes(self._buffer[self._start:line_end])
+                self._start = line_end + 2
+                return line
+            if self._start == 0 and self._end == len(self._buffer):
+                raise ValueError("Chunk header does not fit in the read buffer")
+            self._fill()
+
+    def _read_chunk_size(self) -> int:
+        size_line: bytes = self._read_line()
+        # ignore chunk extensions: 1a;name=value
+        chunk_size: int = int(size_line.split(b";", 1)[0].strip(), 16)
+        if self.trace_file:
+            self.trace_file.write(f"chunk {self.chunk_count + 1}: size line {size_line!r} = {chunk_size} bytes\n")
+        return chunk_size
+
+    def _expect_crlf(self) -> None:
+        trailer: bytes = self._read_line()
+        if trailer:
+            raise ValueError(f"Expected CRLF after chunk {self.chunk_count} but found {trailer!r}")
+
+    def _skip_trailers(self) -> None:
+        # the last chunk is followed by optional trailer fields and an empty line
+        while self._read_line():
+            pass
+        if self.trace_file:
+            self.trace_file.write(f"end of body: {self.chunk_count} chunks, {self.payload_bytes} bytes\n")
+
+    def _fill(self) -> None:
+        """
+        Moves unconsumed data to the front of the buffer and reads more after it
+        """
+        if self._start > 0:
+            unconsumed: int = self._end - self._start
+            self._buffer[0:unconsumed] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = unconsumed
+        bytes_read: int = self._readinto(self._view[self._end:])
+        if not bytes_read:
+            raise EOFError(f"Connection closed in the middle of chunk {self.chunk_count}")
+        self._end += bytes_read
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import json_codec
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Returns the given percentile (0-100) of values using the nearest-rank method
+    """
+    if not values:
+        return 0.0
+    sorted_values: List[float] = sorted(values)
+    rank: int = max(0, min(len(sorted_values) - 1, int(round(percent / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class FairSlots:
+    """
+    Limits how many slots are held at once, shared by several owners (e.g. the resource types of one export).
+    When a slot frees up and more than one owner is waiting, it goes to the waiting owner that holds the fewest,
+    so an owner with many queued slices cannot starve the others; an owner alone gets the whole limit.
+    """
+
+    def __init__(self, limit: int) -> None:
+        """
+        :param limit: most slots held at once
+        """
+        self.limit: int = limit
+        self.in_flight: int = 0
+        # owner -> slots held, and owner -> waiters
+        self.held: Dict[str, int] = {}
+        self._waiting: Dict[str, int] = {}
+        self._condition: asyncio.Condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self, owner: str = "") -> AsyncIterator[None]:
+        """
+        Waits until there is room under the limit and it is owner's turn, and holds a slot until the block exits
+        """
+        async with self._condition:
+            self._waiting[owner] = self._waiting.get(owner, 0) + 1
+            try:
+                await self._condition.wait_for(lambda: self.in_flight < self.limit and self._is_turn_of(owner))
+            finally:
+                self._waiting[owner] -= 1
+            self.in_flight += 1
+            self.held[owner] = self.held.get(owner, 0) + 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self.held[owner] -= 1
+                self._condition.notify_all()
+
+    def _is_turn_of(self, owner: str) -> bool:
+        fewest_held: int = min(self.held.get(waiting_owner, 0)
+                               for waiting_owner, waiters in self._waiting.items() if waiters > 0)
+        return self.held.get(owner, 0) <= fewest_held
+
+    async def _notify_waiters(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+
+class AdaptiveConcurrencyController(FairSlots):
+    """
+    AIMD (additive increase, multiplicative decrease) controller for the number of requests in flight.
+
+    The limit goes up by increase_step after every window in which throughput kept climbing and
+    tail latency stayed flat.  It is multiplied by decrease_factor on a 429/5xx response, a timeout,
+    or when p95 latency rises above latency_tolerance times the best p95 seen so far.
+    Every decision is recorded so we can see where the limit settled for each server.
+    Slots under the limit are shared between owners as in FairSlots.
+    """
+
+    def __init__(self, name: str, initial_limit: int = 2, min_limit: int = 1, max_limit: int = 32,
+                 increase_step: int = 1, decrease_factor: float = 0.5, window_size: int = 20,
+                 minimum_throughput_gain: float = 0.05, latency_tolerance: float = 1.5,
+                 windows_before_probe: int = 5, history_file: Optional[str] = None) -> None:
+        """
+        :param name: name to record decisions under, usually the FHIR server host
+        :param initial_limit: limit to start with if there is no history for this name
+        :param min_limit: never go below this many requests in flight
+        :param max_limit: never go above this many requests in flight
+        :param increase_step: requests to add when throughput is still climbing
+        :param decrease_factor: multiply the limit by this when backing off
+        :param window_size: number of responses to collect before deciding
+        :param minimum_throughput_gain: relative throughput gain needed to keep increasing
+        :param latency_tolerance: back off when p95 latency exceeds the best p95 by this factor
+        :param windows_before_probe: after this many flat windows try one more request in flight anyway
+        :param history_file: json file where the settled limit and decisions are kept per name
+        """
+        assert 1 <= min_limit <= max_limit
+        super().__init__(limit=min_limit)
+        self.name: str = name
+        self.min_limit: int = min_limit
+        self.max_limit: int = max_limit
+        self.increase_step: int = increase_step
+        self.decrease_factor: float = decrease_factor
+        self.window_size: int = window_size
+        self.minimum_throughput_gain: float = minimum_throughput_gain
+        self.latency_tolerance: float = latency_tolerance
+        self.windows_before_probe: int = windows_before_probe
+        self.history_file: Optional[str] = history_file
+        self.decisions: List[Dict[str, Any]] = []
+
+        self._window_start: float = time.time()
+        self._window_latencies: List[float] = []
+        self._window_units: int = 0
+        self._window_had_error: bool = False
+        self._previous_throughput: float = 0.0
+        self._flat_windows: int = 0
+        self._best_p95_latency: Optional[float] = None
+        # wakes the waiters after the limit went up; kept so the task is not garbage collected before it runs
+        self._notify_task: Optional["asyncio.Future[None]"] = None
+
+        settled_limit: Optional[int] = self.load_settled_limit()
+        self.limit = max(min_limit, min(max_limit, settled_limit or initial_limit))
+        self._record("start", "from history" if settled_limit else "initial limit")
+
+    def record_response(self, latency: float, units: int) -> None:
+        """
+        Records a successful response
+
+        :param latency: seconds the response took
+        :param units: amount of work in the response (e.g. resources) used to measure throughput
+        """
+        self._window_latencies.append(latency)
+        self._window_units += units
+        if len(self._window_latencies) >= self.window_size:
+            self._evaluate_window()
+
+    def record_error(self, reason: str) -> None:
+        """
+        Records a 429/5xx response or a timeout and backs off.  Only backs off once per window so a burst
+        of errors from requests that were already in flight does not collapse the limit to the minimum.
+
+        :param reason: what went wrong, e.g. "status 503" or "timeout"
+        """
+        if self._window_had_error:
+            return
+        self._window_had_error = True
+        self._decrease(reason)
+        self._start_window()
+
+    def _evaluate_window(self) -> None:
+        elapsed: float = time.time() - self._window_start
+        throughput: float = self._window_units / elapsed if elapsed > 0 else 0.0
+        p95_latency: float = percentile(self._window_latencies, 95)
+        previous_throughput: float = self._previous_throughput
+        self._previous_throughput = throughput
+        if self._best_p95_latency is None or p95_latency < self._best_p95_latency:
+            self._best_p95_latency = p95_latency
+        if p95_latency > self._best_p95_latency * self.latency_tolerance:
+            self._decrease(f"p95 latency {p95_latency:.2f}s >"
+                           f" {self.latency_tolerance}x best {self._best_p95_latency:.2f}s",
+                           throughput=throughput, p95_latency=p95_latency)
+        elif throughput > previous_throughput * (1 + self.minimum_throughput_gain):
+            self._increase(f"throughput climbing {previous_throughput:.1f} -> {throughput:.1f}/s",
+                           throughput=throughput, p95_latency=p95_latency)
+        elif self._flat_windows + 1 >= self.windows_before_probe:
+            # the server may have more capacity now so probe with one more request in flight
+            self._increase(f"probing after {self._flat_windows + 1} flat windows",
+                           throughput=throughput, p95_latency=p95_latency)
+        else:
+            self._flat_windows += 1
+            self._record("hold", f"throughput flat {previous_throughput:.1f} -> {throughput:.1f}/s",
+                         throughput=throughput, p95_latency=p95_latency)
+        self._start_window()
+
+    def _start_window(self) -> None:
+        self._window_start = time.time()
+        self._window_latencies = []
+        self._window_units = 0
+        self._window_had_error = False
+
+    def _increase(self, reason: str, throughput: float, p95_latency: float) -> None:
+        new_limit: int = min(self.max_limit, self.limit + self.increase_step)
+        self._set_limit(new_limit, "increase" if new_limit != self.limit else "hold", reason,
+                        throughput=throughput, p95_latency=p95_latency)
+
+    def _decrease(self, reason: str, throughput: Optional[float] = None, p95_latency: Optional[float] = None) -> None:
+        new_limit: int = max(self.min_limit, int(self.limit * self.decrease_factor))
+        self._set_limit(new_limit, "decrease" if new_limit != self.limit else "hold", reason,
+                        throughput=throughput, p95_latency=p95_latency)
+        # throughput measured at the old limit is no longer a fair baseline
+        self._previous_throughput = 0.0
+
+    def _set_limit(self, new_limit: int, action: str, reason: str, throughput: Optional[float],
+                   p95_latency: Optional[float]) -> None:
+        self.limit = new_limit
+        self._flat_windows = 0
+        self._record(action, reason, throughput=throughput, p95_latency=p95_latency)
+        if self.in_flight < self.limit and (self._notify_task is None or self._notify_task.done()):
+            self._notify_task = asyncio.ensure_future(self._notify_waiters())
+
+    def _record(self, action: str, reason: str, throughput: Optional[float] = None,
+                p95_latency: Optional[float] = None) -> None:
+        self.decisions.append(
+            {
+                "time": datetime.now().isoformat(),
+                "action": action,
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "throughput": throughput,
+                "p95_latency": p95_latency,
+                "reason": reason
+            }
+        )
+
+    def load_settled_limit(self) -> Optional[int]:
+        """
+        Returns the limit this name settled on in the previous run, if recorded
+        """
+        if not self.history_file or not os.path.exists(self.history_file):
+            return None
+        with open(self.history_file, mode='rb') as file:
+            history: Dict[str, Any] = json_codec.loads(file.read())
+        return history.get(self.name, {}).get("settled_limit")
+
+    def save_history(self) -> None:
+        """
+        Stores the settled limit and this run's decisions under name in history_file
+        """
+        if not self.history_file:
+            return
+        history: Dict[str, Any] = {}
+        if os.path.exists(self.history_file):
+            with open(self.history_file, mode='rb') as file:
+                history = json_codec.loads(file.read())
+        history[self.name] = {
+            "settled_limit": self.limit,
+            "updated": datetime.now().isoformat(),
+            "decisions": self.decisions
+        }
+        with open(self.history_file, mode='wb') as file:
+            file.write(json_codec.dumps(history, indent=True))
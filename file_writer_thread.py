@@ -0,0 +1,214 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, BinaryIO, Callable, Deque, List, Optional, Tuple, Union
+
+# turns the bytes queued by the writers into the bytes to write, e.g. a compressor
+Encoder = Callable[[bytes], bytes]
+# returns the bytes that end what the encoder has started, e.g. the end of a gzip member
+Finisher = Callable[[], bytes]
+
+
+class FileWriterThread:
+    """
+    Writes to one file from a dedicated thread, so the event loop never waits on the disk.
+
+    write() queues the bytes and returns at once.  The thread takes everything that has been queued, joins it
+    into one block of up to max_write_bytes and writes that with a single write and flush, so many small
+    batches become a few large writes.  When less than max_write_bytes is queued, the thread waits up to
+    flush_interval_seconds for more before writing what it has.
+
+    At most max_queued_bytes wait for the thread.  Beyond that write() waits until the thread has caught up,
+    which pushes back on the network readers that call it instead of buffering a slow disk in memory.
+    """
+
+    def __init__(self, file: BinaryIO, offset: int = 0, max_queued_bytes: int = 32 * 1024 * 1024,
+                 max_write_bytes: int = 4 * 1024 * 1024, flush_interval_seconds: float = 1.0,
+                 encode: Optional[Encoder] = None, finish: Optional[Finisher] = None, digest: Optional[Any] = None,
+                 name: str = "file-writer") -> None:
+        """
+        :param file: file opened in binary mode; only the thread touches it until close()
+        :param offset: size of the file when it was opened, e.g. when appending
+        :param max_queued_bytes: bytes queued for the thread before write() waits
+        :param max_write_bytes: largest block joined into one write
+        :param flush_interval_seconds: longest time queued bytes wait for more before they are written
+        :param encode: applied to each joined block before it is written, e.g. compression
+        :param finish: called by sync() and close() to end what encode has started
+        :param digest: hashlib object updated with every byte written to the file, e.g. hashlib.sha256()
+        :param name: name of the thread
+        """
+        self.file: BinaryIO = file
+        self.max_queued_bytes: int = max_queued_bytes
+        self.max_write_bytes: int = max_write_bytes
+        self.flush_interval_seconds: float = flush_interval_seconds
+        self.encode: Optional[Encoder] = encode
+        self.finish: Optional[Finisher] = finish
+        self.digest: Optional[Any] = digest
+        # whether encode has been given data since finish was last called
+        self._unfinished: bool = False
+        # position in the file after the last write of the thread
+        self.offset: int = offset
+        self.bytes_queued: int = 0
+        self.write_count: int = 0
+        # time write() spent waiting for the thread to catch up
+        self.backpressure_seconds: float = 0.0
+        # bytes queued and not yet written; only changed on the event loop
+        self._pending_bytes: int = 0
+        self._drained: asyncio.Event = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        # bytes to write, or a future to resolve with the offset once everything before it is durable
+        self._queue: Deque[Any] = deque()
+        self._condition: threading.Condition = threading.Condition()
+        self._closing: bool = False
+        self._error: Optional[BaseException] = None
+        self._thread: threading.Thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    async def write(self, data: Union[bytes, bytearray]) -> None:
+        """
+        Queues data for the thread; waits first if max_queued_bytes are already queued.
+        A bytearray is copied, so the caller may reuse it.
+        """
+        self._raise_error()
+        if not data:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self._pending_bytes >= self.max_queued_bytes:
+            wait_start: float = time.perf_counter()
+            while self._pending_bytes >= self.max_queued_bytes and self._error is None:
+                self._drained.clear()
+                await self._drained.wait()
+            self.backpressure_seconds += time.perf_counter() - wait_start
+            self._raise_error()
+        self._pending_bytes += len(data)
+        self.bytes_queued += len(data)
+        with self._condition:
+            self._queue.append(data)
+            self._condition.notify()
+
+    async def sync(self) -> int:
+        """
+        Writes everything queued so far, ends the encoder's member, flushes and fsyncs
+
+        :return: offset up to which the file is durable
+        """
+        return await self._request(fsync=True)
+
+    async def close(self) -> int:
+        """
+        Writes everything queued so far, ends the encoder's member and stops the thread; the caller closes the file
+
+        :return: size of the file
+        """
+        try:
+            offset: int = await self._request(fsync=False)
+        finally:
+            with self._condition:
+                self._closing = True
+                self._condition.notify()
+            await self._loop.run_in_executor(None, self._thread.join)
+        return offset
+
+    async def _request(self, fsync: bool) -> int:
+        self._raise_error()
+        done: "asyncio.Future[int]" = self._loop.create_future()
+        with self._condition:
+            self._queue.append((done, fsync))
+            self._condition.notify()
+        return await done
+
+    def _run(self) -> None:
+        # the block being collected, and when its first piece was taken
+        block: List[bytes] = []
+        block_size: int = 0
+        block_started: float = 0.0
+        while True:
+            request: Optional[Tuple["asyncio.Future[int]", bool]] = None
+            with self._condition:
+                # wait until something is queued, the block has waited flush_interval_seconds, or close()
+                while not self._queue and not self._closing:
+                    if not block:
+                        self._condition.wait()
+                        continue
+                    remaining_seconds: float = block_started + self.flush_interval_seconds - time.monotonic()
+                    if remaining_seconds <= 0:
+                        break
+                    self._condition.wait(timeout=remaining_seconds)
+                if self._closing and not self._queue and not block:
+                    return
+                while self._queue and block_size < self.max_write_bytes:
+                    if isinstance(self._queue[0], tuple):
+                        request = self._queue.popleft()
+                        break
+                    piece: bytes = self._queue.popleft()
+                    if not block:
+                        block_started = time.monotonic()
+                    block.append(piece)
+                    block_size += len(piece)
+            if block and (request is not None or self._closing or block_size >= self.max_write_bytes
+                          or time.monotonic() - block_started >= self.flush_interval_seconds):
+                self._write_block(block, block_size)
+                block, block_size = [], 0
+            if request is not None:
+                self._complete_request(*request)
+
+    def _write_block(self, block: List[bytes], block_size: int) -> None:
+        try:
+            if self._error is None:
+                data: bytes = b"".join(block)
+                if self.encode is not None:
+                    data = self.encode(data)
+                    self._unfinished = True
+                self._write_and_flush(data)
+        except BaseException as e:
+            self._set_error(e)
+        self._loop.call_soon_threadsafe(self._on_written, block_size)
+
+    def _complete_request(self, done: "asyncio.Future[int]", fsync: bool) -> None:
+        try:
+            if self._error is None:
+                # finishing without new data would write e.g. an empty gzip member on every sync
+                if self.finish is not None and self._unfinished:
+                    self._write_and_flush(self.finish())
+                    self._unfinished = False
+                if fsync:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+        except BaseException as e:
+            self._set_error(e)
+        self._loop.call_soon_threadsafe(self._resolve, done, self.offset)
+
+    def _write_and_flush(self, data: bytes) -> None:
+        if data:
+            self.file.write(data)
+            self.file.flush()
+            if self.digest is not None:
+                self.digest.update(data)
+            self.offset += len(data)
+            self.write_count += 1
+
+    def _set_error(self, error: BaseException) -> None:
+        if self._error is None:
+            self._error = error
+
+    def _on_written(self, block_size: int) -> None:
+        # runs on the event loop
+        self._pending_bytes -= block_size
+        if self._pending_bytes < self.max_queued_bytes or self._error is not None:
+            self._drained.set()
+
+    def _resolve(self, done: "asyncio.Future[int]", offset: int) -> None:
+        # runs on the event loop
+        if done.done():
+            return
+        if self._error is not None:
+            done.set_exception(self._error)
+        else:
+            done.set_result(offset)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,139 @@
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+
+class HttpSessionPool:
+    """
+    One keep-alive connection pool shared by every aiohttp session in the process, so auth and data requests
+    reuse connections instead of paying DNS, TCP and TLS setup for each new ClientSession.
+    Sessions created by create_session() do not own the pool, so closing them keeps the connections open.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 0, ttl_dns_cache: Optional[int] = 300,
+                 keepalive_timeout: float = 60.0, verify_ssl: bool = True,
+                 trace_configs: Optional[List[TraceConfig]] = None) -> None:
+        """
+        :param limit: maximum number of open connections in the pool (0 for no limit)
+        :param limit_per_host: maximum number of open connections to one host (0 for no limit)
+        :param ttl_dns_cache: seconds to cache DNS lookups for (None to cache forever)
+        :param keepalive_timeout: seconds to keep an idle connection open for reuse
+        :param verify_ssl: whether to verify certificates.  The scripts call with ssl=False per request anyway.
+        :param trace_configs: trace configs added to every session on the pool, e.g. a RequestTracer
+        """
+        self.limit: int = limit
+        self.limit_per_host: int = limit_per_host
+        self.ttl_dns_cache: Optional[int] = ttl_dns_cache
+        self.keepalive_timeout: float = keepalive_timeout
+        self.verify_ssl: bool = verify_ssl
+        self.trace_configs: List[TraceConfig] = trace_configs or []
+        self.requests: int = 0
+        self.connections_created: int = 0
+        self.connections_reused: int = 0
+        self.dns_cache_hits: int = 0
+        self.dns_cache_misses: int = 0
+        self._connector: Optional[TCPConnector] = None
+        self._session: Optional[ClientSession] = None
+        self.trace_config: TraceConfig = TraceConfig()
+        self.trace_config.on_request_start.append(self._on_request_start)
+        self.trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        self.trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        self.trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        self.trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+
+    @property
+    def connector(self) -> TCPConnector:
+        # the connector has to be created inside the running event loop
+        if self._connector is None or self._connector.closed:
+            self._connector = TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout,
+                ssl=None if self.verify_ssl else False
+            )
+        return self._connector
+
+    @property
+    def session(self) -> ClientSession:
+        """
+        A default session on the pool for simple calls such as auth
+        """
+        if self._session is None or self._session.closed:
+            self._session = self.create_session()
+        return self._session
+
+    def create_session(self, timeout: Optional[ClientTimeout] = None,
+                       trace_configs: Optional[List[TraceConfig]] = None,
+                       headers: Optional[Dict[str, str]] = None, auto_decompress: bool = True) -> ClientSession:
+        """
+        Creates a session that uses the shared connection pool
+
+        :param timeout: timeout for requests on this session
+        :param trace_configs: additional trace configs, e.g. for logging
+        :param headers: default headers for requests on this session
+        :param auto_decompress: let aiohttp decode compressed bodies.  Turn off to decode them yourself,
+                                e.g. with a StreamingDecompressor to count the bytes on the wire.
+        """
+        return ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            timeout=timeout or ClientTimeout(total=0),
+            trace_configs=[self.trace_config] + self.trace_configs + (trace_configs or []),
+            headers=headers,
+            auto_decompress=auto_decompress
+        )
+
+    @property
+    def reuse_ratio(self) -> float:
+        """
+        Fraction of connections that were reused from the pool rather than newly opened
+        """
+        total_connections: int = self.connections_created + self.connections_reused
+        return self.connections_reused / total_connections if total_connections > 0 else 0.0
+
+    def report(self) -> str:
+        return (f"Connection pool: requests={self.requests:,} new connections={self.connections_created:,}"
+                f" reused={self.connections_reused:,} reuse ratio={self.reuse_ratio:.0%}"
+                f" DNS cache hits={self.dns_cache_hits:,} misses={self.dns_cache_misses:,}")
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+
+    async def __aenter__(self) -> "HttpSessionPool":
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    # noinspection PyUnusedLocal
+    async def _on_request_start(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                params: Any) -> None:
+        self.requests += 1
+
+    # noinspection PyUnusedLocal
+    async def _on_connection_create_end(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                        params: Any) -> None:
+        self.connections_created += 1
+
+    # noinspection PyUnusedLocal
+    async def _on_connection_reuseconn(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                       params: Any) -> None:
+        self.connections_reused += 1
+
+    # noinspection PyUnusedLocal
+    async def _on_dns_cache_hit(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                params: Any) -> None:
+        self.dns_cache_hits += 1
+
+    # noinspection PyUnusedLocal
+    async def _on_dns_cache_miss(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                 params: Any) -> None:
+        self.dns_cache_misses += 1
@@ -0,0 +1,134 @@
+import hashlib
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import json_codec
+
+
+def hash_resource(resource: Dict[str, Any]) -> bytes:
+    """
+    Returns a 16 byte hash of the resource that does not depend on the order of its keys
+    """
+    return hashlib.blake2b(json_codec.dumps(resource, sort_keys=True), digest_size=16).digest()
+
+
+class IdIndex:
+    """
+    SQLite file that remembers the id, meta.lastUpdated and a content hash of every resource we have downloaded,
+    so the next run can ask the server for just id and meta and then download only the resources that are new
+    or whose lastUpdated changed.
+
+    One row per resource type and id, in a WITHOUT ROWID table keyed on both, so the index is about the size of
+    the ids themselves and a lookup is a single b-tree search.  Writes are batched per page and committed
+    by commit(), so a crash loses at most the rows since the last commit, which are then just downloaded again.
+    """
+
+    # SQLite before 3.32 allows at most 999 parameters in one statement
+    max_ids_per_query: int = 500
+
+    def __init__(self, file_path: str) -> None:
+        """
+        :param file_path: path of the SQLite file; created if it does not exist
+        """
+        self.file_path: str = file_path
+        self._connection: Optional[sqlite3.Connection] = None
+        self.rows_written: int = 0
+        # resources whose content hash differed from the one in the index when they were written
+        self.content_changed: int = 0
+
+    def open(self) -> "IdIndex":
+        self._connection = sqlite3.connect(self.file_path)
+        # WAL lets commits append instead of rewriting pages; NORMAL only fsyncs at checkpoints,
+        # which is fine since a lost commit only means downloading those resources again
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS resource_versions ("
+            " resource_type TEXT NOT NULL,"
+            " id TEXT NOT NULL,"
+            " last_updated TEXT,"
+            " content_hash BLOB,"
+            " PRIMARY KEY (resource_type, id)"
+            ") WITHOUT ROWID"
+        )
+        return self
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        assert self._connection is not None, "Call open() first"
+        return self._connection
+
+    def count(self, resource_type: str) -> int:
+        row: Tuple[int] = self.connection.execute(
+            "SELECT COUNT(*) FROM resource_versions WHERE resource_type = ?", (resource_type,)
+        ).fetchone()
+        return row[0]
+
+    def get_versions(self, resource_type: str, ids: List[str]) -> Dict[str, Tuple[Optional[str], Optional[bytes]]]:
+        """
+        Returns id -> (last_updated, content_hash) for the ids that are in the index
+        """
+        versions: Dict[str, Tuple[Optional[str], Optional[bytes]]] = {}
+        for start in range(0, len(ids), self.max_ids_per_query):
+            batch: List[str] = ids[start:start + self.max_ids_per_query]
+            rows: Iterable[Tuple[str, Optional[str], Optional[bytes]]] = self.connection.execute(
+                f"SELECT id, last_updated, content_hash FROM resource_versions"
+                f" WHERE resource_type = ? AND id IN ({','.join('?' * len(batch))})",
+                [resource_type, *batch]
+            )
+            for id_, last_updated, content_hash in rows:
+                versions[id_] = (last_updated, content_hash)
+        return versions
+
+    def find_changed(self, resource_type: str, resources: List[Dict[str, Any]]) -> List[str]:
+        """
+        Returns the ids of the resources that are not in the index or have a different meta.lastUpdated
+
+        :param resources: resources with at least id and meta.lastUpdated, e.g. fetched with _elements=id,meta.
+                          A resource without meta.lastUpdated always counts as changed.
+        """
+        versions: Dict[str, Tuple[Optional[str], Optional[bytes]]] = self.get_versions(
+            resource_type, [resource["id"] for resource in resources]
+        )
+        changed_ids: List[str] = []
+        for resource in resources:
+            last_updated: Optional[str] = (resource.get("meta") or {}).get("lastUpdated")
+            version: Optional[Tuple[Optional[str], Optional[bytes]]] = versions.get(resource["id"])
+            if last_updated is None or version is None or version[0] != last_updated:
+                changed_ids.append(resource["id"])
+        return changed_ids
+
+    def record(self, resource_type: str, resources: List[Dict[str, Any]]) -> None:
+        """
+        Adds or updates the index entries of resources that have been written to the output
+        """
+        if not resources:
+            return
+        rows: List[Tuple[str, str, Optional[str], bytes]] = [
+            (resource_type, resource["id"], (resource.get("meta") or {}).get("lastUpdated"), hash_resource(resource))
+            for resource in resources
+        ]
+        inserted: int = self.connection.executemany(
+            "INSERT OR IGNORE INTO resource_versions (resource_type, id, last_updated, content_hash)"
+            " VALUES (?, ?, ?, ?)",
+            rows
+        ).rowcount
+        if inserted < len(rows):
+            # a row inserted above already has this hash, so only resources whose content changed since they were
+            # indexed are updated; the hash covers meta.lastUpdated so a new lastUpdated is always stored
+            self.content_changed += self.connection.executemany(
+                "UPDATE resource_versions SET last_updated = ?, content_hash = ?"
+                " WHERE resource_type = ? AND id = ? AND content_hash IS NOT ?",
+                [(last_updated, content_hash, resource_type_, id_, content_hash)
+                 for resource_type_, id_, last_updated, content_hash in rows]
+            ).rowcount
+        self.rows_written += len(rows)
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,86 @@
+import json
+import os
+from typing import Any, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JsonInput = Union[str, bytes, bytearray, memoryview]
+
+# backends in order of preference; orjson is used when it is installed
+BACKENDS: List[str] = ["orjson", "json"]
+# annotated before set_backend() declares it global; Python 3.7 rejects the annotation after that
+backend: str = "json"
+
+
+def _default_backend() -> str:
+    # JSON_BACKEND=json forces the standard library even when orjson is installed, e.g. to compare the two
+    return os.environ.get("JSON_BACKEND") or ("orjson" if orjson is not None else "json")
+
+
+def set_backend(name: Optional[str]) -> str:
+    """
+    Switches every later loads()/dumps() to the named backend
+
+    :param name: "orjson" or "json", or None for the default (orjson if installed, unless JSON_BACKEND says otherwise)
+    :return: the backend now in use
+    """
+    global backend
+    name = name or _default_backend()
+    assert name in BACKENDS, f"Unknown JSON backend {name}, expected one of {BACKENDS}"
+    assert name != "orjson" or orjson is not None, "pip install orjson to use the orjson backend"
+    backend = name
+    return backend
+
+
+set_backend(None)
+
+
+def loads(data: JsonInput) -> Any:
+    """
+    Parses JSON from str or bytes, so response bodies can be parsed without decoding them to str first
+    """
+    if backend == "orjson":
+        return orjson.loads(data)
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def dumps(obj: Any, sort_keys: bool = False, indent: bool = False) -> bytes:
+    """
+    Serializes to UTF-8 JSON bytes.
+
+    Both backends write the same compact form (no spaces, non-ASCII characters as UTF-8 instead of \\u escapes),
+    so files and hashes do not change when orjson is installed or removed.
+
+    :param sort_keys: sort the keys of every object, e.g. for hashing
+    :param indent: indent by two spaces, for files meant to be read by people
+    """
+    if backend == "orjson":
+        option: int = (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(
+        obj, sort_keys=sort_keys, indent=2 if indent else None, separators=(",", ": ") if indent else (",", ":"),
+        ensure_ascii=False
+    ).encode("utf-8")
+
+
+def dumps_ndjson(resources: List[Any]) -> bytes:
+    """
+    Serializes the resources as NDJSON: one compact JSON document per line, each line ending in a newline
+    """
+    if backend == "orjson":
+        return b"".join([orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE) for resource in resources])
+    return "".join(
+        [json.dumps(resource, separators=(",", ":"), ensure_ascii=False) + "\n" for resource in resources]
+    ).encode("utf-8")
+
+
+def parse_ndjson_lines(data: JsonInput) -> List[Any]:
+    """
+    Parses complete NDJSON lines, skipping blank lines
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return [loads(line) for line in bytes(data).splitlines() if line.strip()]
@@ -1,25 +1,47 @@
+import argparse
 import asyncio
-import json
+import copy
 import logging
 import os
+import random
+import sys
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 from logging import Logger
-from typing import Any, List, Dict, Optional, Union
+from typing import Any, Callable, List, Dict, Optional, Set, Tuple, Union
 
-import aiofiles
-from helix_fhir_client_sdk.fhir_client import FhirClient
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TraceConfig
+from helix_fhir_client_sdk.fhir_client import FhirClient, HandleBatchFunction, HandleErrorFunction, \
+    HandleStreamingChunkFunction
 
 from helix_fhir_client_sdk.loggers.fhir_logger import FhirLogger
+from helix_fhir_client_sdk.responses.fhir_get_response import FhirGetResponse
 
 from dotenv import load_dotenv
 
+import json_codec
+from checkpoint_journal import CheckpointJournal, CheckpointState, truncate_to_committed_offset
+from concurrency_controller import AdaptiveConcurrencyController, FairSlots
+from http_session_pool import HttpSessionPool
+from id_index import IdIndex
+from ndjson_sink import NdjsonFileSink, create_ndjson_sink
+from parquet_sink import AUDIT_EVENT_PROJECTION, ParquetFileSink
+from progress_reporter import ProgressCounter, ProgressReporter
+from rolling_ndjson_sink import RollingNdjsonSink, truncate_shards_to_committed_offset
+from request_tracing import RequestTracer
+from sync_watermark import SyncWatermark
+from token_provider import TokenProvider
+
 
 class MyLogger(FhirLogger):
-    def __init__(self):
+    def __init__(self, level: int = logging.DEBUG):
+        """
+        :param level: level of the FhirPerformance logger, e.g. logging.WARNING to drop the per chunk messages
+        """
         self._internal_logger: Logger = logging.getLogger("FhirPerformance")
-        self._internal_logger.setLevel(logging.DEBUG)
+        self._internal_logger.setLevel(level)
 
     def info(self, param: Any) -> None:
         """
@@ -35,208 +57,988 @@ class MyLogger(FhirLogger):
         self._internal_logger.error(param)
 
 
-class ResourceDownloader:
+class ReportingFhirClient(FhirClient):
+    """
+    FhirClient that reports the status code of every failed response, so the adaptive controller can back off,
+    and that can take its access token from a TokenProvider.
+
+    The client returns a 429 as if it were data (error is not set) and only logs the status of some other
+    failures, so the status is taken from the response instead of from the log.  Errors the client would only
+    log, e.g. of the pages of ids listed by get_resources_by_query_async() without dates, go to error_handler().
+    A 429 or 5xx is retried after the Retry-After of the response, or an exponential backoff, so an overloaded
+    server does not cost a page.
+    """
+
+    # statuses of an overloaded or briefly unavailable server, worth asking again
+    RETRY_STATUS_CODES: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
     def __init__(self) -> None:
+        super().__init__()
+        self._on_status_code: Optional[Callable[[int], None]] = None
+        self._token_provider: Optional[TokenProvider] = None
+        self._error_handler: Optional[HandleErrorFunction] = None
+        self._status_retries: int = 0
+        self._max_retry_seconds: float = 60.0
+        # url -> Retry-After header of its last response, read by _get_with_session_async()
+        self._retry_after: Dict[str, str] = {}
+        # seconds from sending the last request to its response headers: the latency of the server, without the
+        # transfer of the body or the wait of a retry
+        self.last_request_seconds: Optional[float] = None
+
+    def on_status_code(self, fn: Callable[[int], None]) -> "ReportingFhirClient":
+        """
+        :param fn: called with the status code of every response that is not 200 or 404
+        """
+        self._on_status_code = fn
+        return self
+
+    def retry_on_status(self, retries: int, max_retry_seconds: float) -> "ReportingFhirClient":
+        """
+        :param retries: how many times a request that got one of RETRY_STATUS_CODES is sent again
+        :param max_retry_seconds: longest wait before a retry, whatever Retry-After asks for
+        """
+        self._status_retries = retries
+        self._max_retry_seconds = max_retry_seconds
+        return self
+
+    def error_handler(self, fn: HandleErrorFunction) -> "ReportingFhirClient":
+        """
+        :param fn: called for the errors that the client passes to handle_error() instead of fn_handle_error
+        """
+        self._error_handler = fn
+        return self
+
+    async def handle_error(self, error: str, response: str, page_number: Optional[int]) -> bool:
+        if self._error_handler:
+            return await self._error_handler(error, response, page_number)
+        return await super().handle_error(error, response, page_number)
+
+    def token_provider(self, provider: TokenProvider) -> "ReportingFhirClient":
+        """
+        :param provider: asked for the access token before every request, so a client picks up the token the
+                         provider refreshed in the background instead of keeping the one it was created with
+        """
+        self._token_provider = provider
+        return self
+
+    async def get_access_token_async(self) -> Optional[str]:
+        if self._token_provider:
+            # cheap while the cached token is valid; skips the discovery and token round trips of the client
+            self._access_token = await self._token_provider.get_access_token()
+        return await super().get_access_token_async()
+
+    async def _send_fhir_request_async(self, http: ClientSession, full_url: str, headers: Dict[str, str],
+                                       payload: Dict[str, Any]) -> ClientResponse:
+        start: float = time.time()
+        response: ClientResponse = await super()._send_fhir_request_async(http, full_url, headers, payload)
+        self.last_request_seconds = time.time() - start
+        if response.status in self.RETRY_STATUS_CODES and "Retry-After" in response.headers:
+            self._retry_after[full_url] = response.headers["Retry-After"]
+        return response
+
+    async def _get_with_session_async(self, *args: Any, **kwargs: Any) -> FhirGetResponse:
+        retry: int = 0
+        while True:
+            result: FhirGetResponse = await super()._get_with_session_async(*args, **kwargs)
+            retry_after: Optional[str] = self._retry_after.pop(result.url, None)
+            if result.status in (200, 404):
+                return result
+            if self._on_status_code and result.status:
+                self._on_status_code(result.status)
+            if result.status not in self.RETRY_STATUS_CODES or retry >= self._status_retries:
+                break
+            # a failed response streams nothing, so sending the request again cannot duplicate lines
+            retry_seconds: float = self.get_retry_seconds(retry_after, retry)
+            retry += 1
+            logging.getLogger("FhirPerformance").warning(
+                f"Status {result.status} for a {self._resource} request, retry {retry} of {self._status_retries}"
+                f" in {retry_seconds:.1f}s"
+            )
+            await asyncio.sleep(retry_seconds)
+        if not result.error:
+            # otherwise the body of the 429 would be handed to fn_handle_batch as resources
+            result.error = f"Fhir Receive failed [{result.status}]: {result.url} {result.responses}"
+        return result
+
+    def get_retry_seconds(self, retry_after: Optional[str], retry: int) -> float:
+        """
+        :param retry_after: Retry-After header of the response, in seconds or as an HTTP date
+        :param retry: number of retries of the request so far
+        :return: how long to wait before sending the request again
+        """
+        if retry_after:
+            try:
+                return min(self._max_retry_seconds, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+            retry_at: Optional[datetime]
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                retry_at = None
+            if retry_at is not None:
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=timezone.utc)
+                seconds: float = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                return min(self._max_retry_seconds, max(0.0, seconds))
+        # without Retry-After: 1s, 2s, 4s, ... with jitter so the slices that failed together do not retry together
+        return min(self._max_retry_seconds, 2 ** retry) * random.uniform(0.5, 1.0)
+
+
+class PooledFhirClient(ReportingFhirClient):
+    """
+    FhirClient whose http sessions all share one keep-alive connection pool
+    instead of opening new connections for every session
+    """
+
+    def __init__(self, pool: HttpSessionPool) -> None:
+        super().__init__()
+        self._pool: HttpSessionPool = pool
+
+    def create_http_session(self) -> ClientSession:
+        # same settings as FhirClient.create_http_session() but on the shared pool
+        trace_config = TraceConfig()
+        if self._log_level == "DEBUG":
+            trace_config.on_request_end.append(FhirClient.on_request_end)
+        return self._pool.create_session(
+            timeout=ClientTimeout(total=60 * 60, sock_read=240),
+            trace_configs=[trace_config],
+            headers={"Connection": "keep-alive"}
+        )
+
+
+def split_date_range(start_date: datetime, end_date: datetime,
+                     number_of_slices: int) -> List[Tuple[datetime, datetime]]:
+    """
+    Splits start_date..end_date into contiguous, non-overlapping time slices of (almost) equal length
+
+    :param start_date: start of the window (inclusive)
+    :param end_date: end of the window (exclusive)
+    :param number_of_slices: number of slices to create
+    :return: list of (slice_start, slice_end) tuples covering the whole window
+    """
+    assert end_date > start_date
+    assert number_of_slices > 0
+    slice_length: timedelta = (end_date - start_date) / number_of_slices
+    slices: List[Tuple[datetime, datetime]] = []
+    slice_start: datetime = start_date
+    for slice_index in range(number_of_slices):
+        # the last slice always ends exactly at end_date so rounding never leaves a gap
+        slice_end: datetime = end_date if slice_index == number_of_slices - 1 else slice_start + slice_length
+        slices.append((slice_start, slice_end))
+        slice_start = slice_end
+    return slices
+
+
+def file_name_for_resource_type(file_name: str, resource_type: str) -> str:
+    """
+    Inserts the resource type before the extensions of file_name, e.g. output.ndjson.gz -> output_Patient.ndjson.gz
+    """
+    directory, base_name = os.path.split(file_name)
+    stem, dot, extensions = base_name.partition(".")
+    return os.path.join(directory, f"{stem}_{resource_type}{dot}{extensions}")
+
+
+def server_url_for(fhir_server: str) -> str:
+    """
+    Returns the FHIR base url of a server given as a host name (https) or as a url, e.g. http://localhost:8080
+    """
+    fhir_server_base_url = fhir_server if "://" in fhir_server else f"https://{fhir_server}"
+    return f"{fhir_server_base_url}/4_0_0"
+
+
+class ResourceDownloader:
+    def __init__(self, resume: bool = False, quiet: bool = False, differential: bool = False,
+                 incremental: bool = False, resource_types: Optional[List[str]] = None) -> None:
+        """
+        :param resume: continue the export recorded in checkpoint_file instead of starting over
+        :param quiet: print nothing but errors
+        :param differential: download only the resources that are new or changed since they were last downloaded
+        :param incremental: download from the watermark of the last successful run up to now
+        :param resource_types: resource types to export at the same time, each into its own files (default AuditEvent)
+        """
         # fhir_server = "fhir.icanbwell.com"
         fhir_server = "fhir-next.icanbwell.com"
         # fhir_server = "fhir-bulk.icanbwell.com"
         # fhir_server = "fhir-next.prod-ue1.icanbwell.com"
-        self.server_url = f"https://{fhir_server}/4_0_0"
+        # fhir_server = "http://localhost:8080"  # mock_fhir_server.py
+        self.fhir_server = fhir_server
+        self.server_url = server_url_for(fhir_server)
         assert os.environ.get("FHIR_CLIENT_ID"), "FHIR_CLIENT_ID environment variable must be set"
         assert os.environ.get("FHIR_CLIENT_SECRET"), "FHIR_CLIENT_SECRET environment variable must be set"
         self.auth_client_id = os.environ.get("FHIR_CLIENT_ID")
         self.auth_client_secret = os.environ.get("FHIR_CLIENT_SECRET")
-        self.resource = "AuditEvent"
+        # with more than one resource type, each type is downloaded by its own downloader (see for_resource_type())
+        # into files named after the type, e.g. output_Patient.ndjson, all sharing one token, connection pool
+        # and concurrent_requests budget
+        self.resource_types: List[str] = resource_types or ["AuditEvent"]
+        self.resource = self.resource_types[0]
         assert os.environ.get("FHIR_CLIENT_TAG"), "FHIR_CLIENT_TAG environment variable must be set"
         self.client = os.environ.get("FHIR_CLIENT_TAG")
-        self.auth_scopes = [f"user/{self.resource}.read", f"access/{self.client}.*"]
+        # one token covers every resource type
+        self.auth_scopes = [f"user/{resource_type}.read" for resource_type in self.resource_types] \
+            + [f"access/{self.client}.*"]
         self.page_size_for_retrieving_ids = 1000
         # greater_than = "2022-02-22"
         # less_than = "2022-02-24"
         self.start_date = datetime.strptime("2022-02-22", "%Y-%m-%d")
         self.end_date = datetime.strptime("2022-02-24", "%Y-%m-%d")
         assert self.end_date > self.start_date
+        # total number of parallel connections across all time slices
+        # (the upper bound for the adaptive controller when use_adaptive_concurrency is set)
         self.concurrent_requests = 10
+        # when > 1, start_date..end_date is cut into this many time slices which are downloaded in parallel
+        self.number_of_slices = 48
+        # let an AIMD controller decide how many slices are in flight, one connection each
+        self.use_adaptive_concurrency: bool = True
+        # where the controller keeps the concurrency it settled on for each server
+        self.concurrency_history_file = "concurrency_history.json"
+        self.concurrency_controller: Optional[AdaptiveConcurrencyController] = None
+        # slots for the slices when use_adaptive_concurrency is off
+        self.slice_slots: Optional[FairSlots] = None
+        self.token_provider: Optional[TokenProvider] = None
+        # a request that gets a 429 or 5xx is sent again up to status_retries times, after the Retry-After of the
+        # response or an exponential backoff, but never waiting longer than max_retry_seconds
+        self.status_retries = 5
+        self.max_retry_seconds = 60.0
+        # keep-alive connection pool shared by auth and all clients; must allow at least concurrent_requests
+        self.connection_pool_limit = 100
+        self.http_pool: Optional[HttpSessionPool] = None
+        # dns, connect and first byte histograms of every request on the pool
+        self.request_tracer: RequestTracer = RequestTracer()
         self.page_size_for_retrieving_resources = 100
         self.use_data_streaming: bool = True
+        # write the NDJSON bytes received from the server as they are instead of re-serializing parsed resources
+        self.use_raw_bytes: bool = True
         self.use_atlas: bool = True
+        # end the file names in .gz or .zst to compress the output on a worker thread (.zst needs zstandard)
+        self.output_file = "output.ndjson"
+        self.ids_output_file = "output_ids.json"
+        self.output_compression_level: Optional[int] = None
+        # the output files are written by one thread each in large blocks; data waits in memory at most
+        # output_flush_interval_in_seconds for more, and downloads pause while output_max_queued_mb wait for the disk
+        self.output_flush_interval_in_seconds = 1.0
+        self.output_max_queued_mb = 32
+        # set either to write the output as shards of at most that many MB (before compression) or resources,
+        # e.g. output-00000.ndjson, output-00001.ndjson, ... listed with their counts, sizes and sha256 in
+        # output.manifest.json, so downstream jobs can read them in parallel
+        self.output_shard_max_mb: Optional[int] = None
+        self.output_shard_max_resources: Optional[int] = None
+        # set to also write the resources to a Parquet file (needs pyarrow), flattened into the columns of
+        # parquet_projection, in row groups of parquet_row_group_size resources which bound the memory it takes
+        self.parquet_output_file: Optional[str] = None  # e.g. "output.parquet"
+        self.parquet_projection: Dict[str, str] = AUDIT_EVENT_PROJECTION
+        self.parquet_row_group_size = 100_000
+        # journal completed batches and slices so a crashed export can be resumed (needs number_of_slices > 1)
+        self.use_checkpoint: bool = True
+        self.checkpoint_file = "output_checkpoint.jsonl"
+        # how often to fsync the output and commit the journal while slices are running
+        self.checkpoint_interval_in_seconds = 30
+        self.resume: bool = resume
+        self.checkpoint_journal: Optional[CheckpointJournal] = None
+        # remember id, meta.lastUpdated and a content hash of every resource written, for differential runs
+        self.use_id_index: bool = True
+        self.id_index_file = "output_id_index.sqlite"
+        self.id_index: Optional[IdIndex] = None
+        # a differential run lists just id and meta of start_date..end_date, looks them up in id_index_file and
+        # downloads the new and changed resources by id into differential_output_file
+        self.differential: bool = differential
+        self.differential_output_file = "output_changes.ndjson"
+        # an incremental run replaces start_date with the largest meta.lastUpdated of the last successful run minus
+        # incremental_overlap, and end_date with now.  Resources in the overlap that are in the id index with the
+        # same lastUpdated were exported by the last run and are skipped.
+        self.incremental: bool = incremental
+        self.watermark_file = "output_watermark.json"
+        self.incremental_overlap = timedelta(minutes=10)
+        self.sync_watermark: Optional[SyncWatermark] = None
+        # resources updated before this may have been exported by the last incremental run
+        self.overlap_end: Optional[datetime] = None
+        self.duplicates_skipped: int = 0
+        self.error_count: int = 0
+        # slices that ended with failed requests, so are missing resources
+        self.incomplete_slices: int = 0
+        # resource type -> resources, ids listed, MB, seconds and errors of its export
+        self.type_metrics: Dict[str, Dict[str, Any]] = {}
+        # progress is redrawn every progress_interval_in_seconds, not on every chunk
+        self.progress_interval_in_seconds = 0.5
+        self.progress: ProgressReporter = ProgressReporter(interval_in_seconds=self.progress_interval_in_seconds,
+                                                           quiet=quiet)
+        # the client logs every chunk it receives at INFO; in quiet mode only warnings and errors get through
+        self.log_level: int = logging.WARNING if quiet else logging.DEBUG
+        if quiet:
+            logging.getLogger("FhirClient").setLevel(logging.WARNING)
 
     async def load_data(self, name):
         start_job = time.time()
 
-        output_file_streaming_ids = await aiofiles.open('output_ids.json', mode='wb')
-        output_file_streaming_resources = await aiofiles.open('output_resources.json', mode='wb')
-        output_file = await aiofiles.open('output.json', mode='w')
+        self.http_pool = HttpSessionPool(limit=max(self.connection_pool_limit, self.concurrent_requests),
+                                         trace_configs=[self.request_tracer.trace_config])
+        # every client (one per slice) shares one token which is refreshed in the background before it expires
+        self.token_provider = TokenProvider(fhir_server_url=self.server_url, client_id=self.auth_client_id,
+                                            client_secret=self.auth_client_secret, auth_scopes=self.auth_scopes,
+                                            session=self.http_pool.session)
+        self.token_provider.start_background_refresh()
+        if self.use_id_index or self.differential or self.incremental:
+            self.id_index = IdIndex(self.id_index_file).open()
+        self.progress.start()
+        try:
+            if len(self.resource_types) == 1:
+                await self.load_resource_type()
+            else:
+                await self.load_resource_types()
+        finally:
+            await self.progress.stop()
+            await self.token_provider.close()
+            self.progress.log(self.request_tracer.report())
+            self.progress.log(self.http_pool.report())
+            await self.http_pool.close()
+            if self.concurrency_controller:
+                self.concurrency_controller.save_history()
+                self.progress.log(f"Concurrency for {self.fhir_server} settled at {self.concurrency_controller.limit}"
+                                  f" after {len(self.concurrency_controller.decisions)} decisions"
+                                  f" (see {self.concurrency_history_file})")
+            if self.id_index:
+                resource_counts: str = ", ".join(
+                    f"{self.id_index.count(resource_type):,} {resource_type}" for resource_type in self.resource_types
+                )
+                self.progress.log(f"Id index {self.id_index_file}: {self.id_index.rows_written:,} entries written,"
+                                  f" content changed for {self.id_index.content_changed:,},"
+                                  f" {resource_counts} in the index")
+                self.id_index.close()
 
-        resource_count_holder = {
-            "resource_count": 0,
-            "total_bytes": 0,
-            "startTime": 0.0
-        }
+        end_job = time.time()
+        if len(self.resource_types) > 1:
+            for resource_type, metrics in self.type_metrics.items():
+                self.progress.log(f"{resource_type}: {metrics['resources']:,} resources ({metrics['mb']:.0f} MB)"
+                                  f" in {timedelta(seconds=metrics['seconds'])}"
+                                  f" ({metrics['resources_per_second']:,.0f}/sec), {metrics['errors']} errors")
+            self.progress.log(f"====== Exported {len(self.resource_types)} resource types in"
+                              f" {timedelta(seconds=end_job - start_job)} =======")
 
-        id_count_holder = {
-            "resource_count": 0,
-            "total_bytes": 0,
-            "startTime": 0.0
-        }
+        # for id_ in list_of_ids:
+        #     print(id_)
 
-        streaming_id_count_holder = {
-            "resource_count": 0,
-            "total_bytes": 0,
-            "startTime": 0.0
-        }
+    async def load_resource_types(self) -> None:
+        """
+        Exports all resource_types at the same time.  The slices of every type wait for slots of one shared
+        budget of concurrent_requests, handed out fairly between the types, so small types are not stuck
+        behind the slices of a large one and the export takes about as long as the largest type.
+        """
+        if self.use_adaptive_concurrency:
+            self.concurrency_controller = AdaptiveConcurrencyController(
+                name=self.fhir_server, max_limit=self.concurrent_requests, history_file=self.concurrency_history_file
+            )
+        else:
+            self.slice_slots = FairSlots(self.concurrent_requests)
+        self.progress.log(f"Exporting {', '.join(self.resource_types)} with {self.concurrent_requests}"
+                          f" parallel connections between them")
+        downloaders: List[ResourceDownloader] = [
+            self.for_resource_type(resource_type) for resource_type in self.resource_types
+        ]
+        try:
+            await asyncio.gather(*[downloader.load_resource_type() for downloader in downloaders])
+        finally:
+            self.error_count = sum(downloader.error_count for downloader in downloaders)
+            self.incomplete_slices = sum(downloader.incomplete_slices for downloader in downloaders)
 
-        streaming_chunk_count_holder = {
-            "resource_count": 0,
-            "total_bytes": 0,
-            "startTime": 0.0
-        }
+    def for_resource_type(self, resource_type: str) -> "ResourceDownloader":
+        """
+        Returns a downloader for one type of a multi type export.  It has the same settings but its own output,
+        id and checkpoint files, and shares the connection pool, token, progress line, id index and concurrency
+        budget of this downloader.
+        """
+        downloader: ResourceDownloader = copy.copy(self)
+        downloader.resource = resource_type
+        downloader.output_file = file_name_for_resource_type(self.output_file, resource_type)
+        downloader.ids_output_file = file_name_for_resource_type(self.ids_output_file, resource_type)
+        downloader.checkpoint_file = file_name_for_resource_type(self.checkpoint_file, resource_type)
+        downloader.differential_output_file = file_name_for_resource_type(self.differential_output_file,
+                                                                          resource_type)
+        if self.parquet_output_file:
+            downloader.parquet_output_file = file_name_for_resource_type(self.parquet_output_file, resource_type)
+        # for the requests that are not limited by slots, e.g. the id batches of a differential run
+        downloader.concurrent_requests = max(1, self.concurrent_requests // len(self.resource_types))
+        downloader.checkpoint_journal = None
+        downloader.sync_watermark = None
+        downloader.overlap_end = None
+        downloader.duplicates_skipped = 0
+        downloader.error_count = 0
+        downloader.incomplete_slices = 0
+        return downloader
+
+    async def load_resource_type(self) -> None:
+        """
+        Exports self.resource into its output files
+        """
+        start_job = time.time()
+
+        if self.incremental:
+            self.start_from_watermark()
+        checkpoint_state: Optional[CheckpointState] = self.open_checkpoint_journal()
+        ids_sink = await create_ndjson_sink(self.ids_output_file, append=checkpoint_state is not None,
+                                            compression_level=self.output_compression_level,
+                                            flush_interval_seconds=self.output_flush_interval_in_seconds,
+                                            max_queued_bytes=self.output_max_queued_mb * 1024 * 1024).open()
+        # resources are streamed to disk as NDJSON so memory stays flat however large the export is
+        output_file: str = self.differential_output_file if self.differential else self.output_file
+        output_sink: Union[NdjsonFileSink, RollingNdjsonSink]
+        if self.rolls_output():
+            output_sink = await RollingNdjsonSink(
+                output_file, append=checkpoint_state is not None,
+                max_shard_bytes=self.output_shard_max_mb * 1024 * 1024 if self.output_shard_max_mb else None,
+                max_shard_records=self.output_shard_max_resources,
+                compression_level=self.output_compression_level,
+                flush_interval_seconds=self.output_flush_interval_in_seconds,
+                max_queued_bytes=self.output_max_queued_mb * 1024 * 1024
+            ).open()
+        else:
+            output_sink = await create_ndjson_sink(output_file, append=checkpoint_state is not None,
+                                                   compression_level=self.output_compression_level,
+                                                   flush_interval_seconds=self.output_flush_interval_in_seconds,
+                                                   max_queued_bytes=self.output_max_queued_mb * 1024 * 1024).open()
+
+        # the callbacks only bump these counters; the reporter renders them from a background task.
+        # With several resource types only the resources of each type fit on the progress line.
+        single_type: bool = len(self.resource_types) == 1
+        id_counter: ProgressCounter = self.progress.counter("Ids", visible=single_type)
+        streaming_id_counter: ProgressCounter = self.progress.counter("Streaming ids", show_bytes=True,
+                                                                      visible=single_type)
+        streaming_chunk_counter: ProgressCounter = self.progress.counter("Streaming chunks", show_bytes=True,
+                                                                         visible=single_type)
+        resource_counter: ProgressCounter = self.progress.counter("Resources" if single_type else self.resource,
+                                                                  expected_from=id_counter, show_bytes=True)
 
-        resources: List[Dict[str, Any]] = []
-
-        async def on_received_data(id_count_holder1: Dict[str, Union[int, float]],
-                                   resource_count_holder1: Dict[str, Union[int, float]], data: List[Dict[str, Any]],
-                                   batch_number: Optional[int]) -> bool:
-            # print(f"received batch: {batch_number}")
-            number_of_ids_to_expect: int = id_count_holder1["resource_count"]
-            if resource_count_holder1["startTime"] == 0.0:
-                print("\n")
-                resource_count_holder1["startTime"] = time.time()
-            for resource in data:
-                resources.append(resource)
-            chunk_end_time = time.time()
-            json_result: str = json.dumps(data)
-            resource_count_holder1["resource_count"] = resource_count_holder1["resource_count"] + len(data)
-            resource_count_holder1["total_bytes"] = resource_count_holder1["total_bytes"] + len(
-                json_result.encode("utf-8"))
-            time_difference = timedelta(seconds=chunk_end_time - resource_count_holder1["startTime"])
-            kilo_bytes_per_sec = resource_count_holder1["total_bytes"] / (
-                    time_difference.total_seconds() * 1024) if time_difference.total_seconds() > 0.0 else 0
-            total_megabytes = resource_count_holder1["total_bytes"] / (1024 * 1024)
-            resource_count = resource_count_holder1['resource_count']
-            resource_count_per_sec = resource_count / time_difference.total_seconds() if time_difference.total_seconds() > 0.0 else 0
-            remaining_resource_count = number_of_ids_to_expect - resource_count
-            estimate_remaining_time = (remaining_resource_count / resource_count_per_sec)
-            print(f"Resources: [{resource_count :,} / {number_of_ids_to_expect:,}] {time_difference},"
-                  + f" Resource/sec={resource_count_per_sec:.2f}"
-                  + f" Total MB={total_megabytes:.0f} KB/sec={kilo_bytes_per_sec:.2f}"
-                  + f" Remaining={timedelta(seconds=estimate_remaining_time)}",
-                  end='\r')
-            await output_file.write(json_result)
-            await output_file.flush()
+        parquet_sink: Optional[ParquetFileSink] = None
+        if self.parquet_output_file and checkpoint_state is not None:
+            self.progress.log(f"A Parquet file cannot be continued, so {self.parquet_output_file} is not written"
+                              f" when resuming; the command to convert the output is logged once the export is"
+                              f" complete")
+        elif self.parquet_output_file:
+            parquet_sink = await ParquetFileSink(self.parquet_output_file, projection=self.parquet_projection,
+                                                 row_group_size=self.parquet_row_group_size).open()
+
+        async def on_received_data(data: List[Dict[str, Any]], batch_number: Optional[int]) -> bool:
+            if not self.use_raw_bytes:
+                # we only have the parsed resources so serialize them once on the way to disk
+                await output_sink.write_resources(data)
+            if parquet_sink:
+                # the client has parsed the resources already so the Parquet sink does not parse the raw lines
+                await parquet_sink.write_resources(data)
+            if self.id_index:
+                self.id_index.record(self.resource, data)
+            if self.sync_watermark:
+                self.sync_watermark.observe(data)
+            resource_counter.add(len(data))
+            resource_counter.total_bytes = output_sink.total_bytes
             return True
 
         async def on_error(error: str, resources1: str, page_number: Optional[int]) -> bool:
-            print(f"\n=== ERROR: {error} ===")
+            self.error_count += 1
+            self.progress.error(f"=== ERROR: {error} ===")
             return True
 
-        async def on_received_ids(id_count_holder1: Dict[str, Union[int, float]], data: List[Dict[str, Any]],
-                                  batch_number: Optional[int]) -> bool:
-            if id_count_holder1["startTime"] == 0.0:
-                print("\n")
-                id_count_holder1["startTime"] = time.time()
-            chunk_end_time = time.time()
-            json_result: str = json.dumps(data)
-            id_count_holder1["resource_count"] = id_count_holder1["resource_count"] + len(data)
-            id_count_holder1["total_bytes"] = id_count_holder1["total_bytes"] + len(
-                json_result.encode("utf-8"))
-            time_difference = timedelta(seconds=chunk_end_time - id_count_holder1["startTime"])
-            kilo_bytes_per_sec = id_count_holder1["total_bytes"] / (
-                    time_difference.total_seconds() * 1024) if time_difference.total_seconds() > 0.0 else 0
-            total_megabytes = id_count_holder1["total_bytes"] / (1024 * 1024)
-            resource_count = id_count_holder1['resource_count']
-            resource_count_per_sec = resource_count / time_difference.total_seconds() if time_difference.total_seconds() > 0.0 else 0
-            print(f"Ids: [{resource_count:,}] {time_difference},"
-                  + f" Resource/sec={resource_count_per_sec:.2f}"
-                  + f" Total MB={total_megabytes:.0f} KB/sec={kilo_bytes_per_sec:.2f}",
-                  end='\r')
+        async def on_received_ids(data: List[Dict[str, Any]], batch_number: Optional[int]) -> bool:
+            # the bytes of streamed ids are counted in on_received_streaming_ids so don't re-serialize them here
+            id_counter.add(len(data))
             return True
 
-        async def on_received_streaming_ids(resource_count_holder1: Dict[str, Union[int, float]],
-                                            data: bytes, page_number: Optional[int]) -> bool:
-            if resource_count_holder1["startTime"] == 0.0:
-                print("\n")
-                resource_count_holder1["startTime"] = time.time()
-            chunk_end_time = time.time()
-            resource_count_holder1["resource_count"] += 1
-            resource_count_holder1["total_bytes"] = resource_count_holder1["total_bytes"] + len(data)
-            time_difference = timedelta(seconds=chunk_end_time - resource_count_holder1["startTime"])
-            kilo_bytes_per_sec = resource_count_holder1["total_bytes"] / (
-                    time_difference.total_seconds() * 1024) if time_difference.total_seconds() > 0.0 else 0
-            total_megabytes = resource_count_holder1["total_bytes"] / (1024 * 1024)
-            print(f"Streaming ids: [{resource_count_holder1['resource_count']:,}] {time_difference},"
-                  + f" Total MB={total_megabytes:.0f} KB/sec={kilo_bytes_per_sec:.2f}",
-                  end='\r')
-            await output_file_streaming_ids.write(data)
+        async def on_received_streaming_ids(data: bytes, page_number: Optional[int]) -> bool:
+            streaming_id_counter.add(1, len(data))
+            if not self.checkpoint_journal:
+                # with a checkpoint load_slices writes the ids of a slice once the slice is complete
+                await ids_sink.write_bytes(data)
             # await output_file.flush()
             return True
 
-        async def on_received_streaming_chunk(resource_count_holder1: Dict[str, Union[int, float]],
-                                              data: bytes, page_number: Optional[int]) -> bool:
-            if resource_count_holder1["startTime"] == 0.0:
-                print("\n")
-                resource_count_holder1["startTime"] = time.time()
-            chunk_end_time = time.time()
-            resource_count_holder1["resource_count"] += 1
-            resource_count_holder1["total_bytes"] = resource_count_holder1["total_bytes"] + len(data)
-            time_difference = timedelta(seconds=chunk_end_time - resource_count_holder1["startTime"])
-            kilo_bytes_per_sec = resource_count_holder1["total_bytes"] / (
-                    time_difference.total_seconds() * 1024) if time_difference.total_seconds() > 0.0 else 0
-            total_megabytes = resource_count_holder1["total_bytes"] / (1024 * 1024)
-            print(f"Streaming chunks: [{resource_count_holder1['resource_count']:,}] {time_difference},"
-                  + f" Total MB={total_megabytes:.0f} KB/sec={kilo_bytes_per_sec:.2f}",
-                  end='\r')
-            await output_file_streaming_resources.write(data)
-            # await output_file.flush()
+        async def on_received_streaming_chunk(data: bytes, page_number: Optional[int]) -> bool:
+            streaming_chunk_counter.add(1, len(data))
+            # NDJSON lines from the server go to disk untouched
+            await output_sink.write_bytes(data)
             return True
 
         # Use a breakpoint in the code line below to debug your script.
-        print(f'Calling {self.server_url} with {self.concurrent_requests} parallel connections...')
-        print(f'From {self.start_date} to {self.end_date}, atlas:{self.use_atlas}, streaming={self.use_data_streaming}')
-        # from helix_fhir_client_sdk.fhir_client import FhirClient
+        self.progress.log(f'Calling {self.server_url}/{self.resource} with {self.concurrent_requests}'
+                          f' parallel connections...')
+        self.progress.log(f'From {self.start_date} to {self.end_date}, atlas:{self.use_atlas},'
+                          f' streaming={self.use_data_streaming}')
+        if self.differential:
+            await self.load_changed_resources(
+                id_counter=id_counter,
+                on_received_data=on_received_data,
+                on_error=on_error,
+                on_received_streaming_chunk=on_received_streaming_chunk
+            )
+        elif self.number_of_slices > 1 or self.incremental:
+            await self.load_slices(
+                id_counter=id_counter,
+                output_sink=output_sink,
+                ids_sink=ids_sink,
+                checkpoint_state=checkpoint_state,
+                on_received_data=on_received_data,
+                on_error=on_error,
+                on_received_ids=on_received_ids,
+                on_received_streaming_ids=on_received_streaming_ids,
+                on_received_streaming_chunk=on_received_streaming_chunk
+            )
+        else:
+            fhir_client = await self.create_fhir_client()
+            await fhir_client.get_resources_by_query_and_last_updated_async(
+                concurrent_requests=self.concurrent_requests,
+                page_size_for_retrieving_resources=self.page_size_for_retrieving_resources,
+                page_size_for_retrieving_ids=self.page_size_for_retrieving_ids,
+                last_updated_start_date=self.start_date,
+                last_updated_end_date=self.end_date,
+                fn_handle_batch=on_received_data,
+                fn_handle_error=on_error,
+                fn_handle_ids=on_received_ids,
+                fn_handle_streaming_ids=on_received_streaming_ids,
+                fn_handle_streaming_chunk=on_received_streaming_chunk
+            )
+
+        end_job = time.time()
+        await ids_sink.close()
+        await output_sink.close()
+        self.progress.log(f"Output writer: {output_sink.write_count:,} writes,"
+                          f" waited {output_sink.backpressure_seconds:.1f}s for the disk")
+        if parquet_sink:
+            await parquet_sink.close()
+            self.progress.log(f"Wrote {parquet_sink.resource_count:,} resources in {parquet_sink.row_group_count}"
+                              f" row groups to {parquet_sink.file_path}"
+                              f" ({parquet_sink.offset / (1024 * 1024):.0f} MB)")
+        elif self.parquet_output_file:
+            # resumed, so the Parquet file has to be made from the finished output: every shard of it if it rolled
+            converted_files: List[str] = [
+                os.path.join(os.path.dirname(output_file), shard["file"]) for shard in output_sink.shards
+            ] if isinstance(output_sink, RollingNdjsonSink) else [output_file]
+            self.progress.log(f"Convert the output to Parquet with python parquet_sink.py"
+                              f" {' '.join(converted_files)} {self.parquet_output_file}")
+        if self.id_index:
+            # the index has to be durable before the watermark moves past what it records
+            self.id_index.commit()
+        if self.sync_watermark:
+            self.save_watermark()
+        output_location: str = output_sink.file_path
+        if isinstance(output_sink, RollingNdjsonSink):
+            output_location = f"{len(output_sink.shards)} shards listed in {output_sink.manifest_file}"
+        self.progress.log(f"====== Received {output_sink.resource_count:,} resources"
+                          f" ({output_sink.total_bytes / (1024 * 1024):.0f} MB,"
+                          f" {output_sink.offset / (1024 * 1024):.0f} MB in {output_location})"
+                          f" in {timedelta(seconds=end_job - start_job)} =======")
+        self.type_metrics[self.resource] = {
+            "resources": output_sink.resource_count,
+            "ids": id_counter.count,
+            "mb": output_sink.total_bytes / (1024 * 1024),
+            "seconds": end_job - start_job,
+            "resources_per_second": output_sink.resource_count / (end_job - start_job) if end_job > start_job else 0,
+            "errors": self.error_count
+        }
+
+    def start_from_watermark(self) -> None:
+        """
+        Moves start_date back to the watermark of the last successful run minus incremental_overlap and end_date
+        forward to now.  A resumed run keeps the window that the interrupted run recorded in its checkpoint.
+        """
+        self.sync_watermark = SyncWatermark(self.watermark_file, key=f"{self.server_url}/{self.resource}")
+        watermark: Optional[datetime] = self.sync_watermark.load()
+        checkpoint_header: Optional[Dict[str, Any]] = None
+        if self.resume and os.path.exists(self.checkpoint_file):
+            checkpoint_header = CheckpointJournal(self.checkpoint_file).load().header
+        if checkpoint_header:
+            self.start_date = datetime.fromisoformat(checkpoint_header["start_date"])
+            self.end_date = datetime.fromisoformat(checkpoint_header["end_date"])
+        else:
+            if watermark is not None:
+                self.start_date = watermark - self.incremental_overlap
+            self.end_date = datetime.utcnow().replace(microsecond=0)
+        assert self.end_date > self.start_date, f"Nothing to do: start {self.start_date} is after end {self.end_date}"
+        self.overlap_end = watermark
+        self.progress.log(f"Incremental export of {self.resource} from {self.start_date} to {self.end_date}"
+                          + (f" (watermark {watermark} minus {self.incremental_overlap})" if watermark else
+                             f" (no watermark in {self.watermark_file} yet)"))
+
+    def save_watermark(self) -> None:
+        """
+        Saves the largest lastUpdated of this run as the watermark for the next one, unless a request failed or
+        a slice ended early, in which case the next run starts from the old watermark again
+        """
+        assert self.sync_watermark
+        if self.duplicates_skipped:
+            self.progress.log(f"Skipped {self.duplicates_skipped:,} resources in the overlap that were already"
+                              f" exported by the last run")
+        if self.error_count or self.incomplete_slices:
+            # a later resource of a complete slice would otherwise move the watermark past the missing ones
+            self.progress.error(f"{self.error_count} requests failed and {self.incomplete_slices} slices are"
+                                f" incomplete so the watermark in {self.watermark_file} stays where it was")
+        elif self.sync_watermark.max_seen is None:
+            self.progress.log(f"No resources received so the watermark in {self.watermark_file} stays where it was")
+        else:
+            self.sync_watermark.save(self.sync_watermark.max_seen)
+            self.progress.log(f"Saved {self.resource} watermark {self.sync_watermark.max_seen} to {self.watermark_file}")
+
+    def rolls_output(self) -> bool:
+        """
+        Whether the output is written as size-bounded shards instead of one file
+        """
+        return bool(self.output_shard_max_mb or self.output_shard_max_resources)
+
+    def open_checkpoint_journal(self) -> Optional[CheckpointState]:
+        """
+        Starts a new checkpoint journal, or when resuming, reads the previous one and cuts the output file
+        back to what it committed
+
+        :return: the state to resume from, or None when starting over
+        """
+        if not self.use_checkpoint or self.number_of_slices <= 1 or self.differential:
+            return None
+        self.checkpoint_journal = CheckpointJournal(self.checkpoint_file)
+        # a resume is only valid for exactly the same export
+        header: Dict[str, Any] = {
+            "server_url": self.server_url,
+            "resource": self.resource,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat(),
+            "number_of_slices": self.number_of_slices,
+            "output_file": self.output_file
+        }
+        if self.resume and os.path.exists(self.checkpoint_file):
+            checkpoint_state: CheckpointState = self.checkpoint_journal.load()
+            assert checkpoint_state.header == header, \
+                f"Cannot resume: {self.checkpoint_file} is for {checkpoint_state.header}, not {header}"
+            truncate: Callable[[str, int], int] = truncate_shards_to_committed_offset if self.rolls_output() \
+                else truncate_to_committed_offset
+            bytes_removed: int = truncate(self.output_file, checkpoint_state.committed_offsets.get(self.output_file, 0))
+            bytes_removed += truncate_to_committed_offset(
+                self.ids_output_file, checkpoint_state.committed_offsets.get(self.ids_output_file, 0)
+            )
+            self.progress.log(f"Resuming from {self.checkpoint_file}: {len(checkpoint_state.completed_slices)} slices"
+                              f" done, {checkpoint_state.committed_batches:,} batches committed,"
+                              f" {bytes_removed:,} bytes of uncommitted output removed")
+            return checkpoint_state
+        self.checkpoint_journal.start(header)
+        return None
+
+    @staticmethod
+    def remove_already_written(data: List[Dict[str, Any]], page: bytes,
+                               ids_seen: Set[str]) -> Tuple[List[Dict[str, Any]], bytes]:
+        """
+        Drops resources that a previous (interrupted) run already wrote for this slice
+
+        :param data: parsed resources of the page
+        :param page: the raw NDJSON lines of the page, if any
+        :param ids_seen: ids committed by the previous run for slices it did not complete
+        :return: the remaining resources and their raw lines
+        """
+        remaining_data: List[Dict[str, Any]] = [resource for resource in data if resource.get("id") not in ids_seen]
+        if not page or len(remaining_data) == len(data):
+            return remaining_data, page
+        lines: List[bytes] = [line for line in page.splitlines(keepends=True) if line.strip()]
+        remaining_lines: List[bytes] = [line for line in lines if json_codec.loads(line).get("id") not in ids_seen]
+        return remaining_data, b"".join(remaining_lines)
+
+    def remove_unchanged(self, data: List[Dict[str, Any]], page: bytes) -> Tuple[List[Dict[str, Any]], bytes]:
+        """
+        Drops resources that are in the id index with the same lastUpdated, i.e. that the last incremental run
+        already exported
+
+        :param data: parsed resources of the page
+        :param page: the raw NDJSON lines of the page, if any
+        :return: the remaining resources and their raw lines
+        """
+        assert self.id_index
+        changed_ids: Set[str] = set(self.id_index.find_changed(self.resource, data))
+        unchanged_ids: Set[str] = {resource["id"] for resource in data if resource["id"] not in changed_ids}
+        if not unchanged_ids:
+            return data, page
+        self.duplicates_skipped += len(unchanged_ids)
+        return self.remove_already_written(data, page, unchanged_ids)
+
+    async def load_slices(self, id_counter: ProgressCounter,
+                          output_sink: Union[NdjsonFileSink, RollingNdjsonSink],
+                          ids_sink: NdjsonFileSink,
+                          checkpoint_state: Optional[CheckpointState],
+                          on_received_data: HandleBatchFunction,
+                          on_error: HandleErrorFunction,
+                          on_received_ids: HandleBatchFunction,
+                          on_received_streaming_ids: HandleStreamingChunkFunction,
+                          on_received_streaming_chunk: HandleStreamingChunkFunction) -> None:
+        """
+        Cuts start_date..end_date into number_of_slices time slices and downloads them in parallel.
+        All slices share the same handlers so their progress rolls up into the same counters and their
+        results end up in the same output files.  The concurrent_requests budget is shared by all slices.
+
+        :param id_counter: aggregate id count across all slices
+        :param output_sink: the output file, synced before each checkpoint commit
+        :param ids_sink: the ids file; with a checkpoint it gets the ids of each slice once the slice is complete
+        :param checkpoint_state: what a previous run completed when resuming
+        :param on_received_data: handler for a batch of resources
+        :param on_error: handler for errors
+        :param on_received_ids: handler for a batch of ids
+        :param on_received_streaming_ids: handler for a chunk of streamed ids
+        :param on_received_streaming_chunk: handler for a chunk of streamed resources
+        """
+        slices: List[Tuple[datetime, datetime]] = split_date_range(self.start_date, self.end_date,
+                                                                   self.number_of_slices)
+        # a multi type export has already created the slots, shared by all types
+        slots: FairSlots
+        if self.use_adaptive_concurrency:
+            # each slice uses one connection and the controller decides how many slices are in flight
+            concurrent_requests_per_slice: int = 1
+            if self.concurrency_controller is None:
+                self.concurrency_controller = AdaptiveConcurrencyController(
+                    name=self.fhir_server,
+                    max_limit=min(len(slices), self.concurrent_requests),
+                    history_file=self.concurrency_history_file
+                )
+            slots = self.concurrency_controller
+            self.progress.log(f'Splitting into {len(slices)} slices: adaptive concurrency starting at'
+                              f' {self.concurrency_controller.limit} (max {self.concurrency_controller.max_limit})')
+        else:
+            # run at most concurrent_requests slices at once and split the connection budget between them
+            if self.slice_slots is None:
+                self.slice_slots = FairSlots(min(len(slices), self.concurrent_requests))
+            slots = self.slice_slots
+            slices_in_flight: int = min(len(slices), slots.limit)
+            concurrent_requests_per_slice = max(1, self.concurrent_requests // slices_in_flight)
+            if self.checkpoint_journal or self.overlap_end:
+                # the lines of a page are only attributable to that page when a slice fetches one page at a time
+                concurrent_requests_per_slice = 1
+            self.progress.log(f'Splitting into {len(slices)} slices: {slices_in_flight} in parallel'
+                              f' with {concurrent_requests_per_slice} connections each')
+        slice_count_holder: Dict[str, int] = {
+            "completed": 0,
+            "total": len(slices)
+        }
+        slice_resource_counts: List[int] = [0 for _ in slices]
+        # failed requests of each slice; a slice with any is missing resources and is not journalled as completed
+        slice_error_counts: List[int] = [0 for _ in slices]
+        ids_seen: Set[str] = checkpoint_state.ids_seen if checkpoint_state else set()
+        checkpoint_lock: asyncio.Lock = asyncio.Lock()
+        last_checkpoint_holder: Dict[str, float] = {"time": time.time()}
+
+        async def commit_checkpoint() -> None:
+            assert self.checkpoint_journal
+            async with checkpoint_lock:
+                # pages are written and recorded under the same lock, so everything pending was written before
+                # the sync and the durable offset it returns covers it
+                pending: CheckpointJournal = self.checkpoint_journal.take_pending()
+                offset: int = await output_sink.sync()
+                ids_offset: int = await ids_sink.sync()
+                pending.commit({output_sink.file_path: offset, ids_sink.file_path: ids_offset})
+                if self.id_index:
+                    self.id_index.commit()
+                last_checkpoint_holder["time"] = time.time()
+
+        async def load_slice(slice_number: int, slice_start: datetime, slice_end: datetime) -> None:
+            if checkpoint_state and slice_number in checkpoint_state.completed_slices:
+                slice_count_holder["completed"] += 1
+                return
+            fhir_client: ReportingFhirClient = await self.create_fhir_client()
+            # slices that start before the watermark overlap the last incremental run
+            skip_unchanged: bool = self.overlap_end is not None and slice_start < self.overlap_end
+            # raw lines of the page being received; written together with the page so a checkpoint
+            # never covers part of a page and resources can be dropped from it
+            buffer_pages: bool = self.checkpoint_journal is not None or skip_unchanged
+            page_lines: List[bytes] = []
+            # streamed ids of the slice; a slice that is downloaded again on resume lists its ids again, so they
+            # are only written together with its completion
+            id_lines: List[bytes] = []
+
+            async def on_received_slice_chunk(data: bytes, batch_number: Optional[int]) -> bool:
+                if not buffer_pages:
+                    return await on_received_streaming_chunk(data, batch_number)
+                page_lines.append(data)
+                return True
+
+            async def on_received_slice_ids(data: bytes, page_number: Optional[int]) -> bool:
+                if self.checkpoint_journal:
+                    id_lines.append(data)
+                return await on_received_streaming_ids(data, page_number)
+
+            async def on_slice_error(error: str, resources1: str, page_number: Optional[int]) -> bool:
+                # a failed page never gets a batch so drop whatever lines it streamed
+                page_lines.clear()
+                slice_error_counts[slice_number] += 1
+                return await on_error(error, resources1, page_number)
+
+            async def on_received_slice_data(data: List[Dict[str, Any]], batch_number: Optional[int]) -> bool:
+                if self.concurrency_controller and fhir_client.last_request_seconds is not None:
+                    # with one connection per slice the last request of the client is the one of this batch
+                    self.concurrency_controller.record_response(latency=fhir_client.last_request_seconds,
+                                                                units=len(data))
+                if not buffer_pages:
+                    slice_resource_counts[slice_number] += len(data)
+                    return await on_received_data(data, batch_number)
+                page: bytes = b"".join(page_lines)
+                page_lines.clear()
+                if ids_seen:
+                    data, page = self.remove_already_written(data, page, ids_seen)
+                if skip_unchanged:
+                    data, page = self.remove_unchanged(data, page)
+                slice_resource_counts[slice_number] += len(data)
+                # writing the page awaits (a full row group, a shard rolling over), so without the lock a commit
+                # could sync the page into the committed offset before its ids are recorded
+                async with checkpoint_lock:
+                    if page:
+                        await on_received_streaming_chunk(page, batch_number)
+                    result: bool = await on_received_data(data, batch_number)
+                    if self.checkpoint_journal:
+                        self.checkpoint_journal.record_batch(slice_number, [resource["id"] for resource in data])
+                if self.checkpoint_journal and \
+                        time.time() - last_checkpoint_holder["time"] >= self.checkpoint_interval_in_seconds:
+                    await commit_checkpoint()
+                return result
+
+            async def download_slice() -> None:
+                fhir_client.last_updated_after(slice_start)
+                fhir_client.last_updated_before(slice_end)
+                # without dates the client lists the ids with its own handle_error, so a failed page of ids would
+                # only be logged and end the listing early
+                fhir_client.error_handler(on_slice_error)
+                try:
+                    await fhir_client.get_resources_by_query_async(
+                        concurrent_requests=concurrent_requests_per_slice,
+                        page_size_for_retrieving_resources=self.page_size_for_retrieving_resources,
+                        page_size_for_retrieving_ids=self.page_size_for_retrieving_ids,
+                        fn_handle_batch=on_received_slice_data,
+                        fn_handle_error=on_slice_error,
+                        fn_handle_ids=on_received_ids,
+                        fn_handle_streaming_ids=on_received_slice_ids,
+                        fn_handle_streaming_chunk=on_received_slice_chunk
+                    )
+                except Exception as e:
+                    if self.concurrency_controller:
+                        self.concurrency_controller.record_error(f"{type(e).__name__} in slice {slice_number + 1}")
+                    raise
+
+            async with slots.slot(self.resource):
+                await download_slice()
+            if self.checkpoint_journal:
+                # the batches it did write are committed either way, so a resume only adds what is missing
+                if not slice_error_counts[slice_number]:
+                    async with checkpoint_lock:
+                        await ids_sink.write_bytes(b"".join(id_lines))
+                        self.checkpoint_journal.record_slice_completed(slice_number)
+                await commit_checkpoint()
+            slice_count_holder["completed"] += 1
+            label: str = f"{self.resource} slice" if len(self.resource_types) > 1 else "Slice"
+            if slice_error_counts[slice_number]:
+                self.incomplete_slices += 1
+                self.progress.error(f"{label} {slice_number + 1} {slice_start} to {slice_end} is incomplete:"
+                                    f" {slice_error_counts[slice_number]} requests failed"
+                                    + ("; --resume downloads it again" if self.checkpoint_journal else ""))
+                return
+            self.progress.log(f"{label} {slice_number + 1} [{slice_count_holder['completed']} /"
+                              f" {slice_count_holder['total']}] {slice_start} to {slice_end} done:"
+                              f" {slice_resource_counts[slice_number]:,} resources (ids so far: {id_counter.count:,})")
+
+        await asyncio.gather(
+            *[
+                load_slice(slice_number, slice_start, slice_end)
+                for slice_number, (slice_start, slice_end) in enumerate(slices)
+            ]
+        )
+
+    async def load_changed_resources(self, id_counter: ProgressCounter,
+                                     on_received_data: HandleBatchFunction,
+                                     on_error: HandleErrorFunction,
+                                     on_received_streaming_chunk: HandleStreamingChunkFunction) -> None:
+        """
+        Differential sync: lists only id and meta of the resources in start_date..end_date, one query per time slice,
+        and then downloads the resources that are not in the id index or whose meta.lastUpdated changed,
+        in batches of page_size_for_retrieving_resources ids.
+
+        :param id_counter: counts the resources listed
+        :param on_received_data: handler for a batch of resources
+        :param on_error: handler for errors
+        :param on_received_streaming_chunk: handler for a chunk of streamed resources
+        """
+        assert self.id_index
+        id_index: IdIndex = self.id_index
+        unchanged_counter: ProgressCounter = self.progress.counter(
+            "Unchanged" if len(self.resource_types) == 1 else f"{self.resource} unchanged"
+        )
+        changed_ids: List[str] = []
+        # share the slots of a multi type export
+        slots: FairSlots = self.concurrency_controller or self.slice_slots or FairSlots(self.concurrent_requests)
+
+        async def on_received_versions(data: List[Dict[str, Any]], batch_number: Optional[int]) -> bool:
+            id_counter.add(len(data))
+            changed_ids_in_batch: List[str] = id_index.find_changed(self.resource, data)
+            changed_ids.extend(changed_ids_in_batch)
+            unchanged_counter.add(len(data) - len(changed_ids_in_batch))
+            return True
+
+        async def list_versions(slice_start: datetime, slice_end: datetime) -> None:
+            async with slots.slot(self.resource):
+                fhir_client = await self.create_fhir_client()
+                fhir_client = fhir_client.include_only_properties(["id", "meta"])
+                fhir_client = fhir_client.page_size(self.page_size_for_retrieving_ids)
+                fhir_client = fhir_client.last_updated_after(slice_start)
+                fhir_client = fhir_client.last_updated_before(slice_end)
+                await fhir_client.get_by_query_in_pages_async(
+                    concurrent_requests=1,
+                    output_queue=asyncio.Queue(),
+                    fn_handle_batch=on_received_versions,
+                    fn_handle_error=on_error,
+                    fn_handle_streaming_chunk=None
+                )
+
+        await asyncio.gather(
+            *[
+                list_versions(slice_start, slice_end)
+                for slice_start, slice_end in split_date_range(self.start_date, self.end_date,
+                                                               max(1, self.number_of_slices))
+            ]
+        )
+        # a resource updated while we were listing can show up in two slices
+        changed_ids = list(dict.fromkeys(changed_ids))
+        self.progress.log(f"{len(changed_ids):,} of {id_counter.count:,} {self.resource} resources are new or changed"
+                          f" since they were recorded in {self.id_index_file}")
+        if not changed_ids:
+            return
+        batch_size: int = self.page_size_for_retrieving_resources
         fhir_client = await self.create_fhir_client()
-        await fhir_client.get_resources_by_query_and_last_updated_async(
+        await fhir_client.get_resources_by_id_in_parallel_batches_async(
             concurrent_requests=self.concurrent_requests,
-            page_size_for_retrieving_resources=self.page_size_for_retrieving_resources,
-            page_size_for_retrieving_ids=self.page_size_for_retrieving_ids,
-            last_updated_start_date=self.start_date,
-            last_updated_end_date=self.end_date,
-            fn_handle_batch=lambda data, batch_number: on_received_data(id_count_holder, resource_count_holder, data,
-                                                                        batch_number),
+            chunks=(changed_ids[start:start + batch_size] for start in range(0, len(changed_ids), batch_size)),
+            fn_handle_batch=on_received_data,
             fn_handle_error=on_error,
-            fn_handle_ids=lambda data, batch_number: on_received_ids(id_count_holder, data, batch_number),
-            fn_handle_streaming_ids=lambda data, batch_number: on_received_streaming_ids(streaming_id_count_holder,
-                                                                                         data, batch_number),
-            fn_handle_streaming_chunk=lambda data, batch_number: on_received_streaming_chunk(
-                streaming_chunk_count_holder,
-                data, batch_number)
+            fn_handle_streaming_chunk=on_received_streaming_chunk
         )
 
-        end_job = time.time()
-        await output_file_streaming_ids.flush()
-        await output_file_streaming_ids.close()
-        await output_file_streaming_resources.flush()
-        await output_file_streaming_resources.close()
-        await output_file.flush()
-        await output_file.close()
-        print(f"\n====== Received {len(resources)} resources in {timedelta(seconds=end_job - start_job)} =======")
-
-        # for id_ in list_of_ids:
-        #     print(id_)
+    def on_failed_status_code(self, status_code: int) -> None:
+        """
+        Backs off the adaptive controller when the server is overloaded
+        """
+        if self.concurrency_controller and (status_code == 429 or status_code >= 500):
+            self.concurrency_controller.record_error(f"status {status_code}")
 
     async def create_fhir_client(self):
-        fhir_client: FhirClient = FhirClient()
+        fhir_client: ReportingFhirClient = PooledFhirClient(self.http_pool) if self.http_pool \
+            else ReportingFhirClient()
+        fhir_client = fhir_client.on_status_code(self.on_failed_status_code)
+        fhir_client = fhir_client.retry_on_status(self.status_retries, self.max_retry_seconds)
         fhir_client = fhir_client.url(self.server_url)
         fhir_client = fhir_client.client_credentials(self.auth_client_id, self.auth_client_secret)
         fhir_client = fhir_client.auth_scopes(self.auth_scopes)
+        if self.token_provider:
+            # skips the discovery and token round trips each client would otherwise make, and hands every
+            # request the token the provider last refreshed
+            fhir_client = fhir_client.token_provider(self.token_provider)
         fhir_client = fhir_client.resource(self.resource)
-        fhir_client = fhir_client.logger(MyLogger())
+        fhir_client = fhir_client.logger(MyLogger(level=self.log_level))
+        # additional_parameters() replaces the previous list so collect them and set them once
+        additional_parameters: List[str] = []
         if self.use_atlas:
-            fhir_client = fhir_client.additional_parameters(["_useAtlas=1"])
+            additional_parameters.append("_useAtlas=1")
         if self.use_data_streaming:
-            fhir_client = fhir_client.additional_parameters(["_streamResponse=1"])
+            additional_parameters.append("_streamResponse=1")
             # fhir_client = fhir_client.use_data_streaming(True)
-        fhir_client = fhir_client.additional_parameters(["_useAccessIndex=1"])
+        if self.use_raw_bytes:
+            # makes the client hand us each NDJSON line as bytes in fn_handle_streaming_chunk
+            fhir_client = fhir_client.use_data_streaming(True)
+        additional_parameters.append("_useAccessIndex=1")
+        fhir_client = fhir_client.additional_parameters(additional_parameters)
         return fhir_client
 
 
@@ -244,4 +1046,21 @@ class ResourceDownloader:
 if __name__ == '__main__':
     load_dotenv()
 
-    asyncio.run(ResourceDownloader().load_data('PyCharm'))
+    parser = argparse.ArgumentParser(description="Downloads resources from a FHIR server")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the slices and batches a previous, interrupted run completed")
+    parser.add_argument("--quiet", action="store_true", help="print nothing but errors")
+    parser.add_argument("--differential", action="store_true",
+                        help="download only the resources that are new or changed since the last run")
+    parser.add_argument("--incremental", action="store_true",
+                        help="download from the watermark saved by the last successful incremental run up to now")
+    parser.add_argument("--resource-types", nargs="+", metavar="RESOURCE_TYPE",
+                        help="export these resource types at the same time, e.g. AuditEvent Patient Practitioner")
+    args = parser.parse_args()
+
+    downloader = ResourceDownloader(resume=args.resume, quiet=args.quiet, differential=args.differential,
+                                    incremental=args.incremental, resource_types=args.resource_types)
+    asyncio.run(downloader.load_data('PyCharm'))
+    if downloader.error_count:
+        # so a scheduler does not take an export with missing resources for a complete one
+        sys.exit(1)
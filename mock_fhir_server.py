@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from benchmark_memory import create_audit_event
+
+ACCESS_TOKEN: str = "mock-access-token"
+
+
+def parse_fhir_date(value: str) -> float:
+    """
+    Parses a FHIR date or dateTime (2022-02-22 or 2022-02-22T10:00:00Z) into a UTC timestamp
+    """
+    value = value.replace("Z", "+00:00")
+    parsed: datetime = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def format_fhir_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class MockFhirServer:
+    """
+    Local stand-in for the FHIR server that implements just what our download scripts use:
+    .well-known/smart-configuration, the token endpoint, searches with _lastUpdated (or date), _count,
+    _getpagesoffset, id:above, id/_id lists and _elements, returned either as a Bundle or, with _streamResponse=1
+    or an ndjson Accept header, as NDJSON sent in chunks.  Responses are gzip compressed when the request
+    accepts gzip and does not send x-no-compression, like the real server.
+
+    The dataset is synthetic and generated on the fly: resource i of every resource type has id
+    <type>-<i zero padded> and is last updated at dataset_start + i * (dataset_end - dataset_start) / dataset_size,
+    so any run against the same settings returns the same bytes.  Latency, errors and disconnects are
+    injected from a seeded random generator so they are reproducible too.
+    """
+
+    def __init__(self, dataset_size: int = 100000, dataset_start: str = "2022-02-22",
+                 dataset_end: str = "2022-02-24", default_page_size: int = 100, chunk_size: int = 100,
+                 response_latency_ms: float = 0, chunk_latency_ms: float = 0, error_rate: float = 0,
+                 error_status: int = 500, retry_after: Optional[str] = None, disconnect_rate: float = 0, token_expires_in_seconds: int = 3600,
+                 seed: int = 0) -> None:
+        """
+        :param dataset_size: number of resources of each resource type
+        :param dataset_start: lastUpdated of the first resource
+        :param dataset_end: resources are spread evenly up to this date
+        :param default_page_size: page size when the request has no _count
+        :param chunk_size: number of resources per HTTP chunk when streaming
+        :param response_latency_ms: delay before the response headers are sent (time to first byte)
+        :param chunk_latency_ms: delay before each chunk when streaming
+        :param error_rate: fraction of search requests that fail with error_status
+        :param error_status: status code of injected errors, e.g. 500 or 429
+        :param retry_after: Retry-After header of injected errors, in seconds or as an HTTP date
+        :param disconnect_rate: fraction of streamed responses where the connection is dropped mid-stream
+        :param token_expires_in_seconds: expires_in returned by the token endpoint
+        :param seed: seed for the injected errors and disconnects
+        """
+        self.dataset_size: int = dataset_size
+        self.dataset_start: float = parse_fhir_date(dataset_start)
+        self.dataset_end: float = parse_fhir_date(dataset_end)
+        self.default_page_size: int = default_page_size
+        self.chunk_size: int = chunk_size
+        self.response_latency_ms: float = response_latency_ms
+        self.chunk_latency_ms: float = chunk_latency_ms
+        self.error_rate: float = error_rate
+        self.error_status: int = error_status
+        self.retry_after: Optional[str] = retry_after
+        self.disconnect_rate: float = disconnect_rate
+        self.token_expires_in_seconds: int = token_expires_in_seconds
+        self.random: random.Random = random.Random(seed)
+        self.step: float = (self.dataset_end - self.dataset_start) / max(1, dataset_size)
+        self.requests: int = 0
+        self.resources_sent: int = 0
+        self.errors_injected: int = 0
+        self.disconnects_injected: int = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def create_app(self) -> web.Application:
+        app: web.Application = web.Application()
+        app.router.add_get("/.well-known/smart-configuration", self.handle_smart_configuration)
+        app.router.add_post("/auth/token", self.handle_token)
+        app.router.add_get("/4_0_0/{resource_type}", self.handle_search)
+        app.router.add_get("/4_0_0/{resource_type}/{id}", self.handle_read)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> str:
+        """
+        Starts the server in the running event loop, e.g. from a benchmark
+
+        :return: base url of the server
+        """
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def report(self) -> str:
+        return (f"Mock FHIR server: requests={self.requests:,} resources sent={self.resources_sent:,}"
+                f" errors injected={self.errors_injected:,} disconnects injected={self.disconnects_injected:,}")
+
+    async def handle_smart_configuration(self, request: web.Request) -> web.Response:
+        return web.json_response({"token_endpoint": f"{request.scheme}://{request.host}/auth/token"})
+
+    async def handle_token(self, request: web.Request) -> web.Response:
+        if not request.headers.get("Authorization", "").startswith("Basic "):
+            return web.json_response({"error": "invalid_client"}, status=401)
+        return web.json_response({
+            "access_token": ACCESS_TOKEN,
+            "token_type": "Bearer",
+            "expires_in": self.token_expires_in_seconds
+        })
+
+    async def handle_read(self, request: web.Request) -> web.StreamResponse:
+        error_response: Optional[web.Response] = await self._check_request(request)
+        if error_response is not None:
+            return error_response
+        index: Optional[int] = self.get_index(request.match_info["resource_type"], request.match_info["id"])
+        if index is None:
+            return web.json_response({"resourceType": "OperationOutcome"}, status=404)
+        return web.json_response(self.create_resource(request.match_info["resource_type"], index))
+
+    async def handle_search(self, request: web.Request) -> web.StreamResponse:
+        error_response: Optional[web.Response] = await self._check_request(request)
+        if error_response is not None:
+            return error_response
+        resource_type: str = request.match_info["resource_type"]
+        indexes: List[int] = self.find_indexes(resource_type, request)
+        page_size: int = int(request.query.get("_count", self.default_page_size))
+        page_number: int = int(request.query.get("_getpagesoffset", 0))
+        page: List[int] = indexes[page_number * page_size:(page_number + 1) * page_size]
+        elements: Optional[List[str]] = request.query["_elements"].split(",") if "_elements" in request.query else None
+        if request.query.get("_streamResponse") == "1" or "ndjson" in request.headers.get("Accept", ""):
+            return await self._stream_resources(request, resource_type, page, elements)
+        resources: List[Dict[str, Any]] = [self.create_resource(resource_type, index, elements) for index in page]
+        self.resources_sent += len(resources)
+        links: List[Dict[str, str]] = [{"relation": "self", "url": str(request.url)}]
+        if (page_number + 1) * page_size < len(indexes):
+            links.append({
+                "relation": "next",
+                "url": str(request.url.update_query({"_getpagesoffset": str(page_number + 1)}))
+            })
+        response: web.Response = web.json_response({
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "link": links,
+            "entry": [{"resource": resource} for resource in resources]
+        })
+        if self._accepts_compression(request):
+            response.enable_compression(web.ContentCoding.gzip)
+        return response
+
+    def get_index(self, resource_type: str, id_: str) -> Optional[int]:
+        match = re.fullmatch(rf"{resource_type.lower()}-(\d+)", id_)
+        if not match or int(match.group(1)) >= self.dataset_size:
+            return None
+        return int(match.group(1))
+
+    def find_indexes(self, resource_type: str, request: web.Request) -> List[int]:
+        """
+        Returns the indexes of the resources matching the search parameters, in id order
+        """
+        first, last = 0, self.dataset_size
+        for parameter in ["_lastUpdated", "date"]:
+            for value in request.query.getall(parameter, []):
+                first, last = self._apply_date_filter(value, first, last)
+        if "id:above" in request.query:
+            above: Optional[int] = self.get_index(resource_type, request.query["id:above"])
+            first = max(first, above + 1 if above is not None else 0)
+        ids: Optional[str] = request.query.get("id") or request.query.get("_id")
+        if ids:
+            indexes: List[int] = sorted(
+                index for index in (self.get_index(resource_type, id_) for id_ in ids.split(","))
+                if index is not None and first <= index < last
+            )
+            return indexes
+        return list(range(first, max(first, last)))
+
+    def _apply_date_filter(self, value: str, first: int, last: int) -> Tuple[int, int]:
+        match = re.fullmatch(r"(eq|gt|ge|lt|le)?(.+)", value)
+        assert match, f"Invalid date filter {value}"
+        prefix: str = match.group(1) or "eq"
+        # position of the date in units of resources since dataset_start
+        position: float = (parse_fhir_date(match.group(2)) - self.dataset_start) / self.step
+        if prefix == "ge":
+            first = max(first, math.ceil(position))
+        elif prefix == "gt":
+            first = max(first, math.floor(position) + 1)
+        elif prefix == "lt":
+            last = min(last, math.ceil(position))
+        elif prefix == "le":
+            last = min(last, math.floor(position) + 1)
+        else:
+            # a bare date matches the whole day
+            day_end: float = position + 24 * 60 * 60 / self.step
+            first, last = max(first, math.ceil(position)), min(last, math.ceil(day_end))
+        return max(0, first), min(self.dataset_size, last)
+
+    def create_resource(self, resource_type: str, index: int, elements: Optional[List[str]] = None) -> Dict[str, Any]:
+        last_updated: str = format_fhir_date(self.dataset_start + index * self.step)
+        resource: Dict[str, Any]
+        if resource_type == "AuditEvent":
+            resource = create_audit_event(index)
+            resource["recorded"] = last_updated
+        else:
+            resource = {"resourceType": resource_type, "meta": {"versionId": "1"}}
+        resource["id"] = f"{resource_type.lower()}-{index:010d}"
+        resource["meta"]["lastUpdated"] = last_updated
+        if elements:
+            resource = {key: value for key, value in resource.items()
+                        if key in elements or key in ["resourceType", "id"]}
+        return resource
+
+    async def _check_request(self, request: web.Request) -> Optional[web.Response]:
+        """
+        Counts the request, applies the response latency and returns an error response if the request
+        is not authorized or an error is injected
+        """
+        self.requests += 1
+        if self.response_latency_ms:
+            await asyncio.sleep(self.response_latency_ms / 1000)
+        if request.headers.get("Authorization") != f"Bearer {ACCESS_TOKEN}":
+            return web.json_response({"resourceType": "OperationOutcome"}, status=401)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors_injected += 1
+            return web.json_response({"resourceType": "OperationOutcome"}, status=self.error_status,
+                                     headers={"Retry-After": self.retry_after} if self.retry_after else None)
+        return None
+
+    @staticmethod
+    def _accepts_compression(request: web.Request) -> bool:
+        return "gzip" in request.headers.get("Accept-Encoding", "") and "x-no-compression" not in request.headers
+
+    async def _stream_resources(self, request: web.Request, resource_type: str, indexes: List[int],
+                                elements: Optional[List[str]]) -> web.StreamResponse:
+        """
+        Sends the resources as NDJSON, creating them one chunk at a time like a server reading from a cursor
+        """
+        response: web.StreamResponse = web.StreamResponse(headers={"Content-Type": "application/fhir+ndjson"})
+        response.enable_chunked_encoding()
+        # compressed here rather than with enable_compression() so every chunk is flushed as it is sent
+        compressor: Optional[Any] = None
+        if self._accepts_compression(request):
+            response.headers["Content-Encoding"] = "gzip"
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        await response.prepare(request)
+        number_of_chunks: int = math.ceil(len(indexes) / self.chunk_size)
+        disconnect_at_chunk: Optional[int] = None
+        if number_of_chunks > 1 and self.disconnect_rate and self.random.random() < self.disconnect_rate:
+            disconnect_at_chunk = self.random.randrange(1, number_of_chunks)
+        for chunk_number, start in enumerate(range(0, len(indexes), self.chunk_size)):
+            if chunk_number == disconnect_at_chunk:
+                self.disconnects_injected += 1
+                assert request.transport is not None
+                request.transport.close()
+                return response
+            if self.chunk_latency_ms:
+                await asyncio.sleep(self.chunk_latency_ms / 1000)
+            chunk: List[Dict[str, Any]] = [
+                self.create_resource(resource_type, index, elements) for index in indexes[start:start + self.chunk_size]
+            ]
+            data: bytes = "".join(json.dumps(resource) + "\n" for resource in chunk).encode("utf-8")
+            if compressor is not None:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            await response.write(data)
+            self.resources_sent += len(chunk)
+        if compressor is not None:
+            await response.write(compressor.flush())
+        await response.write_eof()
+        return response
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs a local mock FHIR server with a synthetic dataset")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dataset-size", type=int, default=100000, help="resources of each resource type")
+    parser.add_argument("--dataset-start", default="2022-02-22")
+    parser.add_argument("--dataset-end", default="2022-02-24")
+    parser.add_argument("--default-page-size", type=int, default=100)
+    parser.add_argument("--chunk-size", type=int, default=100, help="resources per HTTP chunk when streaming")
+    parser.add_argument("--response-latency-ms", type=float, default=0)
+    parser.add_argument("--chunk-latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--retry-after", help="Retry-After header of the failed requests, e.g. 2")
+    parser.add_argument("--disconnect-rate", type=float, default=0,
+                        help="fraction of streamed responses that are cut off mid-stream")
+    parser.add_argument("--token-expires-in", type=int, default=3600)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = MockFhirServer(dataset_size=args.dataset_size, dataset_start=args.dataset_start,
+                            dataset_end=args.dataset_end, default_page_size=args.default_page_size,
+                            chunk_size=args.chunk_size, response_latency_ms=args.response_latency_ms,
+                            chunk_latency_ms=args.chunk_latency_ms, error_rate=args.error_rate,
+                            error_status=args.error_status, retry_after=args.retry_after,
+                            disconnect_rate=args.disconnect_rate,
+                            token_expires_in_seconds=args.token_expires_in, seed=args.seed)
+    print(f"Serving {args.dataset_size:,} resources per resource type on http://{args.host}:{args.port}")
+    try:
+        web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
+    finally:
+        print(server.report())
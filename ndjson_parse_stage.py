@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+import json_codec
+
+# keeps the resources for which it returns True; must be a module level function so it can be sent to the workers
+ResourceFilter = Callable[[Dict[str, Any]], bool]
+
+
+def parse_ndjson_block(block: bytes, resource_filter: Optional[ResourceFilter] = None,
+                       elements: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Parses a block of complete NDJSON lines, skipping blank lines, and keeps the resources that pass the filter
+
+    :param elements: if set, keep only these top level elements of each resource, like _elements does on the server
+    """
+    resources: List[Dict[str, Any]] = json_codec.parse_ndjson_lines(block)
+    if resource_filter is not None:
+        resources = [resource for resource in resources if resource_filter(resource)]
+    if elements is not None:
+        resources = [{key: resource[key] for key in elements if key in resource} for resource in resources]
+    return resources
+
+
+class NdjsonParseStage:
+    """
+    Parses streamed NDJSON in a pool of worker processes so the event loop only reads sockets.
+
+    submit() takes the bytes as they arrive, cuts them at the last newline so every block holds complete lines,
+    and sends the block to the pool.  At most max_in_flight blocks are being parsed at once: when the window is
+    full, submit() waits for the oldest block, so a stream that arrives faster than we can parse slows down
+    the reads instead of piling up memory.  Parsed blocks are handed to on_parsed in the order they were submitted.
+
+    The parsed resources are pickled back from the workers, and unpickling whole resources costs the event loop
+    almost as much as parsing them, so drop what you do not need in the worker with resource_filter and elements.
+    With max_workers=0 the blocks are parsed on the event loop, to compare against.
+    """
+
+    def __init__(self, on_parsed: Callable[[List[Dict[str, Any]]], Awaitable[None]],
+                 max_workers: Optional[int] = None, max_in_flight: Optional[int] = None,
+                 resource_filter: Optional[ResourceFilter] = None, elements: Optional[List[str]] = None) -> None:
+        """
+        :param on_parsed: called with the resources of each block, in order
+        :param max_workers: number of worker processes (default: one per core), or 0 to parse on the event loop
+        :param max_in_flight: maximum number of blocks sent to the pool and not yet handed to on_parsed
+                              (default: two per worker so every worker has the next block waiting)
+        :param resource_filter: module level function that returns True for the resources to keep
+        :param elements: top level elements to keep of each resource, e.g. ["id", "meta"]; None keeps them all
+        """
+        self.on_parsed: Callable[[List[Dict[str, Any]]], Awaitable[None]] = on_parsed
+        self.max_workers: int = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        self.max_in_flight: int = max_in_flight or 2 * max(1, self.max_workers)
+        self.resource_filter: Optional[ResourceFilter] = resource_filter
+        self.elements: Optional[List[str]] = elements
+        self.blocks_submitted: int = 0
+        self.resources_parsed: int = 0
+        # time submit() spent waiting for a free slot in the window
+        self.wait_seconds: float = 0.0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._in_flight: Deque["asyncio.Future[List[Dict[str, Any]]]"] = deque()
+        # an incomplete last line, completed by the next submit()
+        self._remainder: bytearray = bytearray()
+
+    def start(self) -> "NdjsonParseStage":
+        if self.max_workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    async def submit(self, data: bytes) -> None:
+        """
+        Adds the next bytes of the stream; they do not have to end at a line boundary
+        """
+        self._remainder += data
+        block_end: int = self._remainder.rfind(b"\n") + 1
+        if block_end == 0:
+            return
+        block: bytes = bytes(self._remainder[:block_end])
+        del self._remainder[:block_end]
+        await self._submit_block(block)
+
+    async def close(self) -> None:
+        """
+        Parses what is left, waits until every block has been handed to on_parsed and stops the workers
+        """
+        try:
+            if self._remainder.strip():
+                await self._submit_block(bytes(self._remainder))
+            self._remainder.clear()
+            while self._in_flight:
+                await self._deliver_oldest()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    async def __aenter__(self) -> "NdjsonParseStage":
+        return self.start()
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    def report(self) -> str:
+        where: str = f"{self.max_workers} worker processes" if self.max_workers > 0 else "the event loop"
+        return (f"Parsed {self.resources_parsed:,} resources in {self.blocks_submitted:,} blocks on {where},"
+                f" waited {self.wait_seconds:.2f}s for the window of {self.max_in_flight}")
+
+    async def _submit_block(self, block: bytes) -> None:
+        self.blocks_submitted += 1
+        if self._executor is None:
+            resources: List[Dict[str, Any]] = parse_ndjson_block(block, self.resource_filter, self.elements)
+            self.resources_parsed += len(resources)
+            await self.on_parsed(resources)
+            return
+        if len(self._in_flight) >= self.max_in_flight:
+            wait_start: float = time.perf_counter()
+            while len(self._in_flight) >= self.max_in_flight:
+                await self._deliver_oldest()
+            self.wait_seconds += time.perf_counter() - wait_start
+        self._in_flight.append(
+            asyncio.get_event_loop().run_in_executor(self._executor, parse_ndjson_block, block,
+                                                     self.resource_filter, self.elements)
+        )
+        # hand over the blocks at the head that are already done, without waiting for the others
+        while self._in_flight and self._in_flight[0].done():
+            await self._deliver_oldest()
+
+    async def _deliver_oldest(self) -> None:
+        resources: List[Dict[str, Any]] = await self._in_flight.popleft()
+        self.resources_parsed += len(resources)
+        await self.on_parsed(resources)
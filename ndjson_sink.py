@@ -0,0 +1,271 @@
+import gzip
+import hashlib
+import os
+import zlib
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+import json_codec
+from file_writer_thread import FileWriterThread
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@contextmanager
+def open_ndjson_file(file_path: str) -> Iterator[BinaryIO]:
+    """
+    Opens an NDJSON file written by a sink for reading, decompressing .gz and .zst files
+    """
+    with open(file_path, mode='rb') as file:
+        if file_path.endswith(".gz"):
+            with gzip.GzipFile(fileobj=file) as gzip_file:
+                yield gzip_file
+        elif file_path.endswith(".zst"):
+            assert zstandard is not None, "pip install zstandard to read zstd files"
+            with zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True) as zstd_file:
+                yield zstd_file
+        else:
+            yield file
+
+
+def parse_ndjson(data: bytes) -> List[Dict[str, Any]]:
+    """
+    Parses NDJSON bytes into resources.  Only call this when a consumer actually needs Python objects.
+
+    :param data: one or more complete NDJSON lines
+    :return: list of resources
+    """
+    return json_codec.parse_ndjson_lines(data)
+
+
+class NdjsonFileSink:
+    """
+    Writes resources to an NDJSON file (one resource per line) as they arrive.
+    Only counters are kept in memory so memory stays flat no matter how many resources are written.
+
+    The file is written by a FileWriterThread: writes are queued and coalesced into large writes on one thread,
+    and writers wait when more than max_queued_bytes are queued, so a slow disk slows down the downloads.
+    """
+
+    def __init__(self, file_path: str, append: bool = False, flush_interval_seconds: float = 1.0,
+                 max_queued_bytes: int = 32 * 1024 * 1024, checksum: bool = False) -> None:
+        """
+        :param file_path: path of the NDJSON file to write
+        :param append: append to an existing file (e.g. when resuming) instead of overwriting it
+        :param flush_interval_seconds: longest time written data waits in memory for more before going to the file
+        :param max_queued_bytes: bytes waiting for the writer thread before writers have to wait
+        :param checksum: keep a sha256 of the file as it is written (see sha256)
+        """
+        self.file_path: str = file_path
+        self.append: bool = append
+        self.flush_interval_seconds: float = flush_interval_seconds
+        self.max_queued_bytes: int = max_queued_bytes
+        self.checksum: bool = checksum
+        self.resource_count: int = 0
+        self.total_bytes: int = 0
+        self._file: Optional[BinaryIO] = None
+        # updated by the writer thread with the bytes it writes
+        self._digest: Optional[Any] = None
+        # kept after close() so its counters can still be read
+        self._writer: Optional[FileWriterThread] = None
+
+    async def open(self) -> "NdjsonFileSink":
+        offset: int = os.path.getsize(self.file_path) if self.append and os.path.exists(self.file_path) else 0
+        if self.checksum:
+            self._digest = hashlib.sha256()
+            if offset:
+                # the checksum covers the whole file, including what was there before we appended
+                with open(self.file_path, mode='rb') as existing_file:
+                    for block in iter(lambda: existing_file.read(1024 * 1024), b""):
+                        self._digest.update(block)
+        self._file = open(self.file_path, mode='ab' if self.append else 'wb')
+        self._writer = self._create_writer(self._file, offset)
+        return self
+
+    @property
+    def offset(self) -> int:
+        """
+        Position in the file after the last completed write, including anything there before we opened it
+        """
+        return self._writer.offset if self._writer else 0
+
+    @property
+    def sha256(self) -> Optional[str]:
+        """
+        Hex sha256 of the file up to offset, if checksum is set
+        """
+        return self._digest.hexdigest() if self._digest else None
+
+    @property
+    def write_count(self) -> int:
+        """
+        Number of writes to the file so far
+        """
+        return self._writer.write_count if self._writer else 0
+
+    @property
+    def backpressure_seconds(self) -> float:
+        """
+        Time writers waited for the writer thread to catch up
+        """
+        return self._writer.backpressure_seconds if self._writer else 0.0
+
+    async def write_resources(self, resources: List[Dict[str, Any]]) -> int:
+        """
+        Writes a batch of resources as NDJSON lines
+
+        :param resources: resources to write
+        :return: number of bytes written
+        """
+        assert self._file, "open() must be called before writing"
+        if not resources:
+            return 0
+        lines: bytes = json_codec.dumps_ndjson(resources)
+        await self._write(lines)
+        self.resource_count += len(resources)
+        return len(lines)
+
+    async def write_bytes(self, data: bytes) -> int:
+        """
+        Writes NDJSON bytes exactly as they were received from the server, without parsing them.
+        Records are counted by counting the non-empty lines in the raw bytes.
+
+        :param data: one or more complete NDJSON lines
+        :return: number of bytes written
+        """
+        assert self._file, "open() must be called before writing"
+        if not data:
+            return 0
+        if not data.endswith(b"\n"):
+            # the last line of a response may not be terminated and would run into the next response
+            data += b"\n"
+        await self._write(data)
+        # a blank line, e.g. the keep-alive of a stream, is not a resource; check_coverage() skips them too
+        self.resource_count += sum(1 for line in data.split(b"\n") if line.strip())
+        return len(data)
+
+    async def _write(self, data: bytes) -> None:
+        assert self._writer
+        await self._writer.write(data)
+        self.total_bytes += len(data)
+
+    async def sync(self) -> int:
+        """
+        Writes, flushes and fsyncs everything written so far so it survives a crash
+
+        :return: offset up to which the file is durable; safe to truncate back to on resume
+        """
+        assert self._writer
+        return await self._writer.sync()
+
+    async def close(self) -> None:
+        if self._writer and self._file:
+            try:
+                await self._writer.close()
+            finally:
+                self._file.close()
+                self._file = None
+
+    async def __aenter__(self) -> "NdjsonFileSink":
+        return await self.open()
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    def _create_writer(self, file: BinaryIO, offset: int) -> FileWriterThread:
+        return FileWriterThread(file, offset=offset, max_queued_bytes=self.max_queued_bytes,
+                                flush_interval_seconds=self.flush_interval_seconds, digest=self._digest,
+                                name="ndjson-writer")
+
+
+class CompressedNdjsonFileSink(NdjsonFileSink):
+    """
+    NDJSON sink that writes gzip or zstd.  The writer thread compresses each coalesced block before writing it,
+    so the event loop keeps reading from the sockets while the thread compresses (zlib and zstandard release
+    the GIL), and compressing large blocks is cheaper than compressing every batch on its own.
+
+    sync() ends the current gzip member / zstd frame before fsyncing, so the file is always a sequence of
+    complete members up to the offset it returns.  Both formats allow concatenated members, so truncating
+    back to that offset on resume and appending new members gives a valid file.
+    """
+
+    def __init__(self, file_path: str, append: bool = False, compression: str = "gzip",
+                 level: Optional[int] = None, flush_interval_seconds: float = 1.0,
+                 max_queued_bytes: int = 32 * 1024 * 1024, checksum: bool = False) -> None:
+        """
+        :param file_path: path of the compressed file to write
+        :param append: append to an existing file (e.g. when resuming) instead of overwriting it
+        :param compression: "gzip" or "zstd" (needs the zstandard package)
+        :param level: compression level; defaults to 6 for gzip and 3 for zstd
+        :param flush_interval_seconds: longest time written data waits in memory for more before it is compressed
+        :param max_queued_bytes: uncompressed bytes waiting for the writer thread before writers have to wait
+        :param checksum: keep a sha256 of the compressed file as it is written (see sha256)
+        """
+        super().__init__(file_path=file_path, append=append, flush_interval_seconds=flush_interval_seconds,
+                         max_queued_bytes=max_queued_bytes, checksum=checksum)
+        assert compression in ["gzip", "zstd"], f"Unknown compression {compression}"
+        assert compression != "zstd" or zstandard is not None, "pip install zstandard to write zstd files"
+        self.compression: str = compression
+        self.level: int = level if level is not None else (6 if compression == "gzip" else 3)
+        self._compressor: Optional[Any] = None
+
+    @property
+    def compression_ratio(self) -> float:
+        """
+        Uncompressed bytes per byte in the file
+        """
+        return self.total_bytes / self.offset if self.offset else 0.0
+
+    def _create_writer(self, file: BinaryIO, offset: int) -> FileWriterThread:
+        self._compressor = self._create_compressor()
+        return FileWriterThread(file, offset=offset, max_queued_bytes=self.max_queued_bytes,
+                                flush_interval_seconds=self.flush_interval_seconds,
+                                encode=self._compress, finish=self._end_member, digest=self._digest,
+                                name="ndjson-compress")
+
+    def _create_compressor(self) -> Any:
+        if self.compression == "gzip":
+            # wbits=31 writes a gzip header and trailer
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def _compress(self, data: bytes) -> bytes:
+        # runs on the writer thread
+        assert self._compressor
+        return self._compressor.compress(data)
+
+    def _end_member(self) -> bytes:
+        # runs on the writer thread
+        assert self._compressor
+        compressed: bytes = (self._compressor.flush() if self.compression == "gzip"
+                             else self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+        self._compressor = self._create_compressor()
+        return compressed
+
+
+def create_ndjson_sink(file_path: str, append: bool = False, compression_level: Optional[int] = None,
+                       flush_interval_seconds: float = 1.0, max_queued_bytes: int = 32 * 1024 * 1024,
+                       checksum: bool = False) -> NdjsonFileSink:
+    """
+    Creates a sink for file_path, compressed if the name ends in .gz or .zst
+
+    :param file_path: path of the file to write
+    :param append: append to an existing file instead of overwriting it
+    :param compression_level: compression level for compressed files
+    :param flush_interval_seconds: longest time written data waits in memory for more before going to the file
+    :param max_queued_bytes: bytes waiting for the writer thread before writers have to wait
+    :param checksum: keep a sha256 of the file as it is written
+    """
+    if file_path.endswith(".gz"):
+        return CompressedNdjsonFileSink(file_path, append=append, compression="gzip", level=compression_level,
+                                        flush_interval_seconds=flush_interval_seconds,
+                                        max_queued_bytes=max_queued_bytes, checksum=checksum)
+    if file_path.endswith(".zst"):
+        return CompressedNdjsonFileSink(file_path, append=append, compression="zstd", level=compression_level,
+                                        flush_interval_seconds=flush_interval_seconds,
+                                        max_queued_bytes=max_queued_bytes, checksum=checksum)
+    return NdjsonFileSink(file_path, append=append, flush_interval_seconds=flush_interval_seconds,
+                          max_queued_bytes=max_queued_bytes, checksum=checksum)
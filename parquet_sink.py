@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import json_codec
+from ndjson_sink import open_ndjson_file
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# column name -> where the value is in the resource: keys separated by dots, with a list index to take one element
+# ("agent.0.who.reference") or * to take all of them as a list column ("entity.*.what.reference"), optionally
+# followed by the type of the column, :string (the default), :timestamp, :bool or :int
+AUDIT_EVENT_PROJECTION: Dict[str, str] = {
+    "id": "id",
+    "last_updated": "meta.lastUpdated:timestamp",
+    "security_codes": "meta.security.*.code",
+    "type_code": "type.code",
+    "type_display": "type.display",
+    "subtype_codes": "subtype.*.code",
+    "action": "action",
+    "recorded": "recorded:timestamp",
+    "outcome": "outcome",
+    "agent_who": "agent.0.who.reference",
+    "agent_alt_id": "agent.0.altId",
+    "agent_requestor": "agent.0.requestor:bool",
+    "agent_network_address": "agent.0.network.address",
+    "source_site": "source.site",
+    "source_observer": "source.observer.reference",
+    "entity_what": "entity.*.what.reference"
+}
+
+COLUMN_TYPES: List[str] = ["string", "timestamp", "bool", "int"]
+
+
+class ParquetColumn:
+    """
+    One column of a projection: pulls its value out of each resource and turns the values of a row group into
+    an Arrow array
+    """
+
+    def __init__(self, name: str, spec: str) -> None:
+        """
+        :param name: name of the column
+        :param spec: path of the value and optionally its type, e.g. "meta.lastUpdated:timestamp"
+        """
+        path, _, column_type = spec.partition(":")
+        self.name: str = name
+        self.keys: List[str] = path.split(".")
+        self.column_type: str = column_type or "string"
+        assert self.column_type in COLUMN_TYPES, f"Unknown type {self.column_type} of column {name}"
+        assert self.keys.count("*") <= 1, f"Column {name} can only take all elements of one list"
+        self.repeated: bool = "*" in self.keys
+        # the keys up to the list of a repeated column and from its elements to the value, list indexes as int
+        keys: List[Union[str, int]] = [int(key) if key.isdigit() else key for key in self.keys]
+        self._path: List[Union[str, int]] = keys[:keys.index("*")] if self.repeated else keys
+        self._element_path: List[Union[str, int]] = keys[keys.index("*") + 1:] if self.repeated else []
+
+    @property
+    def arrow_type(self) -> Any:
+        value_type: Any = {
+            "string": pyarrow.string(),
+            # FHIR instants have a time zone and up to microseconds
+            "timestamp": pyarrow.timestamp("us", tz="UTC"),
+            "bool": pyarrow.bool_(),
+            "int": pyarrow.int64()
+        }[self.column_type]
+        return pyarrow.list_(value_type) if self.repeated else value_type
+
+    def extract(self, resource: Dict[str, Any]) -> Any:
+        value: Any = self._follow(resource, self._path)
+        if not self.repeated:
+            return None if value is None else self._convert(value)
+        if not isinstance(value, list):
+            return None
+        elements: List[Any] = [self._follow(element, self._element_path) for element in value]
+        return [self._convert(element) for element in elements if element is not None]
+
+    def to_array(self, values: List[Any]) -> Any:
+        if self.column_type != "timestamp":
+            return pyarrow.array(values, type=self.arrow_type)
+        strings: Any = pyarrow.array(values, type=pyarrow.list_(pyarrow.string()) if self.repeated
+                                     else pyarrow.string())
+        try:
+            return strings.cast(self.arrow_type)
+        except pyarrow.ArrowInvalid:
+            # a value without a time zone or otherwise not an instant; leave those empty instead of failing the batch
+            return pyarrow.array([self._cast_or_none(value) for value in values], type=self.arrow_type)
+
+    def _cast_or_none(self, value: Any) -> Any:
+        if isinstance(value, list):
+            return [self._cast_or_none(element) for element in value]
+        try:
+            return pyarrow.scalar(value, type=pyarrow.string()).cast(pyarrow.timestamp("us", tz="UTC")).as_py()
+        except (pyarrow.ArrowInvalid, TypeError):
+            return None
+
+    @staticmethod
+    def _follow(value: Any, path: List[Union[str, int]]) -> Any:
+        # runs for every column of every resource, so missing keys are caught instead of checked for
+        try:
+            for key in path:
+                value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return value
+
+    def _convert(self, value: Any) -> Any:
+        # values of the wrong type are left empty so one odd resource cannot fail a row group
+        if self.column_type == "bool":
+            return value if isinstance(value, bool) else None
+        if self.column_type == "int":
+            return value if isinstance(value, int) and not isinstance(value, bool) else None
+        if type(value) is str:
+            return value
+        # e.g. a CodeableConcept where a code was expected: keep it as JSON
+        return json_codec.dumps(value).decode("utf-8")
+
+
+class ParquetFileSink:
+    """
+    Writes resources to a Parquet file, flattened into the columns of a projection (AUDIT_EVENT_PROJECTION by
+    default), so analytics can read the export without parsing the NDJSON again.
+
+    The values of each column are collected in lists until row_group_size resources have been written, then
+    turned into Arrow arrays and written as one row group on a worker thread while the next row group is being
+    collected.  Memory is bounded by two row groups whatever the size of the export.
+
+    Parquet files cannot be appended to, so a resumed export has to convert its NDJSON output afterwards
+    (python parquet_sink.py output.ndjson output.parquet).  Needs pyarrow (pip install pyarrow).
+    """
+
+    def __init__(self, file_path: str, projection: Optional[Dict[str, str]] = None,
+                 row_group_size: int = 100_000, compression: str = "zstd") -> None:
+        """
+        :param file_path: path of the Parquet file to write
+        :param projection: column name -> path of its value in the resource (see AUDIT_EVENT_PROJECTION)
+        :param row_group_size: resources per row group
+        :param compression: Parquet compression codec, e.g. zstd, snappy or none
+        """
+        assert pyarrow is not None, "pip install pyarrow to write Parquet files"
+        self.file_path: str = file_path
+        self.columns: List[ParquetColumn] = [
+            ParquetColumn(name, spec) for name, spec in (projection or AUDIT_EVENT_PROJECTION).items()
+        ]
+        self.row_group_size: int = row_group_size
+        self.compression: str = compression
+        self.resource_count: int = 0
+        self.row_group_count: int = 0
+        # values of the row group being collected, one list per column
+        self._values: List[List[Any]] = [[] for _ in self.columns]
+        self._writer: Optional[Any] = None
+        # one thread so row groups are written in order
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._row_group_being_written: Optional["asyncio.Future[None]"] = None
+
+    async def open(self) -> "ParquetFileSink":
+        schema: Any = pyarrow.schema([(column.name, column.arrow_type) for column in self.columns])
+        self._writer = pyarrow.parquet.ParquetWriter(self.file_path, schema, compression=self.compression)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parquet-writer")
+        return self
+
+    @property
+    def offset(self) -> int:
+        """
+        Size of the file so far; the footer is only written by close()
+        """
+        return os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+
+    async def write_resources(self, resources: List[Dict[str, Any]]) -> None:
+        """
+        Adds the projected values of the resources to the row group, writing it once it is full
+        """
+        assert self._writer, "open() must be called before writing"
+        start: int = 0
+        while start < len(resources):
+            # fill the row group column by column, which keeps the inner loop tight
+            end: int = min(len(resources), start + self.row_group_size - len(self._values[0]))
+            for column, values in zip(self.columns, self._values):
+                extract: Callable[[Dict[str, Any]], Any] = column.extract
+                values.extend([extract(resource) for resource in resources[start:end]])
+            self.resource_count += end - start
+            start = end
+            if len(self._values[0]) >= self.row_group_size:
+                await self._write_row_group()
+
+    async def write_bytes(self, data: bytes) -> None:
+        """
+        Adds the resources of complete NDJSON lines, e.g. as streamed by the server
+        """
+        await self.write_resources(json_codec.parse_ndjson_lines(data))
+
+    async def close(self) -> None:
+        if not self._writer or not self._executor:
+            return
+        try:
+            if self._values[0]:
+                await self._write_row_group()
+            if self._row_group_being_written:
+                await self._row_group_being_written
+        finally:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._writer.close)
+            self._executor.shutdown(wait=True)
+            self._writer = None
+            self._executor = None
+
+    async def __aenter__(self) -> "ParquetFileSink":
+        return await self.open()
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    async def _write_row_group(self) -> None:
+        # at most one row group is being written while the next one is collected
+        if self._row_group_being_written:
+            await self._row_group_being_written
+        values: List[List[Any]] = self._values
+        self._values = [[] for _ in self.columns]
+        self._row_group_being_written = asyncio.get_event_loop().run_in_executor(
+            self._executor, self._write_values, values
+        )
+        self.row_group_count += 1
+
+    def _write_values(self, values: List[List[Any]]) -> None:
+        # runs on the writer thread; building the arrays and compressing release the GIL for the most part
+        assert self._writer
+        table: Any = pyarrow.Table.from_arrays(
+            [column.to_array(column_values) for column, column_values in zip(self.columns, values)],
+            schema=self._writer.schema
+        )
+        self._writer.write_table(table, row_group_size=table.num_rows)
+
+
+async def convert(input_files: List[str], output_file: str, row_group_size: int,
+                  compression: str) -> ParquetFileSink:
+    """
+    Writes the resources of NDJSON files (.ndjson, .gz or .zst), e.g. the shards of one export, to one Parquet
+    file with AUDIT_EVENT_PROJECTION
+    """
+    async with ParquetFileSink(output_file, row_group_size=row_group_size, compression=compression) as sink:
+        for input_file in input_files:
+            with open_ndjson_file(input_file) as file:
+                # the zstandard reader cannot be iterated by line, so read blocks and split them after the last
+                # complete line
+                partial_line: bytes = b""
+                for block in iter(lambda: file.read(4 * 1024 * 1024), b""):
+                    block = partial_line + block
+                    end: int = block.rfind(b"\n") + 1
+                    partial_line = block[end:]
+                    if end:
+                        await sink.write_bytes(block[:end])
+                if partial_line.strip():
+                    await sink.write_bytes(partial_line)
+    return sink
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts an NDJSON export of AuditEvents to Parquet")
+    parser.add_argument("input_files", nargs="+", help="NDJSON files, optionally compressed (.gz, .zst)")
+    parser.add_argument("output_file", help="Parquet file to write")
+    parser.add_argument("--row-group-size", type=int, default=100_000, help="resources per row group")
+    parser.add_argument("--compression", default="zstd", help="Parquet compression codec, e.g. zstd or snappy")
+    args = parser.parse_args()
+
+    converted: ParquetFileSink = asyncio.run(convert(args.input_files, args.output_file,
+                                                     row_group_size=args.row_group_size,
+                                                     compression=args.compression))
+    print(f"Wrote {converted.resource_count:,} resources in {converted.row_group_count} row groups"
+          f" to {args.output_file} ({os.path.getsize(args.output_file):,} bytes)")
@@ -0,0 +1,147 @@
+import asyncio
+import sys
+import time
+from datetime import timedelta
+from typing import Any, List, Optional, TextIO
+
+
+class ProgressCounter:
+    """
+    Count and bytes of one kind of item (ids, chunks, resources).  add() is all the download callbacks call,
+    so it only does a few additions; rates and ETA are worked out by the reporter when it renders.
+    """
+
+    def __init__(self, name: str, expected_from: Optional["ProgressCounter"] = None,
+                 show_bytes: bool = False, visible: bool = True) -> None:
+        """
+        :param name: label shown in the progress line
+        :param expected_from: counter whose count is the number of items we expect, e.g. ids for resources
+        :param show_bytes: show MB and KB/sec
+        :param visible: show the counter on the progress line; a hidden counter only counts
+        """
+        self.name: str = name
+        self.expected_from: Optional[ProgressCounter] = expected_from
+        self.show_bytes: bool = show_bytes
+        self.visible: bool = visible
+        self.count: int = 0
+        self.total_bytes: int = 0
+        self.start_time: Optional[float] = None
+
+    def add(self, count: int = 1, byte_count: int = 0) -> None:
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.count += count
+        self.total_bytes += byte_count
+
+    def render(self, now: float) -> str:
+        assert self.start_time is not None
+        elapsed_seconds: float = now - self.start_time
+        per_second: float = self.count / elapsed_seconds if elapsed_seconds > 0 else 0.0
+        text: str
+        if self.expected_from is not None:
+            text = f"{self.name}: [{self.count:,} / {self.expected_from.count:,}]"
+        else:
+            text = f"{self.name}: [{self.count:,}]"
+        text += f" {timedelta(seconds=int(elapsed_seconds))} {self.name}/sec={per_second:,.0f}"
+        if self.show_bytes:
+            kilo_bytes_per_sec: float = self.total_bytes / (elapsed_seconds * 1024) if elapsed_seconds > 0 else 0.0
+            text += f" MB={self.total_bytes / (1024 * 1024):,.0f} KB/sec={kilo_bytes_per_sec:,.0f}"
+        if self.expected_from is not None and per_second > 0:
+            remaining: int = max(0, self.expected_from.count - self.count)
+            text += f" Remaining={timedelta(seconds=int(remaining / per_second))}"
+        return text
+
+
+class ProgressReporter:
+    """
+    Renders the progress counters on one status line at a fixed rate from a background task,
+    so terminal writes cost the same whether the server sends ten chunks a second or ten thousand.
+
+    Messages such as "slice done" go through log() so they print above the status line.
+    In quiet mode nothing is written to the output at all; errors still go to stderr.
+    """
+
+    def __init__(self, interval_in_seconds: float = 0.5, quiet: bool = False, output: TextIO = sys.stdout) -> None:
+        """
+        :param interval_in_seconds: how often to redraw the status line
+        :param quiet: write nothing
+        :param output: where to write
+        """
+        self.interval_in_seconds: float = interval_in_seconds
+        self.quiet: bool = quiet
+        self.output: TextIO = output
+        self.counters: List[ProgressCounter] = []
+        self._render_task: Optional["asyncio.Task[None]"] = None
+        self._last_line_length: int = 0
+
+    def counter(self, name: str, expected_from: Optional[ProgressCounter] = None,
+                show_bytes: bool = False, visible: bool = True) -> ProgressCounter:
+        """
+        Creates a counter that is shown on the status line once it has counted something
+        """
+        progress_counter: ProgressCounter = ProgressCounter(name=name, expected_from=expected_from,
+                                                            show_bytes=show_bytes, visible=visible)
+        self.counters.append(progress_counter)
+        return progress_counter
+
+    def start(self) -> "ProgressReporter":
+        if not self.quiet and self._render_task is None:
+            self._render_task = asyncio.ensure_future(self._render_periodically())
+        return self
+
+    async def stop(self) -> None:
+        """
+        Stops the background task and leaves the final status on its own line
+        """
+        if self._render_task is not None:
+            self._render_task.cancel()
+            try:
+                await self._render_task
+            except asyncio.CancelledError:
+                pass
+            self._render_task = None
+            self.render()
+            self.output.write("\n")
+            self.output.flush()
+            self._last_line_length = 0
+
+    def log(self, message: str) -> None:
+        """
+        Writes a message on its own line; the status line is redrawn below it on the next tick
+        """
+        if self.quiet:
+            return
+        self._clear_status_line()
+        self.output.write(message + "\n")
+        self.output.flush()
+
+    def error(self, message: str) -> None:
+        if not self.quiet:
+            self._clear_status_line()
+        print(message, file=sys.stderr)
+
+    def render(self) -> None:
+        now: float = time.time()
+        line: str = " | ".join(
+            counter.render(now) for counter in self.counters if counter.visible and counter.start_time is not None
+        )
+        # pad with spaces to overwrite the end of a longer previous line
+        self.output.write("\r" + line.ljust(self._last_line_length))
+        self.output.flush()
+        self._last_line_length = len(line)
+
+    async def __aenter__(self) -> "ProgressReporter":
+        return self.start()
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.stop()
+
+    async def _render_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_in_seconds)
+            self.render()
+
+    def _clear_status_line(self) -> None:
+        if self._last_line_length:
+            self.output.write("\r" + " " * self._last_line_length + "\r")
+            self._last_line_length = 0
@@ -0,0 +1,188 @@
+import math
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+from aiohttp import ClientSession, TraceConfig
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations in logarithmic buckets, each bucket 10% wider than the previous one.
+
+    Recording is a log() and a list increment, so it is cheap enough to call for every chunk of a response,
+    and percentiles are accurate to within the 10% bucket width no matter how many values were recorded.
+    """
+
+    # smallest duration that gets its own bucket; anything faster lands in bucket 0
+    minimum_seconds: float = 0.0001
+    growth_factor: float = 1.1
+    # enough buckets to go from 0.1ms to over an hour
+    number_of_buckets: int = 190
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.counts: List[int] = [0] * self.number_of_buckets
+        self.count: int = 0
+        self.total_seconds: float = 0.0
+        self.max_seconds: float = 0.0
+        self._log_growth_factor: float = math.log(self.growth_factor)
+
+    def record(self, seconds: float) -> None:
+        bucket: int = 0
+        if seconds > self.minimum_seconds:
+            bucket = min(self.number_of_buckets - 1,
+                         int(math.log(seconds / self.minimum_seconds) / self._log_growth_factor) + 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def bucket_upper_bound(self, bucket: int) -> float:
+        return float(self.minimum_seconds * self.growth_factor ** bucket)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the given percentile (0-100), capped at the maximum seen
+        """
+        if self.count == 0:
+            return 0.0
+        rank: int = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen: int = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.bucket_upper_bound(bucket), self.max_seconds)
+        return self.max_seconds
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.mean_seconds,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max_seconds
+        }
+
+    def report(self) -> str:
+        return (f"{self.name:<16} {self.count:>10,} {self.percentile(50) * 1000:>10.1f}"
+                f" {self.percentile(90) * 1000:>10.1f} {self.percentile(99) * 1000:>10.1f}"
+                f" {self.max_seconds * 1000:>10.1f}")
+
+
+class RequestTracer:
+    """
+    Records where the time of every aiohttp request goes, from the TraceConfig hooks:
+
+    - dns: host name resolution (only when the DNS cache misses)
+    - connect: opening a new connection, not counting dns.  aiohttp has no separate TLS hook, so for https
+      this is TCP connect plus the TLS handshake.  Requests on a reused keep-alive connection have no connect time.
+    - first byte: from sending the request to receiving the response headers, i.e. mostly the server
+      running the query and opening its cursor
+    - chunk gap: between consecutive chunks of the response body (the first one measured from the headers),
+      i.e. how fast the server streams and how fast our loop reads.  aiohttp only fires
+      on_response_chunk_received from response.read(), so loops over response.content have to call the
+      function returned by chunk_timer() for every chunk instead.
+
+    Pass trace_config to the ClientSession (or HttpSessionPool) and print report() at the end of the run.
+    """
+
+    def __init__(self) -> None:
+        self.dns: LatencyHistogram = LatencyHistogram("dns")
+        self.connect: LatencyHistogram = LatencyHistogram("connect (+tls)")
+        self.first_byte: LatencyHistogram = LatencyHistogram("first byte")
+        self.chunk_gap: LatencyHistogram = LatencyHistogram("chunk gap")
+        self.exceptions: int = 0
+        self.trace_config: TraceConfig = TraceConfig()
+        self.trace_config.on_request_start.append(self._on_request_start)
+        self.trace_config.on_dns_resolvehost_start.append(self._on_dns_resolvehost_start)
+        self.trace_config.on_dns_resolvehost_end.append(self._on_dns_resolvehost_end)
+        self.trace_config.on_connection_create_start.append(self._on_connection_create_start)
+        self.trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        self.trace_config.on_request_end.append(self._on_request_end)
+        self.trace_config.on_response_chunk_received.append(self._on_response_chunk_received)
+        self.trace_config.on_request_exception.append(self._on_request_exception)
+
+    @property
+    def histograms(self) -> List[LatencyHistogram]:
+        return [self.dns, self.connect, self.first_byte, self.chunk_gap]
+
+    def chunk_timer(self) -> Callable[[], None]:
+        """
+        Returns a function to call for every chunk read from one response body, starting now
+        (call this right after the response headers have arrived)
+        """
+        last_chunk_time: List[float] = [time.perf_counter()]
+
+        def on_chunk() -> None:
+            now: float = time.perf_counter()
+            self.chunk_gap.record(now - last_chunk_time[0])
+            last_chunk_time[0] = now
+
+        return on_chunk
+
+    def to_dict(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {histogram.name: histogram.to_dict() for histogram in self.histograms}
+        result["exceptions"] = self.exceptions
+        return result
+
+    def report(self) -> str:
+        lines: List[str] = [f"{'Latency (ms)':<16} {'count':>10} {'p50':>10} {'p90':>10} {'p99':>10} {'max':>10}"]
+        lines.extend(histogram.report() for histogram in self.histograms)
+        lines.append(f"request exceptions: {self.exceptions:,}")
+        return "\n".join(lines)
+
+    # noinspection PyUnusedLocal
+    async def _on_request_start(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                params: Any) -> None:
+        trace_config_ctx.request_start = time.perf_counter()
+
+    # noinspection PyUnusedLocal
+    async def _on_dns_resolvehost_start(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                        params: Any) -> None:
+        trace_config_ctx.dns_start = time.perf_counter()
+
+    # noinspection PyUnusedLocal
+    async def _on_dns_resolvehost_end(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                      params: Any) -> None:
+        trace_config_ctx.dns_seconds = time.perf_counter() - trace_config_ctx.dns_start
+        self.dns.record(trace_config_ctx.dns_seconds)
+
+    # noinspection PyUnusedLocal
+    async def _on_connection_create_start(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                          params: Any) -> None:
+        trace_config_ctx.connect_start = time.perf_counter()
+
+    # noinspection PyUnusedLocal
+    async def _on_connection_create_end(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                        params: Any) -> None:
+        # aiohttp resolves the host inside connection create
+        self.connect.record(time.perf_counter() - trace_config_ctx.connect_start
+                            - getattr(trace_config_ctx, "dns_seconds", 0.0))
+
+    # noinspection PyUnusedLocal
+    async def _on_request_end(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                              params: Any) -> None:
+        # aiohttp calls this once the response headers have been read, before the body
+        now: float = time.perf_counter()
+        self.first_byte.record(now - trace_config_ctx.request_start)
+        trace_config_ctx.last_chunk_time = now
+
+    # noinspection PyUnusedLocal
+    async def _on_response_chunk_received(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                          params: Any) -> None:
+        # only fired by response.read(), with the whole body as one chunk
+        now: float = time.perf_counter()
+        self.chunk_gap.record(now - trace_config_ctx.last_chunk_time)
+        trace_config_ctx.last_chunk_time = now
+
+    # noinspection PyUnusedLocal
+    async def _on_request_exception(self, session: ClientSession, trace_config_ctx: SimpleNamespace,
+                                    params: Any) -> None:
+        self.exceptions += 1
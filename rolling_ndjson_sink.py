@@ -0,0 +1,324 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import json_codec
+from ndjson_sink import NdjsonFileSink, create_ndjson_sink, open_ndjson_file
+
+
+def manifest_file_for(file_path: str) -> str:
+    """
+    Returns the manifest of the shards of file_path, e.g. output.ndjson.gz -> output.manifest.json
+    """
+    directory, base_name = os.path.split(file_path)
+    return os.path.join(directory, f"{base_name.partition('.')[0]}.manifest.json")
+
+
+def shard_file_for(file_path: str, shard_number: int) -> str:
+    """
+    Returns the name of a shard of file_path, e.g. output.ndjson.gz -> output-00003.ndjson.gz
+    """
+    directory, base_name = os.path.split(file_path)
+    stem, dot, extensions = base_name.partition(".")
+    return os.path.join(directory, f"{stem}-{shard_number:05d}{dot}{extensions}")
+
+
+def measure_ndjson(file_path: str) -> Tuple[int, int]:
+    """
+    Counts the non-empty NDJSON lines and uncompressed bytes of a file, decompressing .gz and .zst files
+
+    :return: lines, bytes
+    """
+    with open_ndjson_file(file_path) as file:
+        lines: int = 0
+        size: int = 0
+        # the line cut by the end of a block, finished by the next one
+        partial_line: bytes = b""
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            block_lines: List[bytes] = (partial_line + block).split(b"\n")
+            partial_line = block_lines.pop()
+            # counted like NdjsonFileSink.write_bytes() counts them
+            lines += sum(1 for line in block_lines if line.strip())
+            size += len(block)
+        return lines, size
+
+
+def read_manifest(file_path: str) -> Dict[str, Any]:
+    with open(manifest_file_for(file_path), mode='rb') as file:
+        manifest: Dict[str, Any] = json_codec.loads(file.read())
+        return manifest
+
+
+def write_manifest(file_path: str, manifest: Dict[str, Any]) -> None:
+    manifest_file: str = manifest_file_for(file_path)
+    temporary_file: str = f"{manifest_file}.tmp"
+    with open(temporary_file, mode='wb') as file:
+        file.write(json_codec.dumps(manifest, indent=True))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file, manifest_file)
+
+
+def truncate_shards_to_committed_offset(file_path: str, committed_offset: int) -> int:
+    """
+    Cuts the shards of file_path back to committed_offset, counted over the shards in order, like
+    checkpoint_journal.truncate_to_committed_offset does for a single file: shards after it are removed and the
+    shard it falls into is truncated and reopened by the next RollingNdjsonSink(append=True)
+
+    :return: number of bytes removed
+    """
+    if not os.path.exists(manifest_file_for(file_path)):
+        assert committed_offset == 0, \
+            f"{manifest_file_for(file_path)} is missing but the checkpoint expects {committed_offset} bytes"
+        return 0
+    manifest: Dict[str, Any] = read_manifest(file_path)
+    directory: str = os.path.dirname(file_path)
+    kept_shards: List[Dict[str, Any]] = []
+    shard_start: int = 0
+    bytes_removed: int = 0
+    for shard in manifest["shards"]:
+        shard_file: str = os.path.join(directory, shard["file"])
+        size: int = os.path.getsize(shard_file) if os.path.exists(shard_file) else 0
+        if shard_start >= committed_offset:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+            bytes_removed += size
+            continue
+        shard_end: int = shard_start + shard["bytes"]
+        shard_size: int = min(shard_end, committed_offset) - shard_start
+        assert size >= shard_size, f"{shard_file} is shorter ({size}) than the checkpoint ({shard_size})"
+        os.truncate(shard_file, shard_size)
+        bytes_removed += size - shard_size
+        if shard_size < shard["bytes"]:
+            # the manifest was written after the checkpoint; the lines up to the checkpoint have to be counted
+            shard = {**shard, "records": measure_ndjson(shard_file)[0], "bytes": shard_size, "sha256": None}
+        kept_shards.append(shard)
+        shard_start = shard_end
+    write_manifest(file_path, {**manifest, "complete": False, "shards": kept_shards})
+    return bytes_removed
+
+
+class RollingNdjsonSink:
+    """
+    Writes NDJSON into a series of files instead of one, e.g. output-00000.ndjson, output-00001.ndjson, ...
+    starting a new file when the current one holds max_shard_bytes (before compression) or max_shard_records,
+    so downstream jobs can read the shards in parallel without splitting one large file first.  Shards end at
+    line boundaries, so each one is valid NDJSON on its own.
+
+    output.manifest.json lists every shard with its records, bytes and sha256 (computed by the writer thread
+    as the shard is written).  It is rewritten whenever a shard is finished and on every sync(), and has
+    "complete": true once the sink is closed.  The shard being written has no sha256 yet.
+
+    Has the same interface as NdjsonFileSink.  offset counts the bytes of all shards in order, so a checkpoint
+    can commit it and truncate_shards_to_committed_offset() can cut the shards back to it on resume.
+    """
+
+    def __init__(self, file_path: str, append: bool = False, max_shard_bytes: Optional[int] = None,
+                 max_shard_records: Optional[int] = None, compression_level: Optional[int] = None,
+                 flush_interval_seconds: float = 1.0, max_queued_bytes: int = 32 * 1024 * 1024) -> None:
+        """
+        :param file_path: name the shards are derived from, e.g. output.ndjson; end it in .gz or .zst to compress
+        :param append: continue the shards in the manifest (e.g. when resuming) instead of starting over
+        :param max_shard_bytes: uncompressed bytes per shard; a line longer than this gets a shard of its own
+        :param max_shard_records: lines per shard
+        :param compression_level: compression level for compressed shards
+        :param flush_interval_seconds: longest time written data waits in memory for more before going to the file
+        :param max_queued_bytes: bytes waiting for the writer thread before writers have to wait
+        """
+        assert max_shard_bytes or max_shard_records, "set max_shard_bytes, max_shard_records or both"
+        self.file_path: str = file_path
+        self.manifest_file: str = manifest_file_for(file_path)
+        self.append: bool = append
+        self.max_shard_bytes: Optional[int] = max_shard_bytes
+        self.max_shard_records: Optional[int] = max_shard_records
+        self.compression_level: Optional[int] = compression_level
+        self.flush_interval_seconds: float = flush_interval_seconds
+        self.max_queued_bytes: int = max_queued_bytes
+        # the manifest entries of all shards, the last one being written if _current is set
+        self.shards: List[Dict[str, Any]] = []
+        # counters of the shards written and closed by this sink
+        self._closed_resource_count: int = 0
+        self._closed_total_bytes: int = 0
+        self._closed_write_count: int = 0
+        self._closed_backpressure_seconds: float = 0.0
+        self._current: Optional[NdjsonFileSink] = None
+        # records and bytes the current shard had when it was reopened
+        self._current_base_records: int = 0
+        self._current_base_bytes: int = 0
+        # writers wait while a shard is finished and the next one opened
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    async def open(self) -> "RollingNdjsonSink":
+        directory: str = os.path.dirname(self.file_path)
+        if os.path.exists(self.manifest_file):
+            previous_shards: List[Dict[str, Any]] = read_manifest(self.file_path)["shards"]
+            if self.append:
+                self.shards = previous_shards
+                if self.shards and self.shards[-1]["sha256"] is None:
+                    await self._open_shard(self.shards[-1], append=True)
+            else:
+                # a new export must not leave shards of an older, larger one behind
+                for shard in previous_shards:
+                    shard_file: str = os.path.join(directory, shard["file"])
+                    if os.path.exists(shard_file):
+                        os.remove(shard_file)
+        await self._write_manifest(complete=False)
+        return self
+
+    @property
+    def resource_count(self) -> int:
+        return self._closed_resource_count + (self._current.resource_count if self._current else 0)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._closed_total_bytes + (self._current.total_bytes if self._current else 0)
+
+    @property
+    def offset(self) -> int:
+        """
+        Bytes in all shards after the last completed write, including anything there before we opened them
+        """
+        finished_bytes: int = sum(shard["bytes"] for shard in (self.shards[:-1] if self._current else self.shards))
+        return finished_bytes + (self._current.offset if self._current else 0)
+
+    @property
+    def write_count(self) -> int:
+        return self._closed_write_count + (self._current.write_count if self._current else 0)
+
+    @property
+    def backpressure_seconds(self) -> float:
+        return self._closed_backpressure_seconds + (self._current.backpressure_seconds if self._current else 0.0)
+
+    async def write_resources(self, resources: List[Dict[str, Any]]) -> int:
+        """
+        Writes a batch of resources as NDJSON lines
+
+        :return: number of bytes written
+        """
+        if not resources:
+            return 0
+        return await self.write_bytes(json_codec.dumps_ndjson(resources))
+
+    async def write_bytes(self, data: bytes) -> int:
+        """
+        Writes NDJSON bytes as they were received, starting new shards at line boundaries as they fill up
+
+        :param data: one or more complete NDJSON lines
+        :return: number of bytes written
+        """
+        if not data:
+            return 0
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        async with self._lock:
+            remaining: bytes = data
+            while remaining:
+                if self._current is None:
+                    await self._open_shard({"file": os.path.basename(shard_file_for(self.file_path,
+                                                                                       len(self.shards))),
+                                            "records": 0, "bytes": 0, "sha256": None}, append=False)
+                assert self._current
+                fitting_bytes: int = self._fitting_bytes(remaining)
+                await self._current.write_bytes(remaining[:fitting_bytes])
+                remaining = remaining[fitting_bytes:]
+                if remaining or self._is_full():
+                    await self._finish_shard()
+        return len(data)
+
+    async def sync(self) -> int:
+        """
+        Fsyncs the shard being written and records it in the manifest
+
+        :return: offset over all shards up to which they are durable; safe to truncate back to on resume
+        """
+        async with self._lock:
+            if self._current:
+                records: int = self._current_base_records + self._current.resource_count
+                self.shards[-1].update(bytes=await self._current.sync(), records=records)
+            await self._write_manifest(complete=False)
+            return self.offset
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._current:
+                await self._finish_shard()
+            await self._write_manifest(complete=True)
+
+    async def __aenter__(self) -> "RollingNdjsonSink":
+        return await self.open()
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    def _fitting_bytes(self, data: bytes) -> int:
+        """
+        :return: length of the leading lines of data that fit into the current shard; at least one line if the
+                 shard is empty
+        """
+        assert self._current
+        end: int = len(data)
+        if self.max_shard_bytes:
+            room_bytes: int = self.max_shard_bytes - self._current_base_bytes - self._current.total_bytes
+            if room_bytes < end:
+                end = data.rfind(b"\n", 0, max(room_bytes, 0)) + 1
+        if self.max_shard_records:
+            room_records: int = self.max_shard_records - self._current_base_records - self._current.resource_count
+            if data.count(b"\n", 0, end) > room_records:
+                end = 0
+                for _ in range(room_records):
+                    end = data.find(b"\n", end) + 1
+        if end == 0 and self._current.total_bytes == 0 and self._current_base_bytes == 0:
+            end = data.find(b"\n") + 1
+        return end
+
+    def _is_full(self) -> bool:
+        assert self._current
+        return bool((self.max_shard_bytes and
+                     self._current_base_bytes + self._current.total_bytes >= self.max_shard_bytes) or
+                    (self.max_shard_records and
+                     self._current_base_records + self._current.resource_count >= self.max_shard_records))
+
+    async def _open_shard(self, shard: Dict[str, Any], append: bool) -> None:
+        if not append:
+            self.shards.append(shard)
+        shard_file: str = os.path.join(os.path.dirname(self.file_path), shard["file"])
+        self._current_base_records = shard["records"]
+        self._current_base_bytes = 0
+        if append and os.path.exists(shard_file):
+            # max_shard_bytes counts uncompressed bytes; reading a compressed shard back takes a while
+            self._current_base_bytes = (
+                await asyncio.get_event_loop().run_in_executor(None, measure_ndjson, shard_file)
+            )[1]
+        self._current = await create_ndjson_sink(shard_file, append=append, compression_level=self.compression_level,
+                                                 flush_interval_seconds=self.flush_interval_seconds,
+                                                 max_queued_bytes=self.max_queued_bytes, checksum=True).open()
+        # every shard file is in the manifest before anything is written to it, so a resume can find it
+        await self._write_manifest(complete=False)
+
+    async def _finish_shard(self) -> None:
+        sink: Optional[NdjsonFileSink] = self._current
+        assert sink
+        records: int = self._current_base_records + sink.resource_count
+        await sink.sync()
+        await sink.close()
+        self.shards[-1].update(records=records, bytes=sink.offset, sha256=sink.sha256)
+        self._current = None
+        self._closed_resource_count += sink.resource_count
+        self._closed_total_bytes += sink.total_bytes
+        self._closed_write_count += sink.write_count
+        self._closed_backpressure_seconds += sink.backpressure_seconds
+        await self._write_manifest(complete=False)
+
+    async def _write_manifest(self, complete: bool) -> None:
+        # written and fsynced on a worker thread so downloads keep going while a shard rolls over; the callers
+        # hold the lock (or run before any write), so only one manifest is written at a time
+        manifest: Dict[str, Any] = {
+            "complete": complete,
+            "records": sum(shard["records"] for shard in self.shards),
+            "bytes": sum(shard["bytes"] for shard in self.shards),
+            "max_shard_bytes": self.max_shard_bytes,
+            "max_shard_records": self.max_shard_records,
+            # a copy, since the entry of the current shard changes while the thread writes
+            "shards": [dict(shard) for shard in self.shards]
+        }
+        await asyncio.get_event_loop().run_in_executor(None, write_manifest, self.file_path, manifest)
@@ -0,0 +1,144 @@
+import resource
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from concurrency_controller import percentile
+
+
+def get_peak_rss_in_mb() -> float:
+    """
+    Returns the peak resident set size of this process in MB
+    """
+    peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+
+class RunMetrics:
+    """
+    Timings for one download run, filled in by the load_data() functions of the scripts and
+    written out by benchmark_suite.py.
+
+    Chunk latency is the time between consecutive chunks (the first one is measured from the first byte),
+    which is what we wait on while the server streams.
+
+    Bytes are counted after decompression; wire bytes are what came over the network, which is less when the
+    response was compressed.  CPU seconds are for the whole process, decompress seconds only for decoding.
+    """
+
+    def __init__(self) -> None:
+        self.start_time: Optional[float] = None
+        self.first_byte_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.status: Optional[int] = None
+        self.resource_count: int = 0
+        self.byte_count: int = 0
+        self.wire_byte_count: int = 0
+        self.decompress_seconds: float = 0.0
+        self.start_cpu_time: Optional[float] = None
+        self.end_cpu_time: Optional[float] = None
+        self.chunk_count: int = 0
+        self.chunk_latencies: List[float] = []
+        self._last_chunk_time: Optional[float] = None
+
+    def start(self) -> None:
+        """
+        Call just before sending the request
+        """
+        self.start_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+
+    def record_first_byte(self, status: Optional[int] = None) -> None:
+        """
+        Call when the response headers have been received
+        """
+        if self.first_byte_time is None:
+            self.first_byte_time = time.perf_counter()
+            self._last_chunk_time = self.first_byte_time
+        if status is not None:
+            self.status = status
+
+    def record_chunk(self, byte_count: int, resource_count: int = 0, wire_byte_count: Optional[int] = None) -> None:
+        """
+        Call for every chunk of the body as it arrives
+
+        :param byte_count: decoded bytes in the chunk
+        :param resource_count: resources (lines) in the chunk
+        :param wire_byte_count: bytes received for the chunk if it was compressed, otherwise byte_count
+        """
+        now: float = time.perf_counter()
+        if self.first_byte_time is None:
+            self.record_first_byte()
+        assert self._last_chunk_time is not None
+        self.chunk_latencies.append(now - self._last_chunk_time)
+        self._last_chunk_time = now
+        self.chunk_count += 1
+        self.byte_count += byte_count
+        self.wire_byte_count += wire_byte_count if wire_byte_count is not None else byte_count
+        self.resource_count += resource_count
+
+    def record_decompression(self, cpu_seconds: float) -> None:
+        """
+        Call with the CPU time a StreamingDecompressor spent decoding the body
+        """
+        self.decompress_seconds += cpu_seconds
+
+    def finish(self) -> None:
+        self.end_time = time.perf_counter()
+        self.end_cpu_time = time.process_time()
+
+    @property
+    def time_to_first_byte(self) -> Optional[float]:
+        if self.start_time is None or self.first_byte_time is None:
+            return None
+        return self.first_byte_time - self.start_time
+
+    @property
+    def total_seconds(self) -> Optional[float]:
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    @property
+    def resources_per_second(self) -> float:
+        return self.resource_count / self.total_seconds if self.total_seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.byte_count / (1024 * 1024) / self.total_seconds if self.total_seconds else 0.0
+
+    @property
+    def wire_mb_per_second(self) -> float:
+        return self.wire_byte_count / (1024 * 1024) / self.total_seconds if self.total_seconds else 0.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.byte_count / self.wire_byte_count if self.wire_byte_count else 0.0
+
+    @property
+    def cpu_seconds(self) -> Optional[float]:
+        if self.start_cpu_time is None or self.end_cpu_time is None:
+            return None
+        return self.end_cpu_time - self.start_cpu_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "time_to_first_byte": self.time_to_first_byte,
+            "total_seconds": self.total_seconds,
+            "resources": self.resource_count,
+            "bytes": self.byte_count,
+            "wire_bytes": self.wire_byte_count,
+            "compression_ratio": self.compression_ratio,
+            "chunks": self.chunk_count,
+            "resources_per_second": self.resources_per_second,
+            "mb_per_second": self.mb_per_second,
+            "wire_mb_per_second": self.wire_mb_per_second,
+            "cpu_seconds": self.cpu_seconds,
+            "decompress_cpu_seconds": self.decompress_seconds,
+            "chunk_latency_p50": percentile(self.chunk_latencies, 50),
+            "chunk_latency_p95": percentile(self.chunk_latencies, 95),
+            "chunk_latency_p99": percentile(self.chunk_latencies, 99),
+            "peak_rss_mb": get_peak_rss_in_mb()
+        }
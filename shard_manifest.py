@@ -0,0 +1,219 @@
+import os
+import socket
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import json_codec
+
+
+class Shard:
+    """
+    One unit of work of a sharded export: the resources of one type last updated in [start, end)
+    """
+
+    def __init__(self, shard_id: str, resource_type: str, start: datetime, end: datetime) -> None:
+        self.shard_id: str = shard_id
+        self.resource_type: str = resource_type
+        self.start: datetime = start
+        self.end: datetime = end
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "shard_id": self.shard_id,
+            "resource_type": self.resource_type,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat()
+        }
+
+    @staticmethod
+    def from_dict(entry: Dict[str, Any]) -> "Shard":
+        return Shard(shard_id=entry["shard_id"], resource_type=entry["resource_type"],
+                     start=datetime.fromisoformat(entry["start"]), end=datetime.fromisoformat(entry["end"]))
+
+
+class ShardManifest:
+    """
+    The shards of an export and who is working on them, kept as files in a directory that every worker can see,
+    e.g. on a shared filesystem, so workers on several hosts need nothing but the directory to coordinate:
+
+        manifest.json           what to export and the list of shards, written once by the coordinator
+        leases/<shard>.json     the worker that has claimed a shard and until when; renewed while it works
+        done/<shard>.json       written once when a shard is complete: worker, output file, resource count
+        shards/                 shard outputs, one file per shard and worker
+
+    Leases and completion records are published by writing a temporary file and hard linking it into place,
+    which fails if the target exists, so exactly one worker wins a shard or completes it even when two race.
+    A lease that has expired (its worker died or hung) can be taken over by another worker.
+    Expiry uses the wall clock, so the clocks of the hosts must roughly agree (within lease_seconds).
+    """
+
+    def __init__(self, directory: str) -> None:
+        """
+        :param directory: directory holding the manifest; shared by the coordinator and every worker
+        """
+        self.directory: str = directory
+        self.manifest_file: str = os.path.join(directory, "manifest.json")
+        self.leases_directory: str = os.path.join(directory, "leases")
+        self.done_directory: str = os.path.join(directory, "done")
+        self.shards_directory: str = os.path.join(directory, "shards")
+        self.settings: Dict[str, Any] = {}
+        self.shards: List[Shard] = []
+
+    def create(self, settings: Dict[str, Any], shards: List[Shard]) -> "ShardManifest":
+        """
+        Writes the manifest; fails if the directory already has one, so a running export is never replanned
+        """
+        for directory in [self.directory, self.leases_directory, self.done_directory, self.shards_directory]:
+            os.makedirs(directory, exist_ok=True)
+        self.settings = settings
+        self.shards = shards
+        manifest: Dict[str, Any] = {**settings, "shards": [shard.to_dict() for shard in shards]}
+        if not self._publish(self.manifest_file, manifest):
+            raise FileExistsError(f"{self.manifest_file} already exists")
+        return self
+
+    def load(self) -> "ShardManifest":
+        manifest: Dict[str, Any] = self._read(self.manifest_file)
+        self.shards = [Shard.from_dict(entry) for entry in manifest.pop("shards")]
+        self.settings = manifest
+        return self
+
+    def is_done(self, shard: Shard) -> bool:
+        return os.path.exists(self._done_file(shard))
+
+    def get_done_record(self, shard: Shard) -> Optional[Dict[str, Any]]:
+        return self._read(self._done_file(shard)) if self.is_done(shard) else None
+
+    def get_lease(self, shard: Shard) -> Optional[Dict[str, Any]]:
+        try:
+            return self._read(self._lease_file(shard))
+        except (FileNotFoundError, ValueError):
+            # a lease that is being replaced or was half written counts as no lease
+            return None
+
+    def claim_next(self, worker_id: str, lease_seconds: float, skip: Optional[List[str]] = None) -> Optional[Shard]:
+        """
+        Claims the first shard that is neither done nor leased by a live worker
+
+        :param worker_id: name of this worker, unique across hosts
+        :param lease_seconds: how long the lease is valid unless renewed
+        :param skip: ids of shards not to claim, e.g. ones this worker already failed
+        :return: the claimed shard, or None if there is nothing to claim right now
+        """
+        for shard in self.shards:
+            if (skip and shard.shard_id in skip) or self.is_done(shard):
+                continue
+            lease: Optional[Dict[str, Any]] = self.get_lease(shard)
+            if lease is not None:
+                if lease["expires_at"] > time.time():
+                    continue
+                if not self._break_lease(shard, lease):
+                    continue
+            if self._publish(self._lease_file(shard), self._lease(worker_id, lease_seconds)) and \
+                    not self.is_done(shard):
+                return shard
+        return None
+
+    def renew(self, shard: Shard, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Extends the lease of a shard this worker holds
+
+        :return: False if the lease has been taken over by another worker
+        """
+        lease: Optional[Dict[str, Any]] = self.get_lease(shard)
+        if lease is None or lease["worker"] != worker_id:
+            return False
+        self._write(self._lease_file(shard), self._lease(worker_id, lease_seconds))
+        return True
+
+    def release(self, shard: Shard, worker_id: str) -> None:
+        """
+        Gives up the lease of a shard this worker holds, e.g. after it failed, so another worker can retry it
+        """
+        lease: Optional[Dict[str, Any]] = self.get_lease(shard)
+        if lease is not None and lease["worker"] == worker_id:
+            self._remove(self._lease_file(shard))
+
+    def complete(self, shard: Shard, worker_id: str, record: Dict[str, Any]) -> bool:
+        """
+        Records the shard as done with this worker's output
+
+        :return: False if another worker completed it first; this worker's output should then be discarded
+        """
+        completed: bool = self._publish(self._done_file(shard), {"worker": worker_id, "completed": time.time(),
+                                                                 **record})
+        self.release(shard, worker_id)
+        return completed
+
+    def shard_output_file(self, shard: Shard, worker_id: str, extension: str = "ndjson") -> str:
+        return os.path.join(self.shards_directory, f"{shard.shard_id}.{worker_id}.{extension}")
+
+    def _lease_file(self, shard: Shard) -> str:
+        return os.path.join(self.leases_directory, f"{shard.shard_id}.json")
+
+    def _done_file(self, shard: Shard) -> str:
+        return os.path.join(self.done_directory, f"{shard.shard_id}.json")
+
+    @staticmethod
+    def _lease(worker_id: str, lease_seconds: float) -> Dict[str, Any]:
+        return {"worker": worker_id, "expires_at": time.time() + lease_seconds}
+
+    def _break_lease(self, shard: Shard, expired_lease: Dict[str, Any]) -> bool:
+        """
+        Removes an expired lease.  Renaming it away is atomic, so of several workers breaking the same lease
+        only one succeeds; the others see it gone.
+        """
+        broken_file: str = f"{self._lease_file(shard)}.expired.{os.getpid()}.{time.time():.0f}"
+        try:
+            os.rename(self._lease_file(shard), broken_file)
+        except FileNotFoundError:
+            return False
+        lease: Dict[str, Any] = self._read(broken_file)
+        self._remove(broken_file)
+        # the worker may have renewed in the meantime; then it keeps the shard
+        if lease != expired_lease and lease["expires_at"] > time.time():
+            self._publish(self._lease_file(shard), lease)
+            return False
+        return True
+
+    def _publish(self, file_path: str, content: Dict[str, Any]) -> bool:
+        """
+        Creates file_path with content unless it exists, atomically
+
+        :return: whether this call created it
+        """
+        temporary_file_path: str = self._write_temporary(file_path, content)
+        try:
+            os.link(temporary_file_path, file_path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            self._remove(temporary_file_path)
+
+    def _write(self, file_path: str, content: Dict[str, Any]) -> None:
+        os.replace(self._write_temporary(file_path, content), file_path)
+
+    @staticmethod
+    def _write_temporary(file_path: str, content: Dict[str, Any]) -> str:
+        # unique per process so workers sharing the directory never write the same temporary file
+        temporary_file_path: str = f"{file_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(temporary_file_path, mode='wb') as file:
+            file.write(json_codec.dumps(content, indent=True))
+            file.flush()
+            os.fsync(file.fileno())
+        return temporary_file_path
+
+    @staticmethod
+    def _read(file_path: str) -> Dict[str, Any]:
+        with open(file_path, mode='rb') as file:
+            content: Dict[str, Any] = json_codec.loads(file.read())
+            return content
+
+    @staticmethod
+    def _remove(file_path: str) -> None:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
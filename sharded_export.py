@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import json_codec
+from main import ResourceDownloader, file_name_for_resource_type, server_url_for, split_date_range
+from shard_manifest import Shard, ShardManifest
+
+
+def plan(manifest: ShardManifest, resource_types: List[str], fhir_server: Optional[str] = None,
+         start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+         shards_per_type: int = 16, slices_per_shard: int = 4) -> ShardManifest:
+    """
+    Coordinator: splits the export of each resource type into shards_per_type contiguous _lastUpdated ranges
+    and writes them to the manifest.  The server and window default to the ones configured in main.py.
+
+    :param slices_per_shard: number_of_slices of the downloader that exports one shard
+    """
+    defaults: ResourceDownloader = ResourceDownloader(quiet=True, resource_types=resource_types)
+    start_date = start_date or defaults.start_date
+    end_date = end_date or defaults.end_date
+    shards: List[Shard] = [
+        Shard(shard_id=f"{resource_type}-{shard_index:04d}", resource_type=resource_type,
+              start=shard_start, end=shard_end)
+        for resource_type in resource_types
+        for shard_index, (shard_start, shard_end) in enumerate(split_date_range(start_date, end_date,
+                                                                                shards_per_type))
+    ]
+    settings: Dict[str, Any] = {
+        "fhir_server": fhir_server or defaults.fhir_server,
+        "resource_types": resource_types,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "slices_per_shard": slices_per_shard,
+        "created": time.time()
+    }
+    manifest.create(settings, shards)
+    print(f"Planned {len(shards)} shards of {', '.join(resource_types)} from {start_date} to {end_date}"
+          f" on {settings['fhir_server']} in {manifest.directory}")
+    return manifest
+
+
+def create_shard_downloader(manifest: ShardManifest, shard: Shard, output_file: str,
+                            concurrent_requests: int) -> ResourceDownloader:
+    """
+    Returns a downloader for just the window of one shard.  A shard is small and is retried as a whole, so the
+    downloader keeps no checkpoint, id index or concurrency history, which would be shared by every worker.
+    """
+    downloader: ResourceDownloader = ResourceDownloader(quiet=True, resource_types=[shard.resource_type])
+    downloader.fhir_server = manifest.settings["fhir_server"]
+    downloader.server_url = server_url_for(downloader.fhir_server)
+    downloader.start_date = shard.start
+    downloader.end_date = shard.end
+    downloader.number_of_slices = manifest.settings["slices_per_shard"]
+    downloader.concurrent_requests = concurrent_requests
+    downloader.use_adaptive_concurrency = False
+    downloader.use_checkpoint = False
+    downloader.use_id_index = False
+    downloader.output_file = output_file
+    downloader.ids_output_file = f"{output_file}.ids"
+    return downloader
+
+
+async def keep_lease(manifest: ShardManifest, shard: Shard, worker_id: str, lease_seconds: float) -> None:
+    """
+    Renews the lease on shard three times per lease_seconds until cancelled or another worker takes it over
+    """
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        if not manifest.renew(shard, worker_id, lease_seconds):
+            print(f"[{worker_id}] lost the lease on {shard.shard_id}", flush=True)
+            return
+
+
+async def export_shard(manifest: ShardManifest, shard: Shard, worker_id: str, lease_seconds: float,
+                       concurrent_requests: int) -> bool:
+    """
+    Exports one claimed shard and records it as done
+
+    :return: whether the shard is done, by this or another worker
+    """
+    output_file: str = manifest.shard_output_file(shard, worker_id)
+    downloader: ResourceDownloader = create_shard_downloader(manifest, shard, output_file, concurrent_requests)
+    print(f"[{worker_id}] exporting {shard.shard_id}: {shard.resource_type} from {shard.start} to {shard.end}",
+          flush=True)
+    lease_keeper: asyncio.Future = asyncio.ensure_future(keep_lease(manifest, shard, worker_id, lease_seconds))
+    start: float = time.time()
+    failure: Optional[str] = None
+    try:
+        await downloader.load_data(worker_id)
+        metrics: Dict[str, Any] = downloader.type_metrics[shard.resource_type]
+        if downloader.error_count:
+            failure = f"{downloader.error_count} requests failed"
+        elif metrics["resources"] < metrics["ids"]:
+            # a page that came back short without an error would otherwise be recorded as a complete shard
+            failure = f"only {metrics['resources']:,} of the {metrics['ids']:,} ids listed were written"
+    except Exception as e:
+        failure = f"{type(e).__name__}: {e}"
+    finally:
+        lease_keeper.cancel()
+    seconds: float = time.time() - start
+    remove_file(downloader.ids_output_file)
+    if failure:
+        print(f"[{worker_id}] {shard.shard_id} failed after {seconds:.1f}s: {failure}", flush=True)
+        remove_file(output_file)
+        manifest.release(shard, worker_id)
+        return False
+    resource_count: int = downloader.type_metrics[shard.resource_type]["resources"]
+    record: Dict[str, Any] = {
+        "output_file": os.path.relpath(output_file, manifest.directory),
+        "resources": resource_count,
+        "bytes": os.path.getsize(output_file),
+        "seconds": seconds
+    }
+    if not manifest.complete(shard, worker_id, record):
+        print(f"[{worker_id}] {shard.shard_id} was completed by another worker, discarding {output_file}",
+              flush=True)
+        remove_file(output_file)
+        return True
+    print(f"[{worker_id}] {shard.shard_id} done: {resource_count:,} resources in {seconds:.1f}s", flush=True)
+    return True
+
+
+async def work(manifest: ShardManifest, worker_id: str, lease_seconds: float = 60,
+               concurrent_requests: int = 4, max_attempts: int = 3, poll_interval_seconds: float = 5) -> bool:
+    """
+    Worker: claims shards and exports them until every shard is done.  While shards are leased by other
+    workers it waits, so it can take over the ones whose worker dies.
+
+    :param concurrent_requests: parallel connections of this worker; the load on the server is the sum over workers
+    :param max_attempts: shards that failed this many times on this worker are left to the other workers
+    :return: whether every shard is done
+    """
+    attempts: Dict[str, int] = defaultdict(int)
+    while True:
+        given_up: List[str] = [shard_id for shard_id, count in attempts.items() if count >= max_attempts]
+        shard: Optional[Shard] = manifest.claim_next(worker_id, lease_seconds, skip=given_up)
+        if shard is None:
+            remaining: List[Shard] = [shard for shard in manifest.shards if not manifest.is_done(shard)]
+            if not remaining:
+                print(f"[{worker_id}] all {len(manifest.shards)} shards are done", flush=True)
+                return True
+            if all(shard.shard_id in given_up for shard in remaining):
+                print(f"[{worker_id}] giving up on {', '.join(shard.shard_id for shard in remaining)}", flush=True)
+                return False
+            await asyncio.sleep(poll_interval_seconds)
+            continue
+        if not await export_shard(manifest, shard, worker_id, lease_seconds, concurrent_requests):
+            attempts[shard.shard_id] += 1
+
+
+def check_coverage(manifest: ShardManifest, check_duplicates: bool = False) -> bool:
+    """
+    Checks that the done shards of each resource type cover the whole window without gaps or overlaps
+    and that every shard output is complete
+
+    :param check_duplicates: also read every output and check that no id appears in two shards of a type
+    :return: whether the export is complete
+    """
+    start_date: datetime = datetime.fromisoformat(manifest.settings["start_date"])
+    end_date: datetime = datetime.fromisoformat(manifest.settings["end_date"])
+    problems: List[str] = []
+    for resource_type in manifest.settings["resource_types"]:
+        shards: List[Shard] = sorted([shard for shard in manifest.shards if shard.resource_type == resource_type],
+                                     key=lambda shard: shard.start)
+        covered_until: datetime = start_date
+        resource_count: int = 0
+        ids: Dict[str, str] = {}
+        for shard in shards:
+            if shard.start != covered_until:
+                problems.append(f"{resource_type} is not covered from {covered_until} to {shard.start}"
+                                if shard.start > covered_until else
+                                f"{shard.shard_id} overlaps the previous shard from {shard.start} to {covered_until}")
+            covered_until = max(covered_until, shard.end)
+            record: Optional[Dict[str, Any]] = manifest.get_done_record(shard)
+            if record is None:
+                lease: Optional[Dict[str, Any]] = manifest.get_lease(shard)
+                problems.append(f"{shard.shard_id} ({shard.start} to {shard.end}) is not done"
+                                + (f", leased by {lease['worker']}" if lease else ""))
+                continue
+            output_file: str = os.path.join(manifest.directory, record["output_file"])
+            if not os.path.exists(output_file) or os.path.getsize(output_file) != record["bytes"]:
+                problems.append(f"{output_file} of {shard.shard_id} is missing or does not have"
+                                f" the {record['bytes']:,} bytes recorded")
+                continue
+            resource_count += record["resources"]
+            if check_duplicates:
+                with open(output_file, mode='rb') as file:
+                    for line in file:
+                        if not line.strip():
+                            continue
+                        resource_id: str = json_codec.loads(line)["id"]
+                        if resource_id in ids:
+                            problems.append(f"{resource_type}/{resource_id} is in {ids[resource_id]}"
+                                            f" and {shard.shard_id}")
+                        ids[resource_id] = shard.shard_id
+        if covered_until != end_date:
+            problems.append(f"{resource_type} is not covered from {covered_until} to {end_date}")
+        print(f"{resource_type}: {resource_count:,} resources in {len(shards)} shards")
+    for problem in problems:
+        print(f"=== {problem} ===")
+    print(f"Coverage of {start_date} to {end_date} is {'complete' if not problems else 'INCOMPLETE'}")
+    return not problems
+
+
+def merge(manifest: ShardManifest, output_file: str, check_duplicates: bool = False) -> bool:
+    """
+    Checks coverage and, if it is complete, removes the outputs of abandoned attempts and concatenates the shard
+    outputs of each resource type in time order into one file per type named after output_file,
+    e.g. output_Patient.ndjson
+
+    :return: whether the export is complete
+    """
+    if not check_coverage(manifest, check_duplicates=check_duplicates):
+        return False
+    # outputs of workers that died, or lost a race to complete a shard, are not in any done record
+    recorded_files: List[str] = [
+        os.path.join(manifest.directory, (manifest.get_done_record(shard) or {})["output_file"])
+        for shard in manifest.shards
+    ]
+    for file_name in os.listdir(manifest.shards_directory):
+        if os.path.join(manifest.shards_directory, file_name) not in recorded_files:
+            remove_file(os.path.join(manifest.shards_directory, file_name))
+    for resource_type in manifest.settings["resource_types"]:
+        type_output_file: str = file_name_for_resource_type(output_file, resource_type)
+        shards: List[Shard] = sorted([shard for shard in manifest.shards if shard.resource_type == resource_type],
+                                     key=lambda shard: shard.start)
+        with open(type_output_file, mode='wb') as file:
+            for shard in shards:
+                record: Dict[str, Any] = manifest.get_done_record(shard) or {}
+                with open(os.path.join(manifest.directory, record["output_file"]), mode='rb') as shard_file:
+                    shutil.copyfileobj(shard_file, file, 1024 * 1024)
+        print(f"Merged {len(shards)} shards into {type_output_file} ({os.path.getsize(type_output_file):,} bytes)")
+    return True
+
+
+def run_local(manifest_directory: str, workers: int, worker_args: List[str]) -> bool:
+    """
+    Runs workers worker processes on this host against the manifest and waits for them, to try out sharding
+    against e.g. mock_fhir_server.py without several machines
+    """
+    processes: List[subprocess.Popen] = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--manifest-dir", manifest_directory, "work",
+                          "--worker-id", f"{socket.gethostname()}-local{worker_number}"] + worker_args)
+        for worker_number in range(workers)
+    ]
+    return all([process.wait() == 0 for process in processes])
+
+
+def remove_file(file_path: str) -> None:
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Splits an export into shards by resource type and _lastUpdated range so workers on one or"
+                    " more hosts can export it together through a manifest directory on a shared filesystem"
+    )
+    parser.add_argument("--manifest-dir", default="export_shards",
+                        help="directory with the manifest, leases and shard outputs; shared by all workers")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    def add_plan_arguments(command_parser: argparse.ArgumentParser) -> None:
+        command_parser.add_argument("--resource-types", nargs="+", default=["AuditEvent"], metavar="RESOURCE_TYPE")
+        command_parser.add_argument("--fhir-server", help="host name or url (default: the one in main.py)")
+        command_parser.add_argument("--start", type=datetime.fromisoformat,
+                                    help="start of the _lastUpdated window, e.g. 2022-02-22 (default: main.py)")
+        command_parser.add_argument("--end", type=datetime.fromisoformat,
+                                    help="end of the _lastUpdated window, exclusive (default: main.py)")
+        command_parser.add_argument("--shards-per-type", type=int, default=16)
+        command_parser.add_argument("--slices-per-shard", type=int, default=4,
+                                    help="time slices each worker downloads in parallel within a shard")
+
+    def add_work_arguments(command_parser: argparse.ArgumentParser) -> None:
+        command_parser.add_argument("--lease-seconds", type=float, default=60,
+                                    help="a shard whose worker has not renewed its lease for this long is retried")
+        command_parser.add_argument("--concurrent-requests", type=int, default=4,
+                                    help="parallel connections of each worker")
+        command_parser.add_argument("--max-attempts", type=int, default=3,
+                                    help="attempts of a worker at one shard before it leaves it to the others")
+
+    def add_merge_arguments(command_parser: argparse.ArgumentParser) -> None:
+        command_parser.add_argument("--output-file", default="output.ndjson",
+                                    help="merged output, one file per resource type, e.g. output_AuditEvent.ndjson")
+        command_parser.add_argument("--check-duplicates", action="store_true",
+                                    help="also check that no resource id is in two shards of a type")
+
+    plan_parser = commands.add_parser("plan", help="write the shard manifest (coordinator)")
+    add_plan_arguments(plan_parser)
+    work_parser = commands.add_parser("work", help="claim and export shards until all are done (worker)")
+    work_parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}",
+                             help="unique across hosts (default: host name and process id)")
+    add_work_arguments(work_parser)
+    merge_parser = commands.add_parser("merge", help="check coverage and merge the shard outputs")
+    add_merge_arguments(merge_parser)
+    local_parser = commands.add_parser("local", help="plan (unless planned), run workers on this host, merge")
+    local_parser.add_argument("--workers", type=int, default=4)
+    add_plan_arguments(local_parser)
+    add_work_arguments(local_parser)
+    add_merge_arguments(local_parser)
+    args = parser.parse_args()
+
+    shard_manifest: ShardManifest = ShardManifest(args.manifest_dir)
+    succeeded: bool = True
+    if args.command in ["plan", "local"]:
+        if args.command == "local" and os.path.exists(shard_manifest.manifest_file):
+            print(f"Continuing the export planned in {shard_manifest.manifest_file}")
+        else:
+            plan(shard_manifest, resource_types=args.resource_types, fhir_server=args.fhir_server,
+                 start_date=args.start, end_date=args.end, shards_per_type=args.shards_per_type,
+                 slices_per_shard=args.slices_per_shard)
+    if args.command == "work":
+        succeeded = asyncio.run(work(shard_manifest.load(), worker_id=args.worker_id,
+                                     lease_seconds=args.lease_seconds, concurrent_requests=args.concurrent_requests,
+                                     max_attempts=args.max_attempts))
+    if args.command == "local":
+        succeeded = run_local(args.manifest_dir, args.workers,
+                              ["--lease-seconds", str(args.lease_seconds),
+                               "--concurrent-requests", str(args.concurrent_requests),
+                               "--max-attempts", str(args.max_attempts)])
+    if args.command in ["merge", "local"]:
+        succeeded = merge(shard_manifest.load(), output_file=args.output_file,
+                          check_duplicates=args.check_duplicates) and succeeded
+    sys.exit(0 if succeeded else 1)
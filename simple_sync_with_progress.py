@@ -1,15 +1,18 @@
 import asyncio
-import base64
-import json
 import os
-from typing import Dict, Any
 import time
 from datetime import datetime, timedelta
+from typing import Optional
 
 from dotenv import load_dotenv
-from furl import furl
 from requests import Session, Response
 from requests.exceptions import ChunkedEncodingError
+from urllib3.exceptions import ProtocolError
+
+import json_codec
+from run_metrics import RunMetrics
+from token_provider import get_access_token
+from transport_compression import StreamingDecompressor
 
 # from http.client import HTTPConnection, HTTPResponse
 # HTTPConnection.debuglevel = 1
@@ -17,55 +20,18 @@ from requests.exceptions import ChunkedEncodingError
 
 
 async def authenticate(client_id, client_secret, fhir_server_url):
-    full_uri: furl = furl(furl(fhir_server_url).origin)
-    full_uri /= ".well-known/smart-configuration"
-
-    # print(f"Calling {full_uri}")
-    with Session() as http:
-        response: Response = http.request(
-            "GET", str(full_uri)
-        )
-        response_json = json.loads(response.text)
-        auth_server_url = response_json["token_endpoint"]
-
     auth_scopes = ["user/AuditEvent.read", "access/medstar.*"]
-
-    login_token: str = base64.b64encode(
-        f"{client_id}:{client_secret}".encode("ascii")
-    ).decode("ascii")
-
-    payload: str = (
-        "grant_type=client_credentials&scope=" + "%20".join(auth_scopes)
-        if auth_scopes
-        else ""
-    )
-    # noinspection SpellCheckingInspection
-    headers: Dict[str, str] = {
-        "Accept": "application/json",
-        "Authorization": "Basic " + login_token,
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-
-    # print(f"Calling {auth_server_url}")
-    with Session() as http:
-        with http.request(
-                "POST", auth_server_url, headers=headers, data=payload
-        ) as response:
-            token_text: str = response.text
-            if not token_text:
-                return None
-            token_json: Dict[str, Any] = json.loads(token_text)
-
-            if "access_token" not in token_json:
-                raise Exception(f"No access token found in {token_json}")
-            access_token: str = token_json["access_token"]
-        return access_token
+    # the token endpoint and the access token are cached in process and on disk by the shared provider
+    return await get_access_token(fhir_server_url=fhir_server_url, client_id=client_id,
+                                  client_secret=client_secret, auth_scopes=auth_scopes)
 
 
 async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_atlas: bool, retrieve_only_ids: bool,
-                    use_access_index: bool = False):
+                    use_access_index: bool = False, metrics: Optional[RunMetrics] = None,
+                    use_compression: bool = False) -> RunMetrics:
     """
     loads data
+    :param use_compression: let the server compress the response; it is decompressed here chunk by chunk
     :param use_access_index:
     :param retrieve_only_ids:
     :type retrieve_only_ids:
@@ -74,11 +40,14 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     :param fhir_server:
     :type use_data_streaming:
     :param limit:
-    :return: None
+    :param metrics: timings of this run are recorded here.  If not passed, a new one is created.
+    :return: timings of this run
     """
     greater_than = "2022-02-22"
     less_than = "2022-02-24"
-    fhir_server_url = f"https://{fhir_server}/4_0_0/AuditEvent?_lastUpdated=gt{greater_than}&_lastUpdated=lt{less_than}&_count={limit}&_getpagesoffset=0"
+    # a url such as http://localhost:8080 (see mock_fhir_server.py) can be passed instead of a host name
+    fhir_server_base_url = fhir_server if "://" in fhir_server else f"https://{fhir_server}"
+    fhir_server_url = f"{fhir_server_base_url}/4_0_0/AuditEvent?_lastUpdated=gt{greater_than}&_lastUpdated=lt{less_than}&_count={limit}&_getpagesoffset=0"
     # fhir_server_url = f"https://{fhir_server}/4_0_0/AuditEvent?_lastUpdated=gt2022-04-20&_lastUpdated=lt2022-04-22&_elements=id&_count={limit}&_getpagesoffset=0"
     if retrieve_only_ids:
         fhir_server_url += "&_elements=id"
@@ -104,9 +73,10 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
         "Content-Type": "application/fhir+json",
         "Accept-Encoding": "gzip,deflate",
         "Authorization": f"Bearer {access_token}",
-        "Connection": "keep-alive",
-        "x-no-compression": "1"
+        "Connection": "keep-alive"
     }
+    if not use_compression:
+        headers["x-no-compression"] = "1"
 
     payload = {}
 
@@ -122,10 +92,14 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
         # print(f"logging_hook: Headers= {response1.headers}")
         pass
 
+    metrics = metrics or RunMetrics()
+    metrics.start()
     with Session() as http:
         http.hooks["response"] = [logging_hook]
 
         with http.request("GET", fhir_server_url, headers=headers, data=payload, stream=use_data_streaming) as response:
+            metrics.record_first_byte(response.status_code)
+            decompressor = StreamingDecompressor(response.headers.get("Content-Encoding"))
             if response.status_code == 200:
                 dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                 print(f"{dt_string}: Received response for {fhir_server_url} with Atlas={use_atlas}.")
@@ -144,20 +118,41 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
                             # for chunk in response.iter_content(chunk_size=None):
                             #     file.write(chunk)
                             #     file.flush()
-                            # if you want to receive data one line at a time
-                            line: bytes
-                            for line in response.iter_lines():
-                                # await asyncio.sleep(0)
-                                chunk_number += 1
-                                # dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                                chunk_end_time = time.time()
-                                file.write(line)
-                                # my_text = line.decode('utf-8')
-                                # chunk_number += my_text.count('\n')
-                                file.write("\n".encode('utf-8'))
-                                file.flush()
-                                print(f"[{chunk_number:,}] {timedelta(seconds=chunk_end_time - start_job)}", end='\r')
-                        except ChunkedEncodingError as e:
+                            if decompressor.is_compressed:
+                                # read the compressed bytes as they come off the socket and decompress them here,
+                                # so we can count the bytes on the wire and the CPU time of decompressing
+                                data: bytes
+                                for data in response.raw.stream(64 * 1024, decode_content=False):
+                                    decoded: bytes = bytes(decompressor.decompress(data))
+                                    file.write(decoded)
+                                    file.flush()
+                                    lines_in_chunk: int = decoded.count(b'\n')
+                                    chunk_number += lines_in_chunk
+                                    metrics.record_chunk(len(decoded), lines_in_chunk, len(data))
+                                    print(f"[{chunk_number:,}] {timedelta(seconds=time.time() - start_job)}",
+                                          end='\r')
+                                tail: bytes = decompressor.flush()
+                                file.write(tail)
+                                chunk_number += tail.count(b'\n')
+                                metrics.record_chunk(len(tail), tail.count(b'\n'), 0)
+                            else:
+                                # if you want to receive data one line at a time
+                                line: bytes
+                                for line in response.iter_lines():
+                                    # await asyncio.sleep(0)
+                                    chunk_number += 1
+                                    # dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                                    chunk_end_time = time.time()
+                                    file.write(line)
+                                    # my_text = line.decode('utf-8')
+                                    # chunk_number += my_text.count('\n')
+                                    file.write("\n".encode('utf-8'))
+                                    file.flush()
+                                    # iter_lines() hides the HTTP chunks so here each line counts as a chunk
+                                    metrics.record_chunk(len(line) + 1, 1)
+                                    print(f"[{chunk_number:,}] {timedelta(seconds=chunk_end_time - start_job)}",
+                                          end='\r')
+                        except (ChunkedEncodingError, ProtocolError) as e:
                             print("\n")
                             print(str(e))
                             print(response)
@@ -169,13 +164,22 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
                         #     dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                         #     print(f"[{chunk_number}] {dt_string}: {data}")
                     else:
+                        # requests has already decompressed the content; tell() is the number of bytes on the wire
+                        metrics.record_chunk(len(response.content), len(json_codec.loads(response.content).get("entry") or []),
+                                             response.raw.tell())
                         print(response.status_code)
                         print(response.text)
             else:
                 print(f"ERROR: {response.status_code} {response.text}")
+            metrics.record_decompression(decompressor.cpu_seconds)
+    metrics.finish()
     end_job = time.time()
     print(f"\n====== Received {chunk_number} resources in {timedelta(seconds=end_job - start_job)}"
           f" with Atlas={use_atlas} =======")
+    print(f"Content-Encoding={decompressor.content_encoding} wire MB={metrics.wire_byte_count / (1024 * 1024):,.1f}"
+          f" decoded MB={metrics.byte_count / (1024 * 1024):,.1f} ratio={metrics.compression_ratio:.1f}"
+          f" decompress cpu={metrics.decompress_seconds:.2f}s of {metrics.cpu_seconds:.2f}s")
+    return metrics
 
 
 # Press the green button in the gutter to run the script.
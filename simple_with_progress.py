@@ -1,66 +1,40 @@
+import argparse
 import asyncio
-import base64
-import json
 import os
-from typing import Dict, Any
 import time
 from datetime import datetime, timedelta
 
-from aiohttp import ClientSession, ClientResponse, ClientTimeout, TraceConfig
-from dotenv import load_dotenv
-from furl import furl
+from typing import Any, Dict, List, Optional, Set
 
+from aiohttp import ClientSession, ClientTimeout
+from dotenv import load_dotenv
 
-async def authenticate(client_id, client_secret, fhir_server_url):
-    full_uri: furl = furl(furl(fhir_server_url).origin)
-    full_uri /= ".well-known/smart-configuration"
+import json_codec
+from http_session_pool import HttpSessionPool
+from ndjson_parse_stage import NdjsonParseStage
+from request_tracing import RequestTracer
+from run_metrics import RunMetrics
+from token_provider import get_access_token
+from transport_compression import StreamingDecompressor
 
-    # print(f"Calling {full_uri}")
-    async with ClientSession() as http:
-        response: ClientResponse = await http.request(
-            "GET", str(full_uri), ssl=False
-        )
-        response_json = json.loads(await response.text())
-        auth_server_url = response_json["token_endpoint"]
 
+async def authenticate(client_id, client_secret, fhir_server_url, session: Optional[ClientSession] = None):
     auth_scopes = ["user/AuditEvent.read", "access/medstar.*"]
-
-    login_token: str = base64.b64encode(
-        f"{client_id}:{client_secret}".encode("ascii")
-    ).decode("ascii")
-
-    payload: str = (
-        "grant_type=client_credentials&scope=" + "%20".join(auth_scopes)
-        if auth_scopes
-        else ""
-    )
-    # noinspection SpellCheckingInspection
-    headers: Dict[str, str] = {
-        "Accept": "application/json",
-        "Authorization": "Basic " + login_token,
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-
-    # print(f"Calling {auth_server_url}")
-    async with ClientSession() as http:
-        async with http.request(
-                "POST", auth_server_url, headers=headers, data=payload
-        ) as response:
-            token_text: str = await response.text()
-            if not token_text:
-                return None
-            token_json: Dict[str, Any] = json.loads(token_text)
-
-            if "access_token" not in token_json:
-                raise Exception(f"No access token found in {token_json}")
-            access_token: str = token_json["access_token"]
-        return access_token
+    # the token endpoint and the access token are cached in process and on disk by the shared provider
+    return await get_access_token(fhir_server_url=fhir_server_url, client_id=client_id,
+                                  client_secret=client_secret, auth_scopes=auth_scopes, session=session)
 
 
 async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_atlas: bool, retrieve_only_ids: bool,
-                    use_access_index: bool = False):
+                    use_access_index: bool = False, pool: Optional[HttpSessionPool] = None,
+                    metrics: Optional[RunMetrics] = None, use_compression: bool = False,
+                    parse_workers: Optional[int] = None) -> RunMetrics:
     """
     loads data
+    :param parse_workers: parse the streamed resources: None to not parse them, 0 to parse them on the event loop,
+                          n to parse them in n worker processes
+    :param use_compression: let the server compress the response; it is decompressed here chunk by chunk
+    :param pool: connection pool to use for auth and data requests.  If not passed, one is created for this call.
     :param use_access_index:
     :param retrieve_only_ids:
     :type retrieve_only_ids:
@@ -69,11 +43,14 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     :param fhir_server:
     :type use_data_streaming:
     :param limit:
-    :return: None
+    :param metrics: timings of this run are recorded here.  If not passed, a new one is created.
+    :return: timings of this run
     """
     greater_than = "2023-05-01"
     less_than = "2023-05-30"
-    fhir_server_url = f"https://{fhir_server}/4_0_0/AuditEvent?date=gt{greater_than}&date=lt{less_than}&_count={limit}&_getpagesoffset=0"
+    # a url such as http://localhost:8080 (see mock_fhir_server.py) can be passed instead of a host name
+    fhir_server_base_url = fhir_server if "://" in fhir_server else f"https://{fhir_server}"
+    fhir_server_url = f"{fhir_server_base_url}/4_0_0/AuditEvent?date=gt{greater_than}&date=lt{less_than}&_count={limit}&_getpagesoffset=0"
     # fhir_server_url = f"https://{fhir_server}/4_0_0/AuditEvent?_lastUpdated=gt2022-04-20&_lastUpdated=lt2022-04-22&_elements=id&_count={limit}&_getpagesoffset=0"
     if retrieve_only_ids:
         fhir_server_url += "&_elements=id"
@@ -93,52 +70,58 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
     client_id = os.environ.get("FHIR_CLIENT_ID")
     client_secret = os.environ.get("FHIR_CLIENT_SECRET")
 
-    access_token = await authenticate(client_id=client_id, client_secret=client_secret, fhir_server_url=fhir_server_url)
+    owns_pool: bool = pool is None
+    pool = pool or HttpSessionPool()
+    access_token = await authenticate(client_id=client_id, client_secret=client_secret, fhir_server_url=fhir_server_url,
+                                      session=pool.session)
     headers = {
         "Accept": "application/fhir+ndjson" if use_data_streaming else "application/fhir+json",
         "Content-Type": "application/fhir+json",
         "Accept-Encoding": "gzip,deflate",
         "Authorization": f"Bearer {access_token}",
-        "Connection": "keep-alive",
-        "x-no-compression": "1"
+        "Connection": "keep-alive"
     }
+    if not use_compression:
+        headers["x-no-compression"] = "1"
 
     payload = {}
 
     start_job = time.time()
 
-    async def on_request_start(
-            session, trace_config_ctx, params):
-        print("Starting request")
-
-    async def on_request_end(session, trace_config_ctx, params):
-        print("Ending request")
-
-    async def on_response_chunk_received(session, trace_config_ctx, params):
-        print("Received chunk")
-
-    async def on_request_exception(session, trace_config_ctx, params):
-        print("Received exception")
-
-    trace_config = TraceConfig()
-    trace_config.on_request_start.append(on_request_start)
-    trace_config.on_request_end.append(on_request_end)
-    trace_config.on_response_chunk_received.append(on_response_chunk_received)
-    trace_config.on_request_exception.append(on_request_exception)
+    # dns, connect, first byte and chunk gap histograms, printed at the end
+    tracer = RequestTracer()
 
     dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
     print(f"{dt_string}: Calling {fhir_server_url} with Atlas={use_atlas}")
     chunk_number = 0
     num_lines: int = 0
-    async with ClientSession(timeout=ClientTimeout(total=0), trace_configs=[trace_config]) as http:
+    metrics = metrics or RunMetrics()
+    metrics.start()
+    # we decompress ourselves so the bytes on the wire and the CPU time of decompressing can be measured
+    async with pool.create_session(timeout=ClientTimeout(total=0), trace_configs=[tracer.trace_config],
+                                   auto_decompress=False) as http:
         async with http.request("GET", fhir_server_url, headers=headers, data=payload, ssl=False) as response:
+            metrics.record_first_byte(response.status)
+            decompressor = StreamingDecompressor(response.headers.get("Content-Encoding"))
             if response.status == 200:
                 dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                 print(f"{dt_string}: Received response for {fhir_server_url} with Atlas={use_atlas}.")
                 # print(f"{dt_string}: Headers= {response.headers}")
                 with open('output.json', mode='wb') as file:
                     if use_data_streaming:
-                        buffer = b""
+                        # a bytearray grows in place so assembling an HTTP chunk from fragments stays linear
+                        buffer = bytearray()
+                        on_chunk = tracer.chunk_timer()
+                        parsed_resource_ids: Set[str] = set()
+
+                        async def on_parsed(resources: List[Dict[str, Any]]) -> None:
+                            parsed_resource_ids.update(resource["id"] for resource in resources)
+
+                        # only the ids come back from the workers; unpickling whole resources would cost
+                        # the event loop almost as much as parsing them
+                        parse_stage: Optional[NdjsonParseStage] = NdjsonParseStage(
+                            on_parsed=on_parsed, max_workers=parse_workers, elements=["id"]
+                        ).start() if parse_workers is not None else None
 
                         # if you want to receive data one line at a time
                         # using `async for line in response.content` seems to have bugs
@@ -147,17 +130,34 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
                         async for data, end_of_http_chunk in response.content.iter_chunks():
                             chunk_number += 1
                             # file.write(data)
-                            buffer += data
+                            buffer += decompressor.decompress(data)
                             if end_of_http_chunk:
                                 # print("End of HTTP chunk")
-                                my_text = buffer.decode('utf-8')
-                                num_lines += my_text.count('\n')
+                                # count lines on the raw bytes; no need to decode to UTF-8 for that
+                                lines_in_chunk: int = buffer.count(b'\n')
+                                num_lines += lines_in_chunk
+                                on_chunk()
+                                metrics.record_chunk(len(buffer), lines_in_chunk,
+                                                     decompressor.wire_bytes - metrics.wire_byte_count)
                                 file.write(buffer)
                                 file.flush()
-                                buffer = b""
+                                if parse_stage:
+                                    await parse_stage.submit(buffer)
+                                buffer.clear()
                                 chunk_end_time = time.time()
                                 print(f"[{chunk_number:,}][{num_lines:,}] {timedelta(seconds=chunk_end_time - start_job)}",
                                       end='\r')
+                        buffer += decompressor.flush()
+                        if buffer:
+                            lines_in_chunk = buffer.count(b'\n')
+                            num_lines += lines_in_chunk
+                            metrics.record_chunk(len(buffer), lines_in_chunk, 0)
+                            file.write(buffer)
+                            if parse_stage:
+                                await parse_stage.submit(buffer)
+                        if parse_stage:
+                            await parse_stage.close()
+                            print(f"\n{parse_stage.report()}, {len(parsed_resource_ids):,} unique ids")
                         # async for line in response.content:
                         #     # await asyncio.sleep(0)
                         #     chunk_number += 1
@@ -175,19 +175,38 @@ async def load_data(fhir_server: str, use_data_streaming: bool, limit: int, use_
                         #     dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                         #     print(f"[{chunk_number}] {dt_string}: {data}")
                     else:
+                        wire_body: bytes = await response.read()
+                        body: bytes = bytes(decompressor.decompress(wire_body)) + decompressor.flush()
+                        metrics.record_chunk(len(body), len(json_codec.loads(body).get("entry") or []), len(wire_body))
                         print(response.status)
-                        print(await response.text())
+                        print(body.decode('utf-8'))
             else:
                 print(f"ERROR: {response.status} {await response.text()}")
+            metrics.record_decompression(decompressor.cpu_seconds)
+    metrics.finish()
     end_job = time.time()
     print(f"\n====== Received {num_lines} resources in {timedelta(seconds=end_job - start_job)}"
           f" with Atlas={use_atlas} =======")
+    print(f"Content-Encoding={decompressor.content_encoding} wire MB={metrics.wire_byte_count / (1024 * 1024):,.1f}"
+          f" decoded MB={metrics.byte_count / (1024 * 1024):,.1f} ratio={metrics.compression_ratio:.1f}"
+          f" decompress cpu={metrics.decompress_seconds:.2f}s of {metrics.cpu_seconds:.2f}s")
+    print(tracer.report())
+    print(pool.report())
+    if owns_pool:
+        await pool.close()
+    return metrics
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
     load_dotenv()
 
+    parser = argparse.ArgumentParser(description="Downloads resources with aiohttp and reports the throughput")
+    parser.add_argument("--parse-workers", type=int, default=None,
+                        help="also parse the streamed resources: 0 on the event loop, n in n worker processes."
+                             "  Off by default, so only the download is measured.")
+    args = parser.parse_args()
+
     prod_fhir_server_external = "fhir.icanbwell.com"
     prod_fhir_server = "fhir.prod-mstarvac.icanbwell.com"
     prod_next_fhir_server = "fhir-next.icanbwell.com"
@@ -216,7 +235,7 @@ if __name__ == '__main__':
     #                       use_atlas=True, retrieve_only_ids=True))
     print("--------- Prod Next FHIR with data streaming and Atlas, full resources -----")
     asyncio.run(load_data(fhir_server=prod_bulk_fhir_server, use_data_streaming=True, limit=10000,
-                          use_atlas=True, retrieve_only_ids=False))
+                          use_atlas=True, retrieve_only_ids=False, parse_workers=args.parse_workers))
     # print("--------- Prod  FHIR external, full resources -----")
     # asyncio.run(load_data(fhir_server=prod_fhir_server_external, use_data_streaming=False, limit=100,
     #                       use_atlas=False, retrieve_only_ids=False))
@@ -0,0 +1,80 @@
+import os
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import json_codec
+
+
+# FHIR allows any number of digits in the fraction of a second
+fraction_regex = re.compile(r"\.(\d+)")
+
+
+def parse_last_updated(value: str) -> datetime:
+    """
+    Parses a FHIR instant such as 2022-02-22T10:00:00.000Z into a naive UTC datetime,
+    the same kind of datetime as start_date and end_date
+    """
+    # fromisoformat on Python 3.7 only accepts 3 or 6 digits of fraction and no Z
+    value = fraction_regex.sub(lambda match: "." + match.group(1).ljust(6, "0")[:6], value.replace("Z", "+00:00"))
+    parsed: datetime = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class SyncWatermark:
+    """
+    High watermark of an incremental export: the largest meta.lastUpdated seen in the last successful run.
+
+    Watermarks are kept per key (server and resource type) in one json file.  The file is replaced atomically
+    so a crash while saving leaves the previous watermark, and the next run just re-reads a little more.
+    """
+
+    def __init__(self, file_path: str, key: str) -> None:
+        """
+        :param file_path: json file where the watermarks are kept
+        :param key: name to keep this export's watermark under, e.g. server url and resource type
+        """
+        self.file_path: str = file_path
+        self.key: str = key
+        # largest meta.lastUpdated passed to observe() in this run
+        self.max_seen: Optional[datetime] = None
+
+    def load(self) -> Optional[datetime]:
+        """
+        Returns the watermark saved by the last successful run, or None if there was none
+        """
+        if not os.path.exists(self.file_path):
+            return None
+        with open(self.file_path, mode='rb') as file:
+            watermarks: Dict[str, Any] = json_codec.loads(file.read())
+        entry: Optional[Dict[str, Any]] = watermarks.get(self.key)
+        return datetime.fromisoformat(entry["watermark"]) if entry else None
+
+    def observe(self, resources: List[Dict[str, Any]]) -> None:
+        """
+        Raises max_seen to the largest meta.lastUpdated of the resources
+        """
+        for resource in resources:
+            last_updated: Optional[str] = (resource.get("meta") or {}).get("lastUpdated")
+            if last_updated:
+                parsed: datetime = parse_last_updated(last_updated)
+                if self.max_seen is None or parsed > self.max_seen:
+                    self.max_seen = parsed
+
+    def save(self, watermark: datetime) -> None:
+        watermarks: Dict[str, Any] = {}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, mode='rb') as file:
+                watermarks = json_codec.loads(file.read())
+        watermarks[self.key] = {
+            "watermark": watermark.isoformat(),
+            "updated": datetime.now().isoformat()
+        }
+        temporary_file_path: str = f"{self.file_path}.tmp"
+        with open(temporary_file_path, mode='wb') as file:
+            file.write(json_codec.dumps(watermarks, indent=True))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_file_path, self.file_path)
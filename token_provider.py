@@ -0,0 +1,225 @@
+import asyncio
+import base64
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession
+from furl import furl
+
+import json_codec
+
+
+class TokenProvider:
+    """
+    Gets OAuth access tokens for a FHIR server using client credentials.
+
+    The token endpoint from .well-known/smart-configuration and the access token (with its expiry) are cached
+    in process and on disk, so repeated runs skip the auth round trips until the token is about to expire.
+    start_background_refresh() refreshes the token ahead of expiry so long exports never wait on auth.
+    """
+
+    # in-process caches shared by all providers: origin -> token endpoint, cache key -> token
+    _token_endpoints: Dict[str, str] = {}
+    _tokens: Dict[str, Dict[str, Any]] = {}
+
+    def __init__(self, fhir_server_url: str, client_id: str, client_secret: str, auth_scopes: List[str],
+                 cache_file: Optional[str] = ".token_cache.json", refresh_margin_seconds: int = 120,
+                 default_expires_in_seconds: int = 300, session: Optional[ClientSession] = None,
+                 max_retry_seconds: float = 60.0) -> None:
+        """
+        :param fhir_server_url: any url on the FHIR server; only the origin is used
+        :param client_id: OAuth client id
+        :param client_secret: OAuth client secret
+        :param auth_scopes: scopes to request
+        :param cache_file: json file to cache discovery and tokens in.  None to cache in process only.
+        :param refresh_margin_seconds: refresh the token this many seconds before it expires
+        :param default_expires_in_seconds: lifetime to assume when the token response has no expires_in
+        :param session: http session to use.  If not passed, a session is created for each refresh.
+        :param max_retry_seconds: longest wait between retries when the background refresh fails
+        """
+        self.origin: str = furl(fhir_server_url).origin
+        self.client_id: str = client_id
+        self.client_secret: str = client_secret
+        self.auth_scopes: List[str] = auth_scopes
+        self.cache_file: Optional[str] = cache_file
+        self.refresh_margin_seconds: int = refresh_margin_seconds
+        self.default_expires_in_seconds: int = default_expires_in_seconds
+        self.session: Optional[ClientSession] = session
+        self.max_retry_seconds: float = max_retry_seconds
+        # the secret is never part of the key so it never ends up in the cache file
+        self.cache_key: str = f"{self.origin}|{client_id}|{' '.join(sorted(auth_scopes))}"
+        self.auth_round_trips: int = 0
+        self._refresh_lock: asyncio.Lock = asyncio.Lock()
+        self._refresh_task: Optional["asyncio.Task[None]"] = None
+
+    async def get_access_token(self) -> str:
+        """
+        Returns a cached access token if it is still valid past the refresh margin, otherwise gets a new one
+        """
+        cached_token: Optional[Dict[str, Any]] = self._get_cached_token()
+        if cached_token and not self._is_due_for_refresh(cached_token):
+            return str(cached_token["access_token"])
+        async with self._refresh_lock:
+            # another caller may have refreshed while we were waiting on the lock
+            cached_token = self._get_cached_token()
+            if cached_token and not self._is_due_for_refresh(cached_token):
+                return str(cached_token["access_token"])
+            return await self._refresh_token()
+
+    def seconds_until_expiry(self) -> Optional[float]:
+        cached_token: Optional[Dict[str, Any]] = self._get_cached_token()
+        return float(cached_token["expires_at"]) - time.time() if cached_token else None
+
+    def start_background_refresh(self) -> None:
+        """
+        Starts a task that refreshes the token refresh_margin_seconds before it expires
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_in_background())
+
+    async def close(self) -> None:
+        """
+        Stops the background refresh task
+        """
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+    async def __aenter__(self) -> "TokenProvider":
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        await self.close()
+
+    async def _refresh_in_background(self) -> None:
+        retry_seconds: float = 1.0
+        while True:
+            try:
+                await self.get_access_token()
+            except asyncio.CancelledError:
+                # an Exception before Python 3.8; close() must still be able to stop the task
+                raise
+            except Exception as e:
+                # keep refreshing: the current token may be valid for a while yet and the auth server may recover
+                logging.getLogger("FhirPerformance").warning(
+                    f"Refreshing the access token for {self.origin} failed, retrying in {retry_seconds:.0f}s: {e}"
+                )
+                await asyncio.sleep(retry_seconds)
+                retry_seconds = min(self.max_retry_seconds, retry_seconds * 2)
+                continue
+            retry_seconds = 1.0
+            seconds_until_expiry: float = self.seconds_until_expiry() or 0.0
+            # wake up when the token enters the refresh margin, but never spin
+            await asyncio.sleep(max(1.0, seconds_until_expiry - self.refresh_margin_seconds))
+
+    def _is_due_for_refresh(self, token: Dict[str, Any]) -> bool:
+        return float(token["expires_at"]) - self.refresh_margin_seconds <= time.time()
+
+    def _get_cached_token(self) -> Optional[Dict[str, Any]]:
+        token: Optional[Dict[str, Any]] = TokenProvider._tokens.get(self.cache_key)
+        if token is None:
+            token = self._read_cache_file().get("tokens", {}).get(self.cache_key)
+            if token is not None:
+                TokenProvider._tokens[self.cache_key] = token
+        return token
+
+    async def _get_token_endpoint(self, http: ClientSession) -> str:
+        token_endpoint: Optional[str] = TokenProvider._token_endpoints.get(self.origin)
+        if token_endpoint is None:
+            token_endpoint = self._read_cache_file().get("token_endpoints", {}).get(self.origin)
+        if token_endpoint is None:
+            full_uri: furl = furl(self.origin)
+            full_uri /= ".well-known/smart-configuration"
+            async with http.request("GET", str(full_uri), ssl=False) as response:
+                body: bytes = await response.read()
+            self.auth_round_trips += 1
+            if response.status != 200:
+                raise Exception(f"Getting {full_uri} failed with status {response.status}: {body[:500]!r}")
+            response_json: Dict[str, Any] = json_codec.loads(body)
+            token_endpoint = str(response_json["token_endpoint"])
+            self._update_cache_file("token_endpoints", self.origin, token_endpoint)
+        TokenProvider._token_endpoints[self.origin] = token_endpoint
+        return token_endpoint
+
+    async def _refresh_token(self) -> str:
+        http, owns_session = self._get_session()
+        try:
+            auth_server_url: str = await self._get_token_endpoint(http)
+            login_token: str = base64.b64encode(
+                f"{self.client_id}:{self.client_secret}".encode("ascii")
+            ).decode("ascii")
+            payload: str = (
+                "grant_type=client_credentials&scope=" + "%20".join(self.auth_scopes)
+                if self.auth_scopes
+                else ""
+            )
+            # noinspection SpellCheckingInspection
+            headers: Dict[str, str] = {
+                "Accept": "application/json",
+                "Authorization": "Basic " + login_token,
+                "Content-Type": "application/x-www-form-urlencoded",
+            }
+            async with http.request("POST", auth_server_url, headers=headers, data=payload) as response:
+                token_body: bytes = await response.read()
+            self.auth_round_trips += 1
+        finally:
+            if owns_session:
+                await http.close()
+        if response.status != 200:
+            raise Exception(f"Token endpoint {auth_server_url} returned status {response.status}: {token_body[:500]!r}")
+        if not token_body:
+            raise Exception(f"Empty response from token endpoint {auth_server_url}")
+        token_json: Dict[str, Any] = json_codec.loads(token_body)
+        if "access_token" not in token_json:
+            raise Exception(f"No access token found in {token_json}")
+        token: Dict[str, Any] = {
+            "access_token": token_json["access_token"],
+            "expires_at": time.time() + int(token_json.get("expires_in") or self.default_expires_in_seconds)
+        }
+        TokenProvider._tokens[self.cache_key] = token
+        self._update_cache_file("tokens", self.cache_key, token)
+        return str(token["access_token"])
+
+    def _get_session(self) -> Tuple[ClientSession, bool]:
+        if self.session is not None:
+            return self.session, False
+        return ClientSession(), True
+
+    def _read_cache_file(self) -> Dict[str, Any]:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, mode='rb') as file:
+                result: Dict[str, Any] = json_codec.loads(file.read())
+                return result
+        except ValueError:
+            # a corrupt cache is just a cache miss
+            return {}
+
+    def _update_cache_file(self, section: str, key: str, value: Any) -> None:
+        if not self.cache_file:
+            return
+        cache: Dict[str, Any] = self._read_cache_file()
+        cache.setdefault(section, {})[key] = value
+        # the file holds access tokens so only the current user may read it.  The temporary file is per process
+        # because several processes, e.g. the workers of a sharded export, may refresh at the same time.
+        temp_file: str = f"{self.cache_file}.{os.getpid()}.tmp"
+        file_descriptor: int = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, mode='wb') as file:
+            file.write(json_codec.dumps(cache))
+        os.replace(temp_file, self.cache_file)
+
+
+async def get_access_token(fhir_server_url: str, client_id: str, client_secret: str,
+                           auth_scopes: List[str], session: Optional[ClientSession] = None) -> str:
+    """
+    Convenience wrapper used by the download scripts: returns a (possibly cached) access token
+    """
+    return await TokenProvider(fhir_server_url=fhir_server_url, client_id=client_id, client_secret=client_secret,
+                               auth_scopes=auth_scopes, session=session).get_access_token()
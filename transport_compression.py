@@ -0,0 +1,87 @@
+import time
+import zlib
+from typing import Optional, Union
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class StreamingDecompressor:
+    """
+    Decodes a gzip or deflate response body piece by piece as it arrives, so a compressed NDJSON stream
+    can be written and counted chunk by chunk without waiting for the whole body.
+
+    Counts the bytes on the wire, the decoded bytes and the CPU time spent decoding, which is the trade-off
+    for turning compression on: fewer bytes over slow links for some CPU on our side.
+    Bodies without a Content-Encoding (or identity) are passed through unchanged.
+    """
+
+    def __init__(self, content_encoding: Optional[str]) -> None:
+        """
+        :param content_encoding: value of the Content-Encoding header of the response
+        """
+        self.content_encoding: str = (content_encoding or "identity").strip().lower()
+        self.wbits: Optional[int]
+        if self.content_encoding in ("gzip", "x-gzip"):
+            self.wbits = 16 + zlib.MAX_WBITS
+        elif self.content_encoding == "deflate":
+            self.wbits = zlib.MAX_WBITS
+        elif self.content_encoding == "identity":
+            self.wbits = None
+        else:
+            raise ValueError(f"Unsupported Content-Encoding {content_encoding}")
+        self._decompressor = zlib.decompressobj(self.wbits) if self.wbits is not None else None
+        self._first_piece: bool = True
+        self.wire_bytes: int = 0
+        self.decoded_bytes: int = 0
+        self.cpu_seconds: float = 0.0
+
+    @property
+    def is_compressed(self) -> bool:
+        return self.wbits is not None
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.decoded_bytes / self.wire_bytes if self.wire_bytes else 0.0
+
+    def decompress(self, data: BytesLike) -> BytesLike:
+        """
+        Returns the decoded bytes of the next piece of the body; may be empty until a full block has arrived
+        """
+        self.wire_bytes += len(data)
+        if self._decompressor is None:
+            self.decoded_bytes += len(data)
+            return data
+        cpu_start: float = time.thread_time()
+        decoded: bytes = self._decompress(data)
+        self.cpu_seconds += time.thread_time() - cpu_start
+        self.decoded_bytes += len(decoded)
+        return decoded
+
+    def flush(self) -> bytes:
+        """
+        Returns whatever is left in the decompressor at the end of the body
+        """
+        if self._decompressor is None:
+            return b""
+        decoded: bytes = self._decompressor.flush()
+        self.decoded_bytes += len(decoded)
+        return decoded
+
+    def _decompress(self, data: BytesLike) -> bytes:
+        assert self._decompressor is not None
+        if self._first_piece:
+            self._first_piece = False
+            if self.content_encoding == "deflate":
+                try:
+                    return self._decompressor.decompress(data)
+                except zlib.error:
+                    # some servers send raw deflate without the zlib header, like urllib3 we accept both
+                    self.wbits = -zlib.MAX_WBITS
+                    self._decompressor = zlib.decompressobj(self.wbits)
+        decoded: bytes = self._decompressor.decompress(data)
+        # a gzip body may be several members one after the other
+        while self._decompressor.eof and self._decompressor.unused_data:
+            unused_data: bytes = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(self.wbits)
+            decoded += self._decompressor.decompress(unused_data)
+        return decoded